@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
+
+from plugins.settings import load_environment
+from plugins.sqlite_db import connect
+
+
+# Load environment variables from .env file
+load_environment()
+
+# the index lives next to the Gemini cache so that prepare_DAG does not clean it
+index_path = os.getenv('ARTICLE_INDEX_PATH', '/opt/airflow/dags/cache/article_index.sqlite')
+index_enabled = os.getenv('ARTICLE_INDEX', 'on').lower() not in ('off', 'false', '0')
+
+# tracking parameters that do not change the article behind a link
+tracking_parameters = {
+    'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'cmpid', 'ref_src', 'taid',
+}
+
+
+def canonicalize_url(url):
+    '''Normalize a link so that the same article is always indexed under one key'''
+    if not url:
+        return url
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_') and key.lower() not in tracking_parameters
+    ))
+    path = parts.path.rstrip('/') or '/'
+    scheme = 'https' if parts.scheme in ('http', 'https') else parts.scheme
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+class ArticleIndex:
+    '''Persistent index of the articles seen by earlier runs and of the feed validators'''
+    def __init__(self, path=index_path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with connect(self.path) as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS articles (
+                    canonical_link TEXT PRIMARY KEY,
+                    title TEXT,
+                    link TEXT,
+                    pub_date TEXT,
+                    source TEXT,
+                    run_id TEXT,
+                    first_seen REAL
+                )
+                '''
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS idx_articles_run ON articles (run_id, source)'
+            )
+            connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS feeds (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL
+                )
+                '''
+            )
+
+    def conditional_headers(self, url):
+        '''Return the If-None-Match and If-Modified-Since headers of a feed'''
+        with connect(self.path) as connection:
+            row = connection.execute(
+                'SELECT etag, last_modified FROM feeds WHERE url = ?', (url,)
+            ).fetchone()
+        headers = {}
+        if row and row[0]:
+            headers['If-None-Match'] = row[0]
+        if row and row[1]:
+            headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def save_validators(self, url, response_headers):
+        '''Remember the ETag and Last-Modified of a feed for the next conditional request'''
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        with self._lock, connect(self.path) as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO feeds VALUES (?, ?, ?, ?)',
+                (url, etag, last_modified, time.time())
+            )
+
+    def add(self, articles, source, run_id):
+        '''Index the articles not seen before, they belong to the run that found them'''
+        with self._lock, connect(self.path) as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO articles VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        canonicalize_url(article['link']), article['title'],
+                        article['link'], article['pub_date'], source, run_id, time.time()
+                    )
+                    for article in articles if article.get('link')
+                ]
+            )
+
+    def run_articles(self, source, run_id):
+        '''Return the articles of a source first seen by a run, used when its feed did not change'''
+        with connect(self.path) as connection:
+            rows = connection.execute(
+                'SELECT title, link, pub_date FROM articles WHERE source = ? AND run_id = ?',
+                (source, run_id)
+            ).fetchall()
+        return [{'title': title, 'link': link, 'pub_date': pub_date} for title, link, pub_date in rows]
+
+    def new_articles(self, articles, source, run_id):
+        '''Index the articles and keep only the ones first seen by this run'''
+        self.add(articles, source, run_id)
+        links = [canonicalize_url(article['link']) for article in articles if article.get('link')]
+        new_links = set()
+        with connect(self.path) as connection:
+            # a retried run still gets the articles it found the first time
+            for start in range(0, len(links), 500):
+                chunk = links[start:start + 500]
+                new_links.update(row[0] for row in connection.execute(
+                    f"SELECT canonical_link FROM articles WHERE run_id = ? "
+                    f"AND canonical_link IN ({','.join('?' * len(chunk))})",
+                    [run_id, *chunk]
+                ))
+
+        new = []
+        for article in articles:
+            canonical_link = canonicalize_url(article.get('link'))
+            if canonical_link in new_links:
+                # the same article can be listed by several feeds
+                new_links.discard(canonical_link)
+                new.append(article)
+        return new
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from plugins.article_index import canonicalize_url
+from plugins.settings import load_environment
+from plugins.sqlite_db import connect
+
+
+# Load environment variables from .env file
+load_environment()
+
+# the store keeps every run, prepare_DAG only prunes the runs older than the retention
+artifact_store_path = os.getenv(
+    'ARTIFACT_STORE_PATH', '/opt/airflow/dags/artifacts/artifacts.sqlite'
+)
+artifact_retention_days = float(os.getenv('ARTIFACT_RETENTION_DAYS', 30))
+
+# snapshot keys kept in their own columns, the others stay in the record column
+snapshot_columns = ('mode', 'text', 'screenshots_path', 'payload_bytes', 'elapsed', 'error')
+
+
+def article_id(link):
+    '''Stable id of an article, shared by its snapshot and its summary'''
+    return hashlib.sha1(canonicalize_url(link).encode('utf-8')).hexdigest()[:16]
+
+
+class ArtifactStore:
+    '''SQLite tables of the articles, snapshots, summaries and analyses of every run'''
+    def __init__(self, path=artifact_store_path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with connect(self.path, row_factory=sqlite3.Row) as connection:
+            connection.executescript(
+                '''
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY,
+                    started_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS articles (
+                    run_id TEXT,
+                    article_id TEXT,
+                    title TEXT,
+                    link TEXT,
+                    pub_date TEXT,
+                    source TEXT,
+                    selected INTEGER DEFAULT 0,
+                    position INTEGER,
+                    PRIMARY KEY (run_id, article_id)
+                );
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    run_id TEXT,
+                    article_id TEXT,
+                    url TEXT,
+                    mode TEXT,
+                    text TEXT,
+                    screenshots_path TEXT,
+                    payload_bytes INTEGER,
+                    elapsed REAL,
+                    error TEXT,
+                    record TEXT,
+                    PRIMARY KEY (run_id, article_id)
+                );
+                CREATE TABLE IF NOT EXISTS summaries (
+                    run_id TEXT,
+                    article_id TEXT,
+                    summary TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (run_id, article_id)
+                );
+                CREATE TABLE IF NOT EXISTS analyses (
+                    run_id TEXT,
+                    kind TEXT,
+                    content TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (run_id, kind)
+                );
+                CREATE INDEX IF NOT EXISTS idx_articles_article ON articles (article_id);
+                CREATE INDEX IF NOT EXISTS idx_snapshots_article ON snapshots (article_id);
+                CREATE INDEX IF NOT EXISTS idx_summaries_article ON summaries (article_id);
+                '''
+            )
+
+    def _write(self, sql, rows):
+        '''Append or replace rows in one transaction'''
+        with self._lock, connect(self.path, row_factory=sqlite3.Row) as connection:
+            connection.executemany(sql, rows)
+
+    def _read(self, sql, parameters):
+        '''Yield the rows of a query one by one'''
+        with connect(self.path, row_factory=sqlite3.Row) as connection:
+            yield from connection.execute(sql, parameters)
+
+    def start_run(self, run_id):
+        '''Register a run, a retried run keeps its first start time'''
+        self._write('INSERT OR IGNORE INTO runs VALUES (?, ?)', [(run_id, time.time())])
+
+    def run_started_at(self, run_id):
+        '''Start time of a run, None when it was not registered'''
+        rows = list(self._read('SELECT started_at FROM runs WHERE run_id = ?', (run_id,)))
+        return rows[0]['started_at'] if rows else None
+
+    def prune(self, days=artifact_retention_days):
+        '''Delete the runs started more than `days` days ago, returns how many'''
+        limit = time.time() - days * 86400
+        with self._lock, connect(self.path, row_factory=sqlite3.Row) as connection:
+            run_ids = [
+                row[0] for row in connection.execute(
+                    'SELECT run_id FROM runs WHERE started_at < ?', (limit,)
+                )
+            ]
+            for table in ('articles', 'snapshots', 'summaries', 'analyses', 'runs'):
+                connection.executemany(
+                    f'DELETE FROM {table} WHERE run_id = ?', [(run_id,) for run_id in run_ids]
+                )
+        return len(run_ids)
+
+    def add_articles(self, run_id, articles):
+        '''Store the crawled articles of a run in their order'''
+        self._write(
+            'INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+            [
+                (
+                    run_id, article_id(article['link']), article.get('title'),
+                    article['link'], article.get('pub_date'), article.get('source'), position
+                )
+                for position, article in enumerate(articles)
+            ]
+        )
+
+    def select_articles(self, run_id, links):
+        '''Mark the articles kept by the filter, in the order they will be snapshotted'''
+        self._write(
+            'UPDATE articles SET selected = ? WHERE run_id = ? AND article_id = ?',
+            [
+                (order, run_id, article_id(link))
+                for order, link in enumerate(links, start=1)
+            ]
+        )
+
+    def selected_links(self, run_id):
+        '''Links of the articles kept by the filter'''
+        return [
+            row['link'] for row in self._read(
+                'SELECT link FROM articles WHERE run_id = ? AND selected > 0 ORDER BY selected',
+                (run_id,)
+            )
+        ]
+
+    def add_snapshot(self, run_id, snapshot):
+        '''Store or update the snapshot record of an article'''
+        self._write(
+            'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(
+                run_id, article_id(snapshot['url']), snapshot['url'],
+                snapshot.get('mode'), snapshot.get('text'),
+                json.dumps(snapshot.get('screenshots_path') or []),
+                snapshot.get('payload_bytes'), snapshot.get('elapsed'), snapshot.get('error'),
+                json.dumps({
+                    key: value for key, value in snapshot.items()
+                    if key not in snapshot_columns and key not in ('url', 'article_id')
+                }),
+            )]
+        )
+
+    def snapshots(self, run_id, links=None):
+        '''Yield the snapshot records of a run in the order of the selected articles, only those of links when given'''
+        article_ids = {article_id(link) for link in links} if links is not None else None
+        for row in self._read(
+            '''
+            SELECT snapshots.* FROM snapshots
+            LEFT JOIN articles USING (run_id, article_id)
+            WHERE snapshots.run_id = ? ORDER BY articles.selected
+            ''',
+            (run_id,)
+        ):
+            if article_ids is not None and row['article_id'] not in article_ids:
+                continue
+            snapshot = json.loads(row['record'])
+            snapshot.update({key: row[key] for key in snapshot_columns})
+            snapshot['url'] = row['url']
+            snapshot['screenshots_path'] = json.loads(row['screenshots_path'])
+            snapshot['article_id'] = row['article_id']
+            yield snapshot
+
+    def add_summary(self, run_id, link, summary):
+        '''Store the summary of an article as soon as it is ready'''
+        self._write(
+            'INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?)',
+            [(run_id, article_id(link), summary, time.time())]
+        )
+
+    def article_summaries(self, run_id):
+        '''(article id, summary) pairs of a run in the order of the selected articles'''
+        return [
+            (row['article_id'], row['summary']) for row in self._read(
+                '''
+                SELECT summaries.article_id, summaries.summary FROM summaries
+                LEFT JOIN articles USING (run_id, article_id)
+                WHERE summaries.run_id = ? ORDER BY articles.selected
+                ''',
+                (run_id,)
+            )
+        ]
+
+    def summaries(self, run_id):
+        '''Summaries of a run in the order of the selected articles'''
+        return [summary for _, summary in self.article_summaries(run_id)]
+
+    def summarized_ids(self, run_id):
+        '''Ids of the articles of a run that already have a summary'''
+        return {
+            row['article_id'] for row in self._read(
+                'SELECT article_id FROM summaries WHERE run_id = ?', (run_id,)
+            )
+        }
+
+    def set_analysis(self, run_id, kind, content):
+        '''Store an analysis of a run, e.g. the market analysis'''
+        self._write(
+            'INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?)',
+            [(run_id, kind, content, time.time())]
+        )
+
+    def latest_analysis(self, kind, exclude_run_id=None):
+        '''Newest analysis of a kind made by another run, as {"run_id", "content", "created_at"}'''
+        rows = list(self._read(
+            '''
+            SELECT run_id, content, created_at FROM analyses
+            WHERE kind = ? AND run_id != ? ORDER BY created_at DESC LIMIT 1
+            ''',
+            (kind, exclude_run_id or '')
+        ))
+        return dict(rows[0]) if rows else None
+
+    def analysis(self, run_id, kind):
+        '''Return an analysis of a run, None when it was not made'''
+        rows = list(self._read(
+            'SELECT content FROM analyses WHERE run_id = ? AND kind = ?', (run_id, kind)
+        ))
+        return rows[0]['content'] if rows else None
@@ -0,0 +1,150 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from plugins.gemini_model import AnalyzeAI
+from plugins.gemini_model import FilterArticle
+from plugins.market_state import compact_state
+from plugins.market_state import merge_update
+from plugins.rate_limit import estimate_tokens
+from plugins.telemetry import context_map
+
+
+# estimated prompt tokens per FilterArticle request, instructions included
+filter_token_budget = int(os.getenv('FILTER_TOKEN_BUDGET', 3000))
+filter_concurrency = int(os.getenv('FILTER_CONCURRENCY', 4))
+
+# estimated prompt tokens per AnalyzeAI request, far below the context window
+analysis_shard_tokens = int(os.getenv('ANALYSIS_SHARD_TOKENS', 30000))
+analysis_concurrency = int(os.getenv('ANALYSIS_CONCURRENCY', 4))
+
+
+def pack_batches(items, token_counts, token_budget, overhead=0):
+    '''Group consecutive items into batches whose estimated tokens fit the budget'''
+    batches = []
+    batch = []
+    batch_tokens = overhead
+    for item, tokens in zip(items, token_counts):
+        # an item above the budget still gets a batch of its own
+        if batch and batch_tokens + tokens > token_budget:
+            batches.append(batch)
+            batch, batch_tokens = [], overhead
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def filter_articles(
+    articles,
+    token_budget=filter_token_budget,
+    concurrency=filter_concurrency,
+    client=None
+):
+    '''Filter the articles with as few FilterArticle requests as the token budget allows'''
+    if not articles:
+        return []
+
+    overhead = estimate_tokens(
+        FilterArticle([], client=client).filter_payload()['contents'][0]['parts'][0]['text']
+    )
+    # the ids restart from 1 in every batch, the widest one is used for the estimate
+    id_width = len(str(len(articles)))
+    token_counts = [
+        estimate_tokens(FilterArticle.article_line('9' * id_width, article)) + 1
+        for article in articles
+    ]
+    batches = pack_batches(articles, token_counts, token_budget, overhead)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = context_map(
+            executor,
+            lambda batch: FilterArticle(batch, client=client).AI_filter_article(),
+            batches
+        )
+        links = [link for batch_links in results for link in batch_links]
+
+    print(
+        f"Filtered {len(articles)} articles in {len(batches)} batches "
+        f"of at most {token_budget} tokens, about "
+        f"{overhead * len(batches) + sum(token_counts)} prompt tokens, "
+        f"{len(links)} articles kept"
+    )
+    return links
+
+
+def analyze_market(
+    summaries,
+    shard_tokens=analysis_shard_tokens,
+    concurrency=analysis_concurrency,
+    client=None
+):
+    '''Analyze the summaries in one request, or map them over token-bounded shards and reduce'''
+    texts = [summary for summary in summaries if summary]
+    if not texts:
+        return ''
+
+    level = 0
+    while True:
+        # the first level analyzes summaries, the next ones merge partial analyses
+        payload = AnalyzeAI([], client=client)
+        payload = payload.analysis_payload() if level == 0 else payload.reduce_payload()
+        overhead = estimate_tokens(payload['contents'][0]['parts'][0]['text'])
+        token_counts = [estimate_tokens(text) + 8 for text in texts]
+        shards = pack_batches(texts, token_counts, shard_tokens, overhead)
+
+        # a level that cannot group its texts any more is merged in one request
+        if len(shards) == 1 or (level > 0 and len(shards) >= len(texts)):
+            analyze_AI = AnalyzeAI(texts, client=client)
+            if level == 0:
+                return analyze_AI.AI_analysis_market()
+            return analyze_AI.AI_reduce_analysis()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            partials = list(context_map(
+                executor,
+                lambda shard: (
+                    AnalyzeAI(shard, client=client).AI_analysis_market() if level == 0
+                    else AnalyzeAI(shard, client=client).AI_reduce_analysis()
+                ),
+                shards
+            ))
+        print(
+            f"Analysis level {level}: {len(texts)} texts of about {sum(token_counts)} "
+            f"tokens analyzed in {len(shards)} shards"
+        )
+        texts = [partial for partial in partials if partial]
+        if not texts:
+            return ''
+        level += 1
+
+
+def update_market_state(state, articles, shard_tokens=analysis_shard_tokens, client=None):
+    '''Fold the new (article id, summary) pairs into the PESTEL state, one token-bounded shard at a time'''
+    texts = [f"[{article_id}] {summary}" for article_id, summary in articles if summary]
+    ids = [article_id for article_id, summary in articles if summary]
+    if not texts:
+        print("No new article, the PESTEL state is kept as it is.")
+        return state
+
+    overhead = estimate_tokens(
+        AnalyzeAI([], client=client, market_state=compact_state(state))
+        .update_state_payload()['contents'][0]['parts'][0]['text']
+    )
+    token_counts = [estimate_tokens(text) + 8 for text in texts]
+    shards = pack_batches(list(zip(ids, texts)), token_counts, shard_tokens, overhead)
+    print(
+        f"{len(texts)} new articles of about {sum(token_counts)} tokens folded into "
+        f"a state of about {overhead} tokens in {len(shards)} requests"
+    )
+    # each shard updates the state left by the previous one
+    for shard in shards:
+        update = AnalyzeAI(
+            [text for _, text in shard], client=client, market_state=compact_state(state)
+        ).AI_update_state()
+        if update is None:
+            print(f"The PESTEL state could not be updated with {len(shard)} articles.")
+            continue
+        state = merge_update(state, update, [article_id for article_id, _ in shard])
+    return state
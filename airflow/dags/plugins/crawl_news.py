@@ -1,14 +1,255 @@
 import os
+import queue
+import time
 import xml.etree.ElementTree as ET
 
 import requests
 
-from concurrent.futures import as_completed
-from concurrent.futures import ThreadPoolExecutor
-from dotenv import load_dotenv
+from threading import Thread
+
+from plugins.settings import load_environment
+from plugins.telemetry import in_context
+from plugins.telemetry import metrics
+from plugins.telemetry import span
 
 # Load environment variables from .env file
-load_dotenv()
+load_environment()
+
+# seconds a source may take in total, the articles it has not delivered by then are dropped
+source_timeout = float(os.getenv('NEWS_SOURCE_TIMEOUT', 30))
+newsapi_max_pages = int(os.getenv('NEWSAPI_MAX_PAGES', 3))
+newsapi_url = os.getenv('NEWSAPI_URL', 'https://newsapi.org/v2/top-headlines')
+
+user_agent = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+    'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+)
+
+# articles are checked against the index by chunks while a feed streams in
+index_chunk_size = 50
+
+
+def local_name(tag):
+    '''Strip the namespace of an XML tag'''
+    return tag.rsplit('}', 1)[-1]
+
+
+def child_text(element, *names):
+    '''Text of the first non-empty child with one of the names'''
+    for child in element:
+        if local_name(child.tag) in names and child.text and child.text.strip():
+            return child.text.strip()
+    return None
+
+
+def entry_link(element):
+    '''Link of an RSS item or of an Atom entry'''
+    link = None
+    for child in element:
+        if local_name(child.tag) != 'link':
+            continue
+        if child.get('href'):
+            # Atom: prefer the alternate link, the others point to comments or media
+            if child.get('rel', 'alternate') == 'alternate':
+                return child.get('href')
+            link = link or child.get('href')
+        elif child.text and child.text.strip():
+            return child.text.strip()
+    guid = child_text(element, 'guid', 'id')
+    if not link and guid and guid.startswith('http'):
+        link = guid
+    return link
+
+
+def normalize_entry(element, source):
+    '''Turn an RSS item or an Atom entry into an article record, None without a link'''
+    link = entry_link(element)
+    if not link:
+        return None
+    return {
+        'title': child_text(element, 'title') or '',
+        'link': link,
+        'pub_date': child_text(element, 'pubDate', 'published', 'updated', 'date') or '',
+        'source': source,
+    }
+
+
+class FeedSource:
+    '''A news source yielding normalized article records'''
+    def __init__(self, name, timeout=source_timeout):
+        self.name = name
+        self.timeout = timeout
+        self.not_modified = False
+        self.response_headers = {}
+
+    def records(self, deadline, index=None):
+        '''Yield the articles of the source, raise TimeoutError after the deadline'''
+        raise NotImplementedError
+
+
+class XMLFeedSource(FeedSource):
+    '''RSS or Atom feed, parsed incrementally while its bytes stream in'''
+    def __init__(self, url, timeout=source_timeout):
+        super().__init__(url, timeout)
+        self.url = url
+
+    def records(self, deadline, index=None):
+        headers = {'User-Agent': user_agent}
+        if index:
+            headers.update(index.conditional_headers(self.url))
+
+        with requests.get(
+            self.url, headers=headers, stream=True, timeout=min(self.timeout, 10)
+        ) as response:
+            if response.status_code == 304:
+                print(f"Feed not modified since the last run: {self.url}.")
+                self.not_modified = True
+                return
+            response.raise_for_status()  # Raise an error for bad responses
+            self.response_headers = response.headers
+
+            parser = ET.XMLPullParser(events=('end',))
+            for chunk in response.iter_content(chunk_size=16384):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"{self.url} took more than {self.timeout}s")
+                parser.feed(chunk)
+                yield from self.read_entries(parser)
+            parser.close()
+            yield from self.read_entries(parser)
+
+    def read_entries(self, parser):
+        '''Yield the items and entries completed by the bytes fed so far'''
+        for _, element in parser.read_events():
+            if local_name(element.tag) in ('item', 'entry'):
+                record = normalize_entry(element, self.name)
+                # free the parsed entry, the feed is never held in memory as a whole
+                element.clear()
+                if record:
+                    yield record
+
+
+class NewsAPISource(FeedSource):
+    '''NewsAPI top headlines, page after page'''
+    def __init__(self, api_key, max_pages=newsapi_max_pages, page_size=100, timeout=source_timeout):
+        super().__init__('newsapi', timeout)
+        self.api_key = api_key
+        self.max_pages = max_pages
+        self.page_size = page_size
+
+    def records(self, deadline, index=None):
+        for page in range(1, self.max_pages + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"newsapi took more than {self.timeout}s")
+            response = requests.get(
+                newsapi_url,
+                params={
+                    'country': 'us', 
+                    'apiKey': self.api_key, 
+                    'pageSize': self.page_size, 
+                    'page': page
+                },
+                timeout=min(remaining, 10)
+            )
+            if response.status_code != 200:
+                print(f"Error fetching newsapi page {page}: {response.status_code}")
+                return
+            data = response.json()
+            for article in data.get('articles', []):
+                if article.get('url'):
+                    yield {
+                        'title': article.get('title') or '', 
+                        'link': article['url'], 
+                        'pub_date': article.get('publishedAt') or '',
+                        'source': self.name,
+                    }
+            if not data.get('articles') or page * self.page_size >= data.get('totalResults', 0):
+                return
+
+
+def news_sources():
+    '''Build the sources configured by RSS_URL and NEWSAPI'''
+    sources = [
+        XMLFeedSource(url.strip()) for url in os.getenv('RSS_URL', '').split(";;") if url.strip()
+    ]
+    if os.getenv('NEWSAPI'):
+        sources.append(NewsAPISource(os.getenv('NEWSAPI')))
+    return sources
+
+
+def crawl_sources(sources, index=None, run_id=None):
+    '''Run every source in its own thread and yield their articles as they arrive'''
+    records = queue.Queue()
+
+
+    def deliver(source, chunk):
+        '''This function sends a chunk of articles, only the new ones when indexed'''
+        if index and chunk:
+            chunk = index.new_articles(chunk, source.name, run_id)
+        for record in chunk:
+            records.put((source.name, record))
+        return len(chunk)
+
+
+    def run_source(source):
+        '''This function reads one source until it ends, fails or runs out of time'''
+        with span('crawl.source', source=source.name) as source_span:
+            start_time = time.monotonic()
+            deadline = start_time + source.timeout
+            chunk = []
+            delivered = 0
+            try:
+                for record in source.records(deadline, index=index):
+                    chunk.append(record)
+                    if len(chunk) >= index_chunk_size:
+                        delivered += deliver(source, chunk)
+                        chunk = []
+                delivered += deliver(source, chunk)
+                if index and source.not_modified:
+                    # nothing new, unless this run is a retry that already indexed the feed
+                    for record in index.run_articles(source.name, run_id):
+                        records.put((source.name, record))
+                        delivered += 1
+                elif index:
+                    # the validators are saved once the items are indexed, so a failed run refetches
+                    index.save_validators(source.name, source.response_headers)
+                print(
+                    f"{delivered} articles from {source.name} "
+                    f"in {time.monotonic() - start_time:.1f}s."
+                )
+                source_span.set(not_modified=source.not_modified)
+            except Exception as e:
+                delivered += deliver(source, chunk)
+                print(f"Error crawling {source.name} after {delivered} articles: {e}")
+                source_span.status = 'error'
+                source_span.set(error=str(e))
+                metrics.inc('crawl_source_errors_total', source=source.name)
+            finally:
+                source_span.set(articles=delivered)
+                metrics.inc('crawl_articles_total', delivered, source=source.name)
+                metrics.observe(
+                    'crawl_source_seconds', time.monotonic() - start_time, source=source.name
+                )
+                records.put((source.name, None))
+
+
+    for source in sources:
+        # a source stuck in a read is abandoned, it never holds the DAG task
+        Thread(target=in_context(run_source), args=(source,), daemon=True).start()
+
+    pending = {source.name for source in sources}
+    deadline = time.monotonic() + max((source.timeout for source in sources), default=0) + 5
+    while pending:
+        try:
+            name, record = records.get(timeout=max(deadline - time.monotonic(), 0.1))
+        except queue.Empty:
+            print(f"Sources abandoned after their timeout: {', '.join(sorted(pending))}")
+            break
+        if record is None:
+            pending.discard(name)
+        else:
+            yield record
+
 
 class CrawlRSSNews:
     # '''Retrieve and parse RSS feed News'''
@@ -48,49 +289,19 @@ class CrawlRSSNews:
     #             print("No data to parse.")
             
     #     return articles
-    def __init__(self):
+    def __init__(self, index=None, run_id=None):
         self.rss_url = os.getenv('RSS_URL').split(";;")
-
-    def fetch_data(self, url):
-        '''Fetch RSS feed data from a URL'''
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                          'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-        }
-        try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()  # Raise an error for bad responses
-            print(f"Data fetched successfully from {url}.")
-            return response.text
-        except requests.RequestException as e:
-            print(f"Error fetching data from {url}: {e}")
-            return None
-
-    def parse_feed(self, feed_data):
-        '''Parse the RSS feed data and extract articles'''
-        articles = []
-        if feed_data:
-            root = ET.fromstring(feed_data)
-            for item in root.findall('.//item'):
-                title = item.find('title').text
-                link = item.find('link').text
-                pub_date = item.find('pubDate').text
-                articles.append({'title': title, 'link': link, 'pub_date': pub_date})
-        return articles
+        # with an index only the articles first seen by run_id are returned
+        self.index = index
+        self.run_id = run_id
 
     def parse_data(self):
-        '''Fetch and parse RSS feed data concurrently'''
-        all_articles = []
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            # Fetch data concurrently
-            future_to_url = {executor.submit(self.fetch_data, url): url for url in self.rss_url}
-            for future in as_completed(future_to_url):
-                feed_data = future.result()
-                # Parse data concurrently
-                articles = self.parse_feed(feed_data)
-                all_articles.extend(articles)
-
-        return all_articles
+        '''Fetch and parse every RSS or Atom feed concurrently'''
+        return list(crawl_sources(
+            [XMLFeedSource(url) for url in self.rss_url], 
+            index=self.index, 
+            run_id=self.run_id
+        ))
     
     def display_articles(self):
         articles = self.parse_data()
@@ -102,17 +313,10 @@ class CrawlRSSNews:
             )
             
 
-def crawl_api_news():
-    newsapi = os.getenv('NEWSAPI')
-    newsapi_url=f'https://newsapi.org/v2/top-headlines?country=us&apiKey={newsapi}'
-
-    response = requests.get(newsapi_url)
-    data = []
-    if response.status_code == 200:
-        for article in response.json()['articles']:
-            data.append({
-                'title': article['title'], 
-                'link': article['url'], 
-                'pub_date': article['publishedAt']
-            })
-    return data
+def crawl_api_news(index=None, run_id=None):
+    '''Fetch every page of the NewsAPI top headlines'''
+    return list(crawl_sources(
+        [NewsAPISource(os.getenv('NEWSAPI'))], 
+        index=index, 
+        run_id=run_id
+    ))
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import re
+
+from plugins.article_index import canonicalize_url
+
+
+# titles sharing at least this share of their character shingles are the same story
+title_similarity = float(os.getenv('TITLE_SIMILARITY', 0.5))
+
+# 16 bands of 4 MinHash rows catch pairs above about (1/16) ** (1/4) = 0.5 similarity
+minhash_bands = 16
+minhash_rows = 4
+
+shingle_size = 4
+
+# (a * x + b) mod 2**64 with an odd a stands for one hash permutation of MinHash
+minhash_permutations = [
+    (
+        int.from_bytes(hashlib.blake2b(f'a{seed}'.encode('utf-8'), digest_size=8).digest(), 'big') | 1,
+        int.from_bytes(hashlib.blake2b(f'b{seed}'.encode('utf-8'), digest_size=8).digest(), 'big')
+    )
+    for seed in range(minhash_bands * minhash_rows)
+]
+hash_mask = (1 << 64) - 1
+
+# " - CBS News", " | NBC News": the outlet name is not part of the story
+title_suffix = re.compile(r'\s+[-|–—]\s+[^-|–—]{2,40}$')
+
+
+def normalize_title(title):
+    '''Lowercase the title, drop the outlet suffix and the punctuation'''
+    title = title_suffix.sub('', (title or '').strip())
+    return ' '.join(re.findall(r'\w+', title.lower()))
+
+
+def shingles(text):
+    '''Set of the hashed character shingles of a text'''
+    return {
+        int.from_bytes(
+            hashlib.blake2b(text[index:index + shingle_size].encode('utf-8'), digest_size=8)
+            .digest(), 'big'
+        )
+        for index in range(max(len(text) - shingle_size + 1, 1))
+    }
+
+
+def minhash(shingle_set):
+    '''MinHash signature of a set of hashed shingles'''
+    return [
+        min((a * value + b) & hash_mask for value in shingle_set)
+        for a, b in minhash_permutations
+    ]
+
+
+def jaccard(set_a, set_b):
+    '''Share of the elements common to two sets'''
+    return len(set_a & set_b) / max(len(set_a | set_b), 1)
+
+
+class UnionFind:
+    '''Disjoint sets of item positions'''
+    def __init__(self, size):
+        self.parents = list(range(size))
+
+    def find(self, item):
+        while self.parents[item] != item:
+            self.parents[item] = self.parents[self.parents[item]]
+            item = self.parents[item]
+        return item
+
+    def union(self, item_a, item_b):
+        root_a, root_b = self.find(item_a), self.find(item_b)
+        if root_a != root_b:
+            # the earliest article stays the root of its cluster
+            self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def dedup_articles(articles, similarity=title_similarity):
+    '''Keep one article per story, returns (representatives, cluster size per kept link)'''
+    clusters = UnionFind(len(articles))
+
+    # same canonical link
+    first_by_link = {}
+    for position, article in enumerate(articles):
+        canonical_link = canonicalize_url(article['link'])
+        if canonical_link in first_by_link:
+            clusters.union(first_by_link[canonical_link], position)
+        else:
+            first_by_link[canonical_link] = position
+
+    # close titles: only the articles sharing a band of their signatures are compared
+    title_shingles = [
+        shingles(normalize_title(article['title'])) if normalize_title(article['title']) else None
+        for article in articles
+    ]
+    buckets = {}
+    for position, shingle_set in enumerate(title_shingles):
+        if not shingle_set:
+            continue
+        signature = minhash(shingle_set)
+        for band in range(minhash_bands):
+            key = (band, *signature[band * minhash_rows:(band + 1) * minhash_rows])
+            buckets.setdefault(key, []).append(position)
+
+    compared = set()
+    for positions in buckets.values():
+        for index, position_a in enumerate(positions):
+            for position_b in positions[index + 1:]:
+                if (position_a, position_b) in compared:
+                    continue
+                compared.add((position_a, position_b))
+                if jaccard(title_shingles[position_a], title_shingles[position_b]) >= similarity:
+                    clusters.union(position_a, position_b)
+
+    cluster_sizes = {}
+    for position in range(len(articles)):
+        root = clusters.find(position)
+        cluster_sizes[root] = cluster_sizes.get(root, 0) + 1
+
+    representatives = [articles[root] for root in sorted(cluster_sizes)]
+    print(
+        f"Deduplicated {len(articles)} articles into {len(representatives)} stories "
+        f"({len(compared)} title pairs compared instead of "
+        f"{len(articles) * (len(articles) - 1) // 2})"
+    )
+    return representatives, {
+        articles[root]['link']: size for root, size in cluster_sizes.items()
+    }
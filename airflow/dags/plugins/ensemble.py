@@ -0,0 +1,106 @@
+import os
+import statistics
+
+from datetime import datetime
+
+from plugins.structured_output import to_price
+from plugins.structured_output import zone_fields
+
+
+# opinions requested at most, by waves, until they agree
+opinion_samples = int(os.getenv('OPINION_SAMPLES', 4))
+opinion_wave_size = int(os.getenv('OPINION_WAVE_SIZE', 2))
+
+# opinions agree when every zone bound spreads less than this share of its median
+opinion_tolerance = float(os.getenv('OPINION_TOLERANCE', 0.01))
+
+# share of the lowest and of the highest values left out of the trimmed mean
+trim_share = 0.2
+
+zone_keys = [(field, bound) for field in zone_fields for bound in ('min', 'max')]
+
+
+def zone_values(recommendation):
+    '''Prices of the zone bounds of a recommendation, None when one is missing'''
+    try:
+        values = {
+            (field, bound): to_price(recommendation[field][bound])
+            for field, bound in zone_keys
+        }
+    except (KeyError, TypeError):
+        return None
+    return values if None not in values.values() else None
+
+
+def trimmed_mean(values, share=trim_share):
+    '''Mean of the values without the lowest and highest share of them'''
+    values = sorted(values)
+    cut = int(len(values) * share)
+    kept = values[cut:len(values) - cut] or values
+    return sum(kept) / len(kept)
+
+
+def dispersion(values):
+    '''Spread of the values relative to their median'''
+    median = statistics.median(values)
+    return (max(values) - min(values)) / abs(median) if median else float('inf')
+
+
+def opinions_agree(opinions, tolerance=opinion_tolerance):
+    '''Tell whether at least two opinions give the same zones within the tolerance'''
+    values = [zone_values(opinion) for opinion in opinions]
+    values = [value for value in values if value]
+    if len(values) < 2:
+        return False
+    return all(
+        dispersion([value[key] for value in values]) <= tolerance for key in zone_keys
+    )
+
+
+def aggregate_opinions(opinions):
+    '''Merge the opinions locally: median zones, trimmed means and dispersion per bound'''
+    values = [zone_values(opinion) for opinion in opinions]
+    values = [value for value in values if value]
+    if not values:
+        return None
+
+    recommendation = {field: {} for field in zone_fields}
+    recommendation['trimmed_mean'] = {field: {} for field in zone_fields}
+    recommendation['dispersion'] = {field: {} for field in zone_fields}
+    for field, bound in zone_keys:
+        prices = [value[(field, bound)] for value in values]
+        recommendation[field][bound] = round(statistics.median(prices), 2)
+        recommendation['trimmed_mean'][field][bound] = round(trimmed_mean(prices), 2)
+        recommendation['dispersion'][field][bound] = round(dispersion(prices), 4)
+    recommendation['opinions'] = len(values)
+    recommendation['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return recommendation
+
+
+async def run_opinion_ensemble(
+    investment_AI,
+    client,
+    samples=opinion_samples,
+    wave_size=opinion_wave_size,
+    tolerance=opinion_tolerance
+):
+    '''Request opinions wave after wave and stop as soon as they agree, returns (opinions, agreed)'''
+    opinions = []
+    requested = 0
+    while requested < samples:
+        wave = range(requested, min(requested + wave_size, samples))
+        answers = await client.gather(
+            investment_AI.agenerate_opinion_investment_advice(sample=sample)
+            for sample in wave
+        )
+        requested += len(wave)
+        opinions += [
+            (sample, answer) for sample, answer in zip(wave, answers) if answer
+        ]
+        if opinions_agree([opinion for _, opinion in opinions], tolerance):
+            print(f"{len(opinions)} opinions agree after {requested} requests.")
+            if requested < samples:
+                print(f"{samples - requested} opinion requests saved by stopping early.")
+            return opinions, True
+    print(f"Opinions still differ after {requested} requests.")
+    return opinions, False
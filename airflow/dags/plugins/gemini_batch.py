@@ -0,0 +1,142 @@
+import json
+import os
+
+import requests
+
+from plugins.gemini_model import gemini_client
+from plugins.gemini_model import response_text
+
+
+# inline batch requests are limited to 20MB, larger sets are split in several jobs
+batch_max_bytes = int(float(os.getenv('GEMINI_BATCH_MAX_MB', 18)) * 1024 * 1024)
+
+finished_states = ('SUCCEEDED', 'FAILED', 'CANCELLED', 'EXPIRED')
+
+
+def batch_urls(api_url):
+    '''Derive the batch submission URL and the operations base URL from API_PATH'''
+    path, _, query = api_url.partition('?')
+    submit_url = path.replace(':generateContent', ':batchGenerateContent')
+    base_url = path.split('/models/')[0]
+    return f'{submit_url}?{query}' if query else submit_url, base_url, query
+
+
+def batch_state(operation):
+    '''State of a batch operation without its BATCH_STATE_ or JOB_STATE_ prefix'''
+    state = (operation.get('metadata') or {}).get('state', '')
+    if operation.get('done') and not state:
+        state = 'SUCCEEDED' if 'response' in operation else 'FAILED'
+    return state.split('_STATE_')[-1]
+
+
+def inlined_responses(operation):
+    '''The inlined responses of a finished batch operation'''
+    for output in (
+        operation.get('response') or {},
+        (operation.get('metadata') or {}).get('output') or {},
+    ):
+        responses = (output.get('inlinedResponses') or {}).get('inlinedResponses')
+        if responses:
+            return responses
+    return []
+
+
+class GeminiBatch:
+    '''Submit many generateContent requests as inline batch jobs and collect their answers'''
+    def __init__(self, client=None, api_url=None):
+        self.client = client or gemini_client
+        self.submit_url, self.base_url, self.query = batch_urls(api_url or self.client.api_url)
+
+    def cached(self, keyed_payloads, call_type, parse=None):
+        '''Split {key: payload} into the answers already cached and the payloads left to send'''
+        answers, remaining = {}, {}
+        for key, payload in keyed_payloads.items():
+            _, answer = self.client.cached_answer(payload, parse, call_type)
+            if answer is None:
+                remaining[key] = payload
+            else:
+                answers[key] = answer
+        return answers, remaining
+
+    def submit(self, keyed_payloads, display_name='batch', call_type=None):
+        '''Send {key: payload} as one or more jobs, returns ([{"name": ..., "keys": [...]}], unsent keys)
+
+        A job that cannot be submitted is left out, its keys are returned so the caller
+        can send them as direct requests.
+        '''
+        groups = []
+        group, group_bytes = [], 0
+        for key, payload in keyed_payloads.items():
+            request = {'request': payload, 'metadata': {'key': key}}
+            size = len(json.dumps(request))
+            if group and group_bytes + size > batch_max_bytes:
+                groups.append(group)
+                group, group_bytes = [], 0
+            group.append(request)
+            group_bytes += size
+        if group:
+            groups.append(group)
+
+        jobs, unsent = [], []
+        for index, group in enumerate(groups):
+            try:
+                jobs.append(self._submit_group(group, f'{display_name}-{index}', call_type))
+            except requests.RequestException as e:
+                print(f"Could not submit the batch {display_name}-{index}: {e}")
+                unsent.extend(request['metadata']['key'] for request in group)
+        return jobs, unsent
+
+    def _submit_group(self, group, display_name, call_type):
+        # the answers are cached like the direct requests once the job is done
+        cache_keys = {
+            request['metadata']['key']: self.client.cache_key(request['request'])
+            for request in group
+        } if self.client.cache and call_type else {}
+        name = self.client.request_json('POST', self.submit_url, {
+            'batch': {
+                'display_name': display_name,
+                'input_config': {'requests': {'requests': group}},
+            }
+        })['name']
+        print(f"Batch {name} submitted with {len(group)} requests.")
+        return {
+            'name': name,
+            'keys': [request['metadata']['key'] for request in group],
+            'cache_keys': cache_keys,
+            'call_type': call_type,
+        }
+
+    def operation(self, name):
+        '''Fetch the current state of a batch operation'''
+        url = f'{self.base_url}/{name}'
+        return self.client.request_json('GET', f'{url}?{self.query}' if self.query else url)
+
+    def cancel(self, name):
+        '''Ask the server to stop a batch that is no longer awaited'''
+        url = f'{self.base_url}/{name}:cancel'
+        try:
+            self.client.request_json('POST', f'{url}?{self.query}' if self.query else url)
+        except requests.RequestException as e:
+            print(f"Could not cancel {name}: {e}")
+
+    def collect(self, job, parse=None):
+        '''Return (finished, {key: answer}) for a job, the failed requests are left out'''
+        operation = self.operation(job['name'])
+        state = batch_state(operation)
+        if state not in finished_states:
+            return False, {}
+        if state != 'SUCCEEDED':
+            print(f"Batch {job['name']} ended as {state}.")
+            return True, {}
+
+        answers = {}
+        for item in inlined_responses(operation):
+            key = (item.get('metadata') or {}).get('key')
+            try:
+                text = response_text(item['response'])
+                answers[key] = parse(text) if parse else text
+            except Exception:
+                # a request of the batch failed, the caller falls back to a direct request
+                continue
+            self.client.store_answer(job.get('cache_keys', {}).get(key), job.get('call_type'), text)
+        return True, answers
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from plugins.settings import load_environment
+
+
+# Load environment variables from .env file
+load_environment()
+
+# the cache lives next to the DAG so that prepare_DAG does not clean it
+cache_path = os.getenv('GEMINI_CACHE_PATH', '/opt/airflow/dags/cache/gemini_cache.sqlite')
+cache_max_bytes = int(float(os.getenv('GEMINI_CACHE_MAX_MB', 200)) * 1024 * 1024)
+cache_enabled = os.getenv('GEMINI_CACHE', 'on').lower() not in ('off', 'false', '0')
+
+# time to live of a cached answer per call type, in seconds
+default_ttls = {
+    'filter': 24 * 3600,
+    'summary': 7 * 24 * 3600,
+    'analysis': 24 * 3600,
+    'opinion': 12 * 3600,
+    'final': 12 * 3600,
+}
+
+
+def parse_ttls(value):
+    '''Parse TTL overrides written as "summary=604800,filter=3600"'''
+    ttls = dict(default_ttls)
+    for item in (value or '').split(','):
+        if '=' in item:
+            call_type, seconds = item.split('=', 1)
+            ttls[call_type.strip()] = int(seconds)
+    return ttls
+
+
+class ResponseCache:
+    '''Content-addressed on-disk cache of generateContent answers with TTL and LRU eviction'''
+    def __init__(self, path=cache_path, max_bytes=cache_max_bytes, ttls=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = ttls or parse_ttls(os.getenv('GEMINI_CACHE_TTL'))
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _connect(self):
+        '''Open a connection, creating the cache table on first use'''
+        if not self._ready:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._ready:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    call_type TEXT,
+                    response TEXT,
+                    size INTEGER,
+                    created_at REAL,
+                    last_access REAL
+                )
+                '''
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)'
+            )
+            connection.commit()
+            self._ready = True
+        return connection
+
+    @staticmethod
+    def make_key(model, data, variant=None):
+        '''Hash the model, the prompt texts and the inline image bytes of a request'''
+        digest = hashlib.sha256()
+        digest.update(str(model).encode('utf-8'))
+        digest.update(str(variant).encode('utf-8'))
+        for content in data.get('contents', []):
+            for part in content.get('parts', []):
+                if 'text' in part:
+                    digest.update(b'text\0' + part['text'].encode('utf-8'))
+                elif 'inline_data' in part:
+                    inline_data = part['inline_data']
+                    digest.update(b'data\0' + inline_data['mime_type'].encode('utf-8'))
+                    digest.update((inline_data['data'] or '').encode('utf-8'))
+        digest.update(json.dumps(data.get('generationConfig'), sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key, call_type):
+        '''Return the cached answer of a key, or None when missing or expired'''
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    'SELECT response, created_at FROM responses WHERE key = ?', (key,)
+                ).fetchone()
+                if row and now - row[1] <= self.ttls.get(call_type, 0):
+                    connection.execute(
+                        'UPDATE responses SET last_access = ? WHERE key = ?', (now, key)
+                    )
+                    connection.commit()
+                    self.stats['hits'] += 1
+                    return row[0]
+                if row:
+                    connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    connection.commit()
+                self.stats['misses'] += 1
+                return None
+            finally:
+                connection.close()
+
+    def set(self, key, call_type, response):
+        '''Store an answer and evict the least recently used ones above the size cap'''
+        if not self.ttls.get(call_type):
+            return
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            try:
+                connection.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, call_type, response, len(response.encode('utf-8')), now, now)
+                )
+                self.stats['stores'] += 1
+                self._evict(connection)
+                connection.commit()
+            finally:
+                connection.close()
+
+    def _evict(self, connection):
+        '''Delete the least recently used answers until the cache fits in max_bytes'''
+        total_size = connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        rows = connection.execute(
+            'SELECT key, size FROM responses ORDER BY last_access'
+        ).fetchall()
+        for key, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total_size -= size
+            self.stats['evictions'] += 1
+
+    def report(self):
+        '''Print the hit/miss counters of the cache'''
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups if lookups else 0.0
+        print(
+            f"Gemini cache hits: {self.stats['hits']}, misses: {self.stats['misses']}, "
+            f"hit rate: {hit_rate:.1%}, evictions: {self.stats['evictions']}"
+        )
+        return dict(self.stats)
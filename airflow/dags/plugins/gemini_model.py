@@ -1,40 +1,454 @@
+import asyncio
 import base64
 import json
+import mimetypes
 import os
+import threading
 import time
 
+import aiohttp
 import requests
 
 from datetime import datetime
 from datetime import timedelta
 
-from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from plugins.gemini_cache import cache_enabled
+from plugins.gemini_cache import ResponseCache
+from plugins.rate_limit import backoff_delay
+from plugins.rate_limit import classify_status
+from plugins.rate_limit import estimate_request_tokens
+from plugins.rate_limit import get_gemini_governor
+from plugins.rate_limit import max_concurrency
+from plugins.rate_limit import retry_after
+from plugins.settings import load_environment
+from plugins.structured_output import id_list_schema
+from plugins.structured_output import json_generation_config
+from plugins.structured_output import parse_id_list
+from plugins.structured_output import parse_pestel_state
+from plugins.structured_output import pestel_state_schema
+from plugins.structured_output import parse_recommendation
+from plugins.structured_output import recommendation_schema
+from plugins.telemetry import metrics
+from plugins.telemetry import size_buckets
+from plugins.telemetry import span
 
 
 # Load environment variables from .env file
-load_dotenv()
+load_environment()
 api_url = os.getenv('API_PATH')
+model_gemini = os.getenv('MODEL_GEMINI')
 
-class InvestmentAI:
-    '''Use Gemini API to provide advice about investing.'''
+
+def response_text(response_json):
+    '''Extract the generated text from a generateContent response'''
+    return response_json['candidates'][0]['content']['parts'][0]['text']
+
+
+def used_tokens(response_json):
+    '''Input tokens billed for a request, None when the answer does not report them'''
+    try:
+        return response_json['usageMetadata']['promptTokenCount']
+    except (KeyError, TypeError):
+        return None
+
+
+class GeminiClient:
+    '''Shared Gemini transport with pooled keep-alive sessions and an asyncio interface'''
     def __init__(
         self, 
-        image_path=None, 
-        recommendation_opinions=None, 
-        market_analysis=None
+        api_url=None, 
+        pool_size=max_concurrency, 
+        timeout=120, 
+        cache=None, 
+        model=None,
+        governor=None
     ):
-        self.recommendation_opinions = recommendation_opinions
         self.api_url = api_url
-        self.image_path = image_path
-        self.market_analysis = market_analysis
+        self.cache = cache
+        # every client of the process shares the quota and the concurrency limit
+        self.governor = governor or get_gemini_governor()
+        # the query string only carries the API key
+        self.model = model or (api_url or '').split('?')[0]
+        self.pool_size = pool_size
+        self.timeout = timeout
         self.headers = {
             'Content-Type': 'application/json'
         }
+
+        # one keep-alive pool shared by every thread of the process
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # aiohttp sessions are bound to the event loop that created them
+        self._async_session = None
+        self._async_loop = None
+        self._async_connections = {'created': 0, 'reused': 0}
+        self._lock = threading.Lock()
+
+    def _get_async_session(self):
+        '''Return the aiohttp session of the running event loop'''
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_loop is not loop:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_connection_created)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+            self._async_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers=self.headers,
+                trace_configs=[trace_config],
+            )
+            self._async_loop = loop
+        return self._async_session
+
+    async def _on_connection_created(self, session, context, params):
+        with self._lock:
+            self._async_connections['created'] += 1
+
+    async def _on_connection_reused(self, session, context, params):
+        with self._lock:
+            self._async_connections['reused'] += 1
+
+    async def aclose(self):
+        '''Close the aiohttp session of the running event loop'''
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+            self._async_loop = None
+
+    def run(self, coroutine):
+        '''Run a coroutine to completion and release the async connections afterwards'''
+        async def runner():
+            try:
+                return await coroutine
+            finally:
+                await self.aclose()
+
+        return asyncio.run(runner())
+
+    async def gather(self, coroutines, limit=None):
+        '''Await coroutines concurrently, keeping at most `limit` of them in flight'''
+        semaphore = asyncio.Semaphore(limit or max_concurrency)
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*(limited(coroutine) for coroutine in coroutines))
+
+    def connection_stats(self):
+        '''Report how many requests were served by an already open connection'''
+        sync_requests = sync_connections = 0
+        pools = self.session.get_adapter('https://').poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is not None:
+                sync_requests += pool.num_requests
+                sync_connections += pool.num_connections
+        async_connections = self._async_connections['created']
+        async_requests = async_connections + self._async_connections['reused']
+
+        total_requests = sync_requests + async_requests
+        total_connections = sync_connections + async_connections
+        reuse_rate = 0.0
+        if total_requests:
+            reuse_rate = max(total_requests - total_connections, 0) / total_requests
+        return {
+            'requests': total_requests,
+            'connections': total_connections,
+            'reuse_rate': round(reuse_rate, 3),
+        }
+
+    def report(self):
+        '''Print the connection reuse statistics'''
+        stats = self.connection_stats()
+        print(
+            f"Gemini requests: {stats['requests']}, "
+            f"connections opened: {stats['connections']}, "
+            f"connection reuse rate: {stats['reuse_rate']:.1%}"
+        )
+        if self.cache:
+            self.cache.report()
+        self.governor.report()
+        return stats
+
+    def cache_key(self, data, cache_variant=None):
+        '''Key of a request in the response cache, None when the cache is off'''
+        return self.cache.make_key(self.model, data, cache_variant) if self.cache else None
+
+    def cached_answer(self, data, parse=None, call_type=None, cache_variant=None):
+        '''Look the request up in the response cache, returns (key, parsed answer)'''
+        if not (self.cache and call_type):
+            return None, None
+        key = self.cache_key(data, cache_variant)
+        text = self.cache.get(key, call_type)
+        if text is None:
+            return key, None
+        try:
+            return key, parse(text) if parse else text
+        except Exception:
+            return key, None
+
+    def store_answer(self, key, call_type, text):
+        '''Keep a successfully parsed answer in the response cache'''
+        if key and self.cache:
+            self.cache.set(key, call_type, text)
+
+    def request_json(self, method, url, body=None, retries=3, call_type='batch'):
+        '''Send a request other than generateContent under the governor and return its JSON,
+        429/5xx answers and connection errors are retried, the last error is raised'''
+        for attempt in range(retries):
+            last_attempt = attempt == retries - 1
+            # the batch endpoints share the request quota, not the token quota
+            self.governor.acquire(0)
+            try:
+                response = self.session.request(
+                    method, url, headers=self.headers, json=body, timeout=self.timeout
+                )
+            except requests.RequestException as e:
+                self.governor.release('retryable')
+                metrics.inc('gemini_requests_total', call_type=call_type, outcome='connection')
+                if last_attempt:
+                    raise
+                print(f"{e}")
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            outcome = classify_status(response.status_code)
+            self.governor.release(outcome)
+            metrics.inc('gemini_requests_total', call_type=call_type, outcome=outcome)
+            if outcome in ('throttled', 'retryable') and not last_attempt:
+                print(f"{response.status_code}")
+                try:
+                    response_json = response.json()
+                except ValueError:
+                    response_json = None
+                time.sleep(backoff_delay(attempt, retry_after(response.headers, response_json)))
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    def _write_error(self, error_log_path, text):
+        '''Keep the last unparsable answer for later inspection'''
+        print("Error in parsing JSON response")
+        if error_log_path and text is not None:
+            with open(error_log_path, 'a') as f:
+                f.write(f"{text}\n")
+
+    def _start_call(self, call_span, data, call_type):
+        '''Serialize the request once, and count its size and estimated tokens'''
+        body = json.dumps(data)
+        tokens = estimate_request_tokens(data)
+        metrics.observe('gemini_payload_bytes', len(body), size_buckets, call_type=call_type)
+        call_span.set(payload_bytes=len(body), estimated_tokens=tokens)
+        return body, tokens
+
+    def _observe_attempt(self, call_span, call_type, attempt, outcome, elapsed, used=None):
+        '''Count a request attempt in the call span and in the metrics'''
+        metrics.inc('gemini_requests_total', call_type=call_type, outcome=outcome)
+        metrics.observe('gemini_request_seconds', elapsed, call_type=call_type)
+        if attempt:
+            metrics.inc('gemini_retries_total', call_type=call_type)
+        if used:
+            metrics.inc('gemini_prompt_tokens_total', used, call_type=call_type)
+        call_span.set(attempts=attempt + 1, outcome=outcome, prompt_tokens=used)
+
+    def generate(
+        self,
+        data,
+        parse=None,
+        retries=3,
+        default=None,
+        error_log_path=None,
+        call_type=None,
+        cache_variant=None
+    ):
+        '''Send a generateContent request and parse the answer, retrying on failure'''
+        label = call_type or 'other'
+        with span(f'gemini.{label}', kind='call', call_type=label) as call_span:
+            key, output_text = self.cached_answer(data, parse, call_type, cache_variant)
+            if output_text is not None:
+                metrics.inc('gemini_cache_hits_total', call_type=label)
+                call_span.set(cached=True)
+                return output_text
+
+            text = None
+            body, tokens = self._start_call(call_span, data, label)
+            for attempt in range(retries):
+                last_attempt = attempt == retries - 1
+                self.governor.acquire(tokens)
+                start_time = time.perf_counter()
+                try:
+                    response = self.session.post(
+                        url=self.api_url,
+                        headers=self.headers,
+                        data=body,
+                        timeout=self.timeout
+                    )
+                except requests.RequestException as e:
+                    self.governor.release('retryable')
+                    self._observe_attempt(
+                        call_span, label, attempt, 'connection', time.perf_counter() - start_time
+                    )
+                    print(f"{e}")
+                    if last_attempt:
+                        break
+                    time.sleep(backoff_delay(attempt))
+                    continue
+
+                outcome = classify_status(response.status_code)
+                try:
+                    response_json = response.json()
+                except ValueError:
+                    response_json = None
+                used = used_tokens(response_json)
+                self.governor.release(outcome, tokens, used)
+                self._observe_attempt(
+                    call_span, label, attempt, outcome, time.perf_counter() - start_time, used
+                )
+
+                if outcome != 'ok':
+                    print(f"{response.status_code}")
+                    if outcome == 'fatal' or last_attempt:
+                        break
+                    time.sleep(backoff_delay(
+                        attempt, retry_after(response.headers, response_json)
+                    ))
+                    continue
+
+                try:
+                    text = response_text(response_json)
+                except (KeyError, IndexError, TypeError):
+                    # no candidate in the answer, e.g. a blocked one
+                    metrics.inc('gemini_unparsable_total', call_type=label)
+                    continue
+                try:
+                    output_text = parse(text) if parse else text
+                except Exception:
+                    # the parser already repaired what it could, asking again would cost a full request
+                    metrics.inc('gemini_unparsable_total', call_type=label)
+                    break
+                self.store_answer(key, call_type, text)
+                return output_text
+
+            call_span.status = 'error'
+            self._write_error(error_log_path, text)
+            return default
+
+    async def agenerate(
+        self,
+        data,
+        parse=None,
+        retries=3,
+        default=None,
+        error_log_path=None,
+        call_type=None,
+        cache_variant=None
+    ):
+        '''Asyncio counterpart of generate, sharing the keep-alive pool of the event loop'''
+        label = call_type or 'other'
+        with span(f'gemini.{label}', kind='call', call_type=label) as call_span:
+            key, output_text = self.cached_answer(data, parse, call_type, cache_variant)
+            if output_text is not None:
+                metrics.inc('gemini_cache_hits_total', call_type=label)
+                call_span.set(cached=True)
+                return output_text
+
+            session = self._get_async_session()
+            text = None
+            body, tokens = self._start_call(call_span, data, label)
+            for attempt in range(retries):
+                last_attempt = attempt == retries - 1
+                await self.governor.aacquire(tokens)
+                start_time = time.perf_counter()
+                try:
+                    async with session.post(self.api_url, data=body) as response:
+                        status_code = response.status
+                        response_headers = response.headers
+                        response_body = await response.text()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.governor.release('retryable')
+                    self._observe_attempt(
+                        call_span, label, attempt, 'connection', time.perf_counter() - start_time
+                    )
+                    print(f"{e}")
+                    if last_attempt:
+                        break
+                    await asyncio.sleep(backoff_delay(attempt))
+                    continue
+
+                outcome = classify_status(status_code)
+                try:
+                    response_json = json.loads(response_body)
+                except ValueError:
+                    response_json = None
+                used = used_tokens(response_json)
+                self.governor.release(outcome, tokens, used)
+                self._observe_attempt(
+                    call_span, label, attempt, outcome, time.perf_counter() - start_time, used
+                )
+
+                if outcome != 'ok':
+                    print(f"{status_code}")
+                    if outcome == 'fatal' or last_attempt:
+                        break
+                    await asyncio.sleep(backoff_delay(
+                        attempt, retry_after(response_headers, response_json)
+                    ))
+                    continue
+
+                try:
+                    text = response_text(response_json)
+                except (KeyError, IndexError, TypeError):
+                    # no candidate in the answer, e.g. a blocked one
+                    metrics.inc('gemini_unparsable_total', call_type=label)
+                    continue
+                try:
+                    output_text = parse(text) if parse else text
+                except Exception:
+                    # the parser already repaired what it could, asking again would cost a full request
+                    metrics.inc('gemini_unparsable_total', call_type=label)
+                    break
+                self.store_answer(key, call_type, text)
+                return output_text
+
+            call_span.status = 'error'
+            self._write_error(error_log_path, text)
+            return default
+
+
+# client shared by all the AI classes of the process
+gemini_client = GeminiClient(
+    api_url,
+    cache=ResponseCache() if cache_enabled else None,
+    model=model_gemini
+)
+
+
+class InvestmentAI:
+    '''Use Gemini API to provide advice about investing.'''
+    def __init__(
+        self,
+        image_path=None,
+        recommendation_opinions=None,
+        market_analysis=None,
+        client=None
+    ):
+        self.recommendation_opinions = recommendation_opinions
+        self.client = client or gemini_client
+        self.image_path = image_path
+        self.market_analysis = market_analysis
         self.image_encoded_string = None
+        self.image_mime_type = None
         if self.image_path:
             self.image_encoded_string = self.image_to_base64()
-        
-        
+            self.image_mime_type = mimetypes.guess_type(self.image_path)[0] or 'image/png'
+
+
     def image_to_base64(self):
         '''Convert image to base64 string'''
         if not self.image_path:
@@ -44,321 +458,249 @@ class InvestmentAI:
         return image_encoded_string
 
 
-    def generate_opinion_investment_advice(self):
-        '''Get investment advice from Gemini API'''
-        data = {
+    def opinion_payload(self):
+        '''Build the request asking for one expert opinion'''
+        return {
                 "contents": [{
                 "parts":[
                     {"text": f"""
-                    Assume the role of a short-term BTC trading expert (combining technical analysis and macro analysis). Analyze the daily chart of BTC, paying attention to price, trading volume, and average trading volume. Identify potential resistance zones and support zones, and then provide short-term buy and sell recommendations, including: Buy Zone (near the potential support zone, lowest risk), Take Profit Zone (near the potential resistance zone), and Stop Loss Zone (narrow and close to the buy zone because you are not a fan of high risk). 
+                    Assume the role of a short-term BTC trading expert (combining technical analysis and macro analysis). Analyze the daily chart of BTC, paying attention to price, trading volume, and average trading volume. Identify potential resistance zones and support zones, and then provide short-term buy and sell recommendations, including: Buy Zone (near the potential support zone, lowest risk), Take Profit Zone (near the potential resistance zone), and Stop Loss Zone (narrow and close to the buy zone because you are not a fan of high risk).
                     Crutinize the market analysis in the PESTEL framework of the expert:
                     {self.market_analysis}
-                    
+
                     Provide the analysis in JSON format with the following structure:
                     {{
                         "buy_zone": {{"min":"min buy price", "max":"max buy price"}},
                         "sell_zone": {{"min":"min sell price", "max":"max sell price"}},
                         "stop_loss": {{"min":"min stop loss price", "max":"max stop loss price"}},
                     }}
-                    
+
                     Do not provide any information other than the JSON output.
                     """},
                     {
                         "inline_data": {
-                        "mime_type":"image/jpeg",
+                        "mime_type":self.image_mime_type,
                         "data": self.image_encoded_string
                         }
                     }
                 ]
-                }]
+                }],
+                "generationConfig": json_generation_config(recommendation_schema)
             }
-        
-        # Retry 3 times
-        retries = 3
-        retry = 0
-        
-        while retry < retries:
-            response = requests.post(url=self.api_url, headers=self.headers, json=data)
-            
-            if response.status_code != 200:
-                retry += 1
-                time.sleep(0.5)
-                continue
-            
-            try:    
-                output_text = json.loads(
-                    response.json()['candidates'][0]['content']['parts'][0]['text']
-                    .replace('json','')
-                    .replace('`','')
-                )
-                output_text['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-                
-            except:
-                retry += 1
-                time.sleep(0.5)
-                continue
-            
-            if retry == retries:
-                with open(
-                    r'/opt/airflow/dags/buffer_memory/error_generate_opinion.txt', 'a'
-                ) as f:
-                    
-                    f.write(
-                        f"{
-                            response.json()
-                            ['candidates'][0]
-                            ['content']
-                            ['parts'][0]
-                            ['text']
-                        }\n"
-                    )
-                    
-                print("Error in parsing JSON response")
-                
-                output_text = {}
-            break
-                
-        return output_text
-    
-    def generate_final_investment_advice(self):
-        '''Get investment advice from Gemini API'''
-        data = {
+
+    def final_payload(self):
+        '''Build the request merging the expert opinions'''
+        return {
                 "contents": [{
                 "parts":[
                     {"text": f"""
-                    Assume the role of a short-term BTC trading expert (combining technical analysis and macro analysis). Analyze the daily chart of BTC, paying attention to price, trading volume, and average trading volume. Identify potential resistance zones and support zones, and then provide short-term buy and sell recommendations, including: Buy Zone (near the potential support zone, lowest risk), Take Profit Zone (near the potential resistance zone), and Stop Loss Zone (narrow and close to the buy zone because you are not a fan of high risk). 
+                    Assume the role of a short-term BTC trading expert (combining technical analysis and macro analysis). Analyze the daily chart of BTC, paying attention to price, trading volume, and average trading volume. Identify potential resistance zones and support zones, and then provide short-term buy and sell recommendations, including: Buy Zone (near the potential support zone, lowest risk), Take Profit Zone (near the potential resistance zone), and Stop Loss Zone (narrow and close to the buy zone because you are not a fan of high risk).
                     Crutinize the market analysis in the PESTEL framework of the expert:
                     {self.market_analysis}
-                    
+
                     Also consider the opinions of other experts:
                     {self.recommendation_opinions}
-                    
+
                     Provide the analysis in JSON format with the following structure:
                     {{
                         "buy_zone": {{"min":"min buy price", "max":"max buy price"}},
                         "sell_zone": {{"min":"min sell price", "max":"max sell price"}},
                         "stop_loss": {{"min":"min stop loss price", "max":"max stop loss price"}},
                     }}
-                    
+
                     Do not provide any information other than the JSON output.
                     """},
                     {
                         "inline_data": {
-                        "mime_type":"image/jpeg",
+                        "mime_type":self.image_mime_type,
                         "data": self.image_encoded_string
                         }
                     }
                 ]
-                }]
+                }],
+                "generationConfig": json_generation_config(recommendation_schema)
             }
 
-        # Retry 3 times
-        retries = 3
-        retry = 0
-        
-        while retry < retries:
-            response = requests.post(url=self.api_url, headers=self.headers, json=data)
-            
-            if response.status_code != 200:
-                retry += 1
-                time.sleep(0.5)
-                continue
-            
-            try:    
-                output_text = json.loads(
-                    response.json()['candidates'][0]['content']['parts'][0]['text']
-                    .replace('json','')
-                    .replace('`','')
-                )
-                output_text['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-                
-            except:
-                retry += 1
-                time.sleep(0.5)
-                continue
-            
-            if retry == retries:
-                with open(
-                    r'/opt/airflow/dags/buffer_memory/error_generate_final.txt', 'a'
-                ) as f:
-                    
-                    f.write(
-                        f"{
-                            response.json()
-                            ['candidates'][0]
-                            ['content']
-                            ['parts'][0]
-                            ['text']
-                        }\n"
-                    )
-                    
-                print("Error in parsing JSON response")
-                
-                output_text = {}
-                
-            break
-        
-        return output_text
-    
-    
+    def generate_opinion_investment_advice(self, sample=0):
+        '''Get investment advice from Gemini API, `sample` tells the opinions apart in the cache'''
+        return self.client.generate(
+            self.opinion_payload(),
+            parse=parse_recommendation,
+            default={},
+            error_log_path=r'/opt/airflow/dags/buffer_memory/error_generate_opinion.txt',
+            call_type='opinion',
+            cache_variant=sample
+        )
+
+    async def agenerate_opinion_investment_advice(self, sample=0):
+        '''Get investment advice from Gemini API without blocking the event loop'''
+        return await self.client.agenerate(
+            self.opinion_payload(),
+            parse=parse_recommendation,
+            default={},
+            error_log_path=r'/opt/airflow/dags/buffer_memory/error_generate_opinion.txt',
+            call_type='opinion',
+            cache_variant=sample
+        )
+
+    def generate_final_investment_advice(self):
+        '''Get investment advice from Gemini API'''
+        return self.client.generate(
+            self.final_payload(),
+            parse=parse_recommendation,
+            default={},
+            error_log_path=r'/opt/airflow/dags/buffer_memory/error_generate_final.txt',
+            call_type='final'
+        )
+
+    async def agenerate_final_investment_advice(self):
+        '''Get the final investment advice from Gemini API without blocking the event loop'''
+        return await self.client.agenerate(
+            self.final_payload(),
+            parse=parse_recommendation,
+            default={},
+            error_log_path=r'/opt/airflow/dags/buffer_memory/error_generate_final.txt',
+            call_type='final'
+        )
+
+
 class SummarizeArticle:
-    '''Summarize the article from snapshots'''
-    def __init__(self, article_snapshot_paths=None):
+    '''Summarize the article from its extracted text, or from snapshots'''
+    def __init__(self, article_snapshot_paths=None, article_text=None, client=None):
         self.article_snapshot_paths = article_snapshot_paths
-        self.api_url = api_url
-        self.headers = {
-            'Content-Type': 'application/json'
-        }
+        self.article_text = article_text
+        self.client = client or gemini_client
         self.image_encoded_string = None
-        if self.article_snapshot_paths:
+        if self.article_snapshot_paths and not self.article_text:
             self.image_encoded_string = self.convert_images_to_base64()
-        
+
     def convert_images_to_base64(self):
         '''Convert images to base64 string in attached format'''
         attach_images = []
         for image_path in self.article_snapshot_paths:
+            mime_type = mimetypes.guess_type(image_path)[0] or 'image/png'
             with open(image_path, "rb") as image_file:
                 image_encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
                 attach_images.append({
                     "inline_data":{
-                    "mime_type": "image/jpeg",
+                    "mime_type": mime_type,
                     "data": image_encoded_string
                     }
                 })
 
         return attach_images
-    
-    def generate_summarize_article(self):
-        '''Get summary of the article from Gemini API'''
-        data = {
+
+    def summarize_payload(self):
+        '''Build the request summarizing the article'''
+        return {
                 "contents": [{
                 "parts":[
                     {"text": f"""
                     Summarize this article, focus on statistic figures or anything affects analysing macroeconomics. No more than 1000 words. Carefully read the article and provide a summary of the content, because maybe there are other articles and you need exclude them.
                     Provide the summary in this format with the following structure:
-                    
+
                     Title: the article title
                     Content: your summarized content
-                    
+
                     Kindly provide me no more than the Title and the Content.
                     """},
-                    self.image_encoded_string
+                    *self.article_parts()
                 ]
                 }]
             }
 
-        response = requests.post(url=self.api_url, headers=self.headers, json=data)
-
-        if response.status_code == 200:
-            print("Request Api for extracting data was successful")
-            output_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-        else:
-            output_text = {}
-        
-        return output_text
-    
-    
+    def article_parts(self):
+        '''Attach the article text when it was extracted, one part per snapshot otherwise'''
+        if self.article_text:
+            return [{"text": f"Here is the article:\n{self.article_text}"}]
+        return self.image_encoded_string or []
+
+    def generate_summarize_article(self):
+        '''Get summary of the article from Gemini API'''
+        return self.client.generate(
+            self.summarize_payload(), retries=2, default={}, call_type='summary'
+        )
+
+    async def agenerate_summarize_article(self):
+        '''Get summary of the article from Gemini API without blocking the event loop'''
+        return await self.client.agenerate(
+            self.summarize_payload(), retries=2, default={}, call_type='summary'
+        )
+
+
 class FilterArticle:
-    def __init__(self, articles_list=None):
+    def __init__(self, articles_list=None, client=None):
         self.articles_list = articles_list
-        self.api_url = api_url
-        self.headers = {
-            'Content-Type': 'application/json'
-        }
+        self.client = client or gemini_client
         self.min_date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-        
-    def AI_filter_article(self):
-        '''Get the list of the article from Gemini API'''
-        data = {
+
+    @staticmethod
+    def article_line(short_id, article):
+        '''Compact id|date|title line standing for an article in the prompt'''
+        title = ' '.join((article.get('title') or '').split())
+        return f"{short_id}|{article.get('pub_date') or ''}|{title}"
+
+    def article_lines(self):
+        '''Number the articles from 1 and write one compact line per article'''
+        return "\n".join(
+            self.article_line(short_id, article)
+            for short_id, article in enumerate(self.articles_list or [], start=1)
+        )
+
+    def filter_payload(self):
+        '''Build the request filtering the article titles'''
+        return {
                 "contents": [{
                 "parts":[
                     {"text": f"""
                     Let's read the article titles carefully and give me the articles that maybe affect to the macroeconomics, especially the PESTEL framework, and cryptocurrency. And Its publish date is from {self.min_date} to now.
-                    Here are the article titles:
-                    {self.articles_list}
-                    Provide the filtered articles in this JSON format with the following structure:
-                    [link1, link2, link3...]
+                    Here are the articles, one per line as id|publish date|title:
+                    {self.article_lines()}
+                    Provide the ids of the filtered articles in this JSON format with the following structure:
+                    [id1, id2, id3...]
                     Do not provide any information other than the JSON output.
                     """}
                 ]
-                }]
+                }],
+                "generationConfig": json_generation_config(id_list_schema)
             }
 
-        # response = requests.post(url=self.api_url, headers=self.headers, json=data)
-
-        # if response.status_code == 200:
-        #     print("Request Api for extracting data was successful")
-        #     output_text = json.loads(
-        #         response.json()['candidates'][0]['content']['parts'][0]['text']
-        #         .replace('json','')
-        #         .replace('`','')
-        #     )
-        # else:
-        #     print(f"{response.status_code }")
-        #     output_text = []
-        
-        # Retry 3 times
-        retries = 3
-        retry = 0
-        
-        while retry < retries:
-            response = requests.post(url=self.api_url, headers=self.headers, json=data)
-            
-            if response.status_code != 200:
-                retry += 1
-                time.sleep(0.5)
-                continue
-            
-            try:    
-                output_text = json.loads(
-                    response.json()['candidates'][0]['content']['parts'][0]['text']
-                    .replace('json','')
-                    .replace('`','')
-                )
-                output_text['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
-                
-            except:
-                retry += 1
-                time.sleep(0.5)
+    def AI_filter_article(self):
+        '''Get the links of the filtered articles from Gemini API'''
+        short_ids = self.client.generate(
+            self.filter_payload(),
+            parse=parse_id_list,
+            default=[],
+            error_log_path=r'/opt/airflow/dags/buffer_memory/error_AI_filter.txt',
+            call_type='filter'
+        )
+        links = []
+        for short_id in short_ids:
+            try:
+                position = int(short_id) - 1
+            except (ValueError, TypeError):
                 continue
-            
-            if retry == retries:
-                with open(
-                    r'/opt/airflow/dags/buffer_memory/error_AI_filter.txt', 'a'
-                ) as f:
-                    
-                    f.write(
-                        f"{
-                            response.json()
-                            ['candidates'][0]
-                            ['content']
-                            ['parts'][0]
-                            ['text']
-                        }\n"
-                    )
-                    
-                print("Error in parsing JSON response")
-                
-                output_text = []
-                
-            break
-        
-        return output_text
-    
-    
+            # ignore the ids that were never sent
+            if 0 <= position < len(self.articles_list):
+                link = self.articles_list[position]['link']
+                if link not in links:
+                    links.append(link)
+        return links
+
+
 class AnalyzeAI:
-    def __init__(self, summarized_articles_list=None):
-        self.summarized_articles_list = summarized_articles_list
-        self.api_url = api_url
-        self.headers = {
-            'Content-Type': 'application/json'
-        }
+    def __init__(self, summarized_articles_list=None, client=None, market_state=None):
+        # one summary per article
+        self.summarized_articles_list = summarized_articles_list or []
+        self.client = client or gemini_client
+        # the PESTEL state of the previous runs, updated with the new summaries
+        self.market_state = market_state
         self.min_date = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
-        
-    def AI_analysis_market(self):
-        '''Get commentary about the market from Gemini API'''
+
+    def analysis_payload(self):
+        '''Build the request analysing the market'''
         summarized_articles="\n\n".join(self.summarized_articles_list)
-        data = {
+        return {
                 "contents": [{
                 "parts":[
                     {"text": f"""
@@ -370,14 +712,67 @@ class AnalyzeAI:
                 }]
             }
 
-        response = requests.post(url=self.api_url, headers=self.headers, json=data)
-
-        if response.status_code == 200:
-            print("Request Api for extracting data was successful")
-            output_text = response.json()['candidates'][0]['content']['parts'][0]['text']
-        else:
-            print(f"{response.status_code}")
-            output_text = ''
-        
-        return output_text
-    
\ No newline at end of file
+    def reduce_payload(self):
+        '''Build the request merging partial analyses, each made from a share of the articles'''
+        partial_analyses="\n\n".join(
+            f"Partial analysis {number}:\n{analysis}"
+            for number, analysis in enumerate(self.summarized_articles_list, start=1)
+        )
+        return {
+                "contents": [{
+                "parts":[
+                    {"text": f"""
+                    Act as a cryptocurrency expert. Each partial analysis below applies the PESTEL framework to a different share of today's news articles. Merge them into one PESTEL analysis of the macroeconomics and cryptocurrency: keep every distinct point, merge the repeated ones and resolve the contradictions. How do they affect the cryptocurrency market? and setiment of the market. Focus on BTC. And provide no abundance of information, just focus on the main points.
+                    Here are the partial analyses:
+                    {partial_analyses}
+                    """}
+                ]
+                }]
+            }
+
+    def update_state_payload(self):
+        '''Build the request updating the PESTEL state with the summaries of the new articles'''
+        summarized_articles="\n\n".join(self.summarized_articles_list)
+        return {
+                "contents": [{
+                "parts":[
+                    {"text": f"""
+                    Act as a cryptocurrency expert keeping a PESTEL analysis of the macroeconomics and cryptocurrency up to date, focused on BTC. Here is the analysis so far, in JSON, every point listing the ids of the articles supporting it:
+                    {json.dumps(self.market_state or {}, ensure_ascii=False)}
+
+                    Here are the summarized new articles, each one starting with its [id]:
+                    {summarized_articles}
+
+                    Update the analysis with the new articles: add their new points, revise the points they confirm or contradict, and remove the points they make obsolete. Keep the points short, and keep the ids of every article supporting a point, old and new. Give the updated sentiment of the market for BTC. And provide no abundance of information, just focus on the main points.
+                    Provide the updated analysis in JSON format with the following structure:
+                    {{
+                        "dimensions": {{"political": [{{"point": "...", "impact": "bullish|bearish|neutral", "article_ids": ["id"]}}], "economic": [], "social": [], "technological": [], "environmental": [], "legal": []}},
+                        "sentiment": "..."
+                    }}
+                    Do not provide any information other than the JSON output.
+                    """}
+                ]
+                }],
+                "generationConfig": json_generation_config(pestel_state_schema)
+            }
+
+    def AI_analysis_market(self):
+        '''Get commentary about the market from Gemini API'''
+        return self.client.generate(
+            self.analysis_payload(), retries=2, default='', call_type='analysis'
+        )
+
+    def AI_reduce_analysis(self):
+        '''Merge partial analyses into one with Gemini API'''
+        return self.client.generate(
+            self.reduce_payload(), retries=2, default='', call_type='analysis'
+        )
+
+    def AI_update_state(self):
+        '''Get the updated PESTEL state from Gemini API, None when the answer cannot be read'''
+        return self.client.generate(
+            self.update_state_payload(),
+            parse=parse_pestel_state,
+            error_log_path=r'/opt/airflow/dags/buffer_memory/error_update_state.txt',
+            call_type='analysis'
+        )
@@ -0,0 +1,257 @@
+import io
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from PIL import ImageStat
+
+
+# output format of the tiles sent to Gemini: JPEG or WEBP
+image_format = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+image_quality = int(os.getenv('IMAGE_QUALITY', 70))
+image_max_width = int(os.getenv('IMAGE_MAX_WIDTH', 1024))
+
+# cropped strips are stacked back into tiles of at most this height
+tile_max_height = int(os.getenv('TILE_MAX_HEIGHT', 1600))
+
+# strips whose 256-bit perceptual hashes differ by at most this many bits are duplicates
+tile_hash_distance = int(os.getenv('TILE_HASH_DISTANCE', 10))
+
+# strips with a smaller grayscale standard deviation are treated as blank
+blank_stddev = float(os.getenv('TILE_BLANK_STDDEV', 3))
+
+# scrolling step used by snapshot_article when no offsets were recorded
+default_scrolling_height = 460
+
+image_extensions = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+def dhash(image, hash_size=16):
+    '''Compute the difference hash of an image as an integer'''
+    pixels = list(
+        image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS).getdata()
+    )
+    value = 0
+    for row in range(hash_size):
+        for column in range(hash_size):
+            left = pixels[row * (hash_size + 1) + column]
+            right = pixels[row * (hash_size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(hash_a, hash_b):
+    '''Count the bits that differ between two hashes'''
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def is_blank(image):
+    '''Tell whether an image is (almost) a single flat color'''
+    return ImageStat.Stat(image.convert('L')).stddev[0] < blank_stddev
+
+
+def crop_overlap(image, offset, previous_offset, viewport_height):
+    '''Keep only the part of a viewport screenshot not shown by the previous one'''
+    if previous_offset is None:
+        return image
+    # screenshots are taken in device pixels, offsets are in CSS pixels
+    scale = image.height / viewport_height if viewport_height else 1
+    overlap = (previous_offset + viewport_height - offset) * scale
+    overlap = int(min(max(overlap, 0), image.height))
+    return image.crop((0, overlap, image.width, image.height))
+
+
+def stack_strips(strips, max_height=tile_max_height):
+    '''Paste consecutive strips under each other into tiles of at most max_height'''
+    tiles = []
+    group = []
+    group_height = 0
+    for strip in strips:
+        if group and group_height + strip.height > max_height:
+            tiles.append(group)
+            group, group_height = [], 0
+        group.append(strip)
+        group_height += strip.height
+    if group:
+        tiles.append(group)
+
+    stacked = []
+    for group in tiles:
+        tile = Image.new('RGB', (max(strip.width for strip in group), sum(
+            strip.height for strip in group
+        )), 'white')
+        top = 0
+        for strip in group:
+            tile.paste(strip, (0, top))
+            top += strip.height
+        stacked.append(tile)
+    return stacked
+
+
+def clean_strips(strips, max_width=image_max_width):
+    '''Drop the blank and repeated strips and downsize the others'''
+    kept = []
+    kept_hashes = []
+    for strip in strips:
+        if strip.height == 0 or is_blank(strip):
+            continue
+
+        # drop repeated banners, ads and sticky elements
+        strip_hash = dhash(strip)
+        if any(
+            hamming_distance(strip_hash, kept_hash) <= tile_hash_distance
+            for kept_hash in kept_hashes
+        ):
+            continue
+        kept_hashes.append(strip_hash)
+
+        if strip.width > max_width:
+            strip = strip.resize(
+                (max_width, round(strip.height * max_width / strip.width)), Image.LANCZOS
+            )
+        kept.append(strip)
+    return kept
+
+
+def save_tiles(strips, output_prefix, image_format=image_format, quality=image_quality):
+    '''Stack the strips into tiles and encode them in parallel, returns the tile paths'''
+    extension = image_extensions.get(image_format, '.jpg')
+    tiles = stack_strips(strips)
+    tiles_path = [
+        f'{output_prefix}_tile_{number}{extension}' for number in range(1, len(tiles) + 1)
+    ]
+    if not tiles:
+        return tiles_path
+    # Pillow releases the GIL while it encodes
+    with ThreadPoolExecutor(max_workers=min(len(tiles), os.cpu_count() or 1)) as executor:
+        list(executor.map(
+            lambda tile, tile_path: tile.save(
+                tile_path, format=image_format, quality=quality, optimize=True
+            ),
+            tiles,
+            tiles_path
+        ))
+    return tiles_path
+
+
+def preprocess_article(
+    screenshots_path,
+    scroll_offsets=None,
+    viewport_height=None,
+    image_format=image_format,
+    quality=image_quality,
+    max_width=image_max_width
+):
+    '''Crop, deduplicate, downsize and re-encode the screenshots of one article'''
+    bytes_before = sum(os.path.getsize(path) for path in screenshots_path)
+    if not scroll_offsets:
+        scroll_offsets = [
+            i * default_scrolling_height for i in range(len(screenshots_path))
+        ]
+
+    strips = []
+    previous_offset = None
+    for path, offset in zip(screenshots_path, scroll_offsets):
+        with Image.open(path) as screenshot:
+            image = screenshot.convert('RGB')
+        strips.append(crop_overlap(
+            image, offset, previous_offset, viewport_height or image.height
+        ))
+        previous_offset = offset
+
+    # the output file names reuse the prefix of the screenshots
+    output_prefix = screenshots_path[0].rsplit('_', 1)[0] if screenshots_path else ''
+    tiles_path = save_tiles(
+        clean_strips(strips, max_width), output_prefix, image_format, quality
+    )
+
+    return {
+        'tiles_path': tiles_path,
+        'screenshots': len(screenshots_path),
+        'tiles': len(tiles_path),
+        'bytes_before': bytes_before,
+        'bytes_after': sum(os.path.getsize(path) for path in tiles_path),
+    }
+
+
+def tile_full_page(
+    image_data,
+    output_prefix,
+    strip_height=default_scrolling_height,
+    image_format=image_format,
+    quality=image_quality,
+    max_width=image_max_width
+):
+    '''Slice a full-page screenshot into tiles in memory, the screenshot itself is never written'''
+    with Image.open(io.BytesIO(image_data)) as screenshot:
+        image = screenshot.convert('RGB')
+    # strips as high as the scrolling steps, so banners are deduplicated the same way
+    strips = [
+        image.crop((0, top, image.width, min(top + strip_height, image.height)))
+        for top in range(0, image.height, strip_height)
+    ]
+    tiles_path = save_tiles(clean_strips(strips, max_width), output_prefix, image_format, quality)
+
+    return {
+        'tiles_path': tiles_path,
+        'screenshots': 1,
+        'tiles': len(tiles_path),
+        'bytes_before': len(image_data),
+        'bytes_after': sum(os.path.getsize(path) for path in tiles_path),
+    }
+
+
+def _preprocess_snapshot(snapshot):
+    '''Preprocess the screenshots of one snapshot record, in a worker process'''
+    return preprocess_article(
+        snapshot['screenshots_path'],
+        scroll_offsets=snapshot.get('scroll_offsets'),
+        viewport_height=snapshot.get('viewport_height'),
+    )
+
+
+def preprocess_snapshots(snapshot_list, max_workers=None):
+    '''Replace the screenshots of every snapshot by compact tiles, returns the byte counts'''
+    # a snapshot tiled by the snapshot task or by an earlier try of the task is not tiled again
+    indexes = [
+        index for index, snapshot in enumerate(snapshot_list)
+        if snapshot.get('screenshots_path')
+        and not snapshot.get('tiled') and not snapshot.get('original_screenshots_path')
+    ]
+    if indexes:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                _preprocess_snapshot, [snapshot_list[index] for index in indexes]
+            )
+            for index, result in zip(indexes, results):
+                snapshot = snapshot_list[index]
+                snapshot['original_screenshots_path'] = snapshot['screenshots_path']
+                snapshot['screenshots_path'] = result['tiles_path']
+                snapshot['tiled'] = True
+                snapshot['bytes_before'] = result['bytes_before']
+                snapshot['bytes_after'] = result['bytes_after']
+
+    return preprocess_stats(snapshot_list)
+
+
+def preprocess_stats(snapshot_list):
+    '''Count the screenshots, tiles and bytes of the tiled snapshots from their records'''
+    # counted from the records, so every try of a batch reports the same numbers
+    tiled = [snapshot for snapshot in snapshot_list if 'bytes_before' in snapshot]
+    stats = {
+        'articles': len(tiled),
+        # a full-page capture is one screenshot tiled by the snapshot task
+        'screenshots': sum(len(snapshot.get('original_screenshots_path', [])) or 1 for snapshot in tiled),
+        'tiles': sum(len(snapshot['screenshots_path']) for snapshot in tiled),
+        'bytes_before': sum(snapshot['bytes_before'] for snapshot in tiled),
+        'bytes_after': sum(snapshot['bytes_after'] for snapshot in tiled),
+    }
+    stats['ratio'] = round(stats['bytes_before'] / max(stats['bytes_after'], 1), 2)
+    print(
+        f"Preprocessed {stats['screenshots']} screenshots into {stats['tiles']} tiles, "
+        f"{stats['bytes_before']} bytes -> {stats['bytes_after']} bytes "
+        f"({stats['ratio']}x smaller)"
+    )
+    return stats
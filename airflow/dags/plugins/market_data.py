@@ -0,0 +1,247 @@
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from datetime import datetime
+from datetime import timezone
+
+# a bare Figure renders headlessly and keeps no global pyplot state between threads
+from matplotlib.figure import Figure
+
+from plugins.sqlite_db import connect
+
+
+# exchange REST endpoint returning Binance-style klines, can point to a local stub
+klines_api_url = os.getenv('KLINES_API_URL', 'https://api.binance.com/api/v3/klines')
+klines_store_path = os.getenv(
+    'KLINES_STORE_PATH', '/opt/airflow/dags/market_data/klines.sqlite'
+)
+chart_symbol = os.getenv('CHART_SYMBOL', 'BTCUSDT')
+
+# candles shown on the chart given to InvestmentAI, per interval
+chart_intervals = {'1d': 120, '4h': 90}
+volume_ma_period = 20
+
+# width of the chart in inches, rendered at 100 dpi
+figure_width = 19.2
+
+interval_milliseconds = {
+    '1m': 60_000,
+    '5m': 300_000,
+    '15m': 900_000,
+    '1h': 3_600_000,
+    '4h': 14_400_000,
+    '1d': 86_400_000,
+}
+
+
+def fetch_klines(symbol, interval, start_time=None, limit=1000, timeout=10):
+    '''Fetch candles from the klines endpoint, oldest first'''
+    params = {'symbol': symbol, 'interval': interval, 'limit': limit}
+    if start_time is not None:
+        params['startTime'] = start_time
+    response = requests.get(klines_api_url, params=params, timeout=timeout)
+    response.raise_for_status()
+    return [
+        {
+            'open_time': int(row[0]),
+            'open': float(row[1]),
+            'high': float(row[2]),
+            'low': float(row[3]),
+            'close': float(row[4]),
+            'volume': float(row[5]),
+            'close_time': int(row[6]),
+        }
+        for row in response.json()
+    ]
+
+
+class KlinesStore:
+    '''Incremental local store of candles per symbol and interval'''
+    def __init__(self, path=klines_store_path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with connect(self.path) as connection:
+            connection.execute(
+                '''
+                CREATE TABLE IF NOT EXISTS klines (
+                    symbol TEXT,
+                    interval TEXT,
+                    open_time INTEGER,
+                    open REAL,
+                    high REAL,
+                    low REAL,
+                    close REAL,
+                    volume REAL,
+                    close_time INTEGER,
+                    PRIMARY KEY (symbol, interval, open_time)
+                )
+                '''
+            )
+
+    def last_open_time(self, symbol, interval):
+        '''Open time of the newest stored candle, None when nothing is stored'''
+        with connect(self.path) as connection:
+            return connection.execute(
+                'SELECT MAX(open_time) FROM klines WHERE symbol = ? AND interval = ?',
+                (symbol, interval)
+            ).fetchone()[0]
+
+    def upsert(self, symbol, interval, candles):
+        '''Insert new candles and overwrite the ones still open at the previous update'''
+        with self._lock, connect(self.path) as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO klines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (
+                        symbol, interval, candle['open_time'], candle['open'],
+                        candle['high'], candle['low'], candle['close'],
+                        candle['volume'], candle['close_time']
+                    )
+                    for candle in candles
+                ]
+            )
+
+    def load(self, symbol, interval, limit):
+        '''Return the newest candles, oldest first'''
+        with connect(self.path, row_factory=sqlite3.Row) as connection:
+            rows = connection.execute(
+                '''
+                SELECT * FROM klines WHERE symbol = ? AND interval = ?
+                ORDER BY open_time DESC LIMIT ?
+                ''',
+                (symbol, interval, limit)
+            ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def update(self, symbol, interval, lookback):
+        '''Download only the candles newer than the stored ones, returns how many'''
+        last_open_time = self.last_open_time(symbol, interval)
+        if last_open_time is None:
+            # first run: fetch enough history for the chart and its volume average
+            start_time = int(time.time() * 1000) - (
+                lookback + volume_ma_period
+            ) * interval_milliseconds[interval]
+        else:
+            # the newest stored candle was still open, fetch it again
+            start_time = last_open_time
+
+        fetched = 0
+        while True:
+            candles = fetch_klines(symbol, interval, start_time=start_time)
+            if not candles:
+                break
+            self.upsert(symbol, interval, candles)
+            fetched += len(candles)
+            if len(candles) < 1000:
+                break
+            start_time = candles[-1]['open_time'] + 1
+        return fetched
+
+
+def moving_average(values, period):
+    '''Simple moving average, None until enough values are available'''
+    averages = []
+    total = 0.0
+    for index, value in enumerate(values):
+        total += value
+        if index >= period:
+            total -= values[index - period]
+        averages.append(total / period if index >= period - 1 else None)
+    return averages
+
+
+def plot_candles(price_axis, volume_axis, candles, interval, shown):
+    '''Draw the price candles, the volume bars and the volume moving average'''
+    volumes = [candle['volume'] for candle in candles]
+    volume_ma = moving_average(volumes, volume_ma_period)[-shown:]
+    candles = candles[-shown:]
+    volumes = volumes[-shown:]
+    positions = range(len(candles))
+    colors = [
+        '#26a69a' if candle['close'] >= candle['open'] else '#ef5350'
+        for candle in candles
+    ]
+
+    # line collections draw much faster than one rectangle patch per candle
+    body_width = 0.7 * figure_width * 72 / len(chart_intervals) * 0.85 / max(len(candles), 1)
+    price_axis.vlines(
+        positions,
+        [candle['low'] for candle in candles],
+        [candle['high'] for candle in candles],
+        colors=colors,
+        linewidth=0.8
+    )
+    price_axis.vlines(
+        positions,
+        [min(candle['open'], candle['close']) for candle in candles],
+        [max(candle['open'], candle['close']) for candle in candles],
+        colors=colors,
+        linewidth=body_width
+    )
+    price_axis.set_title(
+        f"{chart_symbol} {interval} - last close {candles[-1]['close']:,.2f}"
+    )
+    price_axis.yaxis.tick_right()
+    price_axis.grid(alpha=0.2)
+
+    volume_axis.vlines(positions, 0, volumes, colors=colors, linewidth=body_width)
+    volume_axis.plot(
+        positions,
+        [value if value is not None else float('nan') for value in volume_ma],
+        color='#f0b90b',
+        linewidth=1.2,
+        label=f'Volume MA({volume_ma_period})'
+    )
+    volume_axis.legend(loc='upper left')
+    volume_axis.yaxis.tick_right()
+    volume_axis.grid(alpha=0.2)
+
+    ticks = list(positions)[::max(len(candles) // 8, 1)]
+    volume_axis.set_xticks(ticks)
+    volume_axis.set_xticklabels([
+        datetime.fromtimestamp(candles[tick]['open_time'] / 1000, tz=timezone.utc)
+        .strftime('%m-%d %H:%M' if interval != '1d' else '%Y-%m-%d')
+        for tick in ticks
+    ])
+
+
+def render_btc_chart(folder_path, prefix_filename='', store=None):
+    '''Update the local candles and render the price, volume and volume MA chart'''
+    store = store or KlinesStore()
+    start_time = time.perf_counter()
+
+    for interval, shown in chart_intervals.items():
+        try:
+            store.update(chart_symbol, interval, shown)
+        except requests.RequestException as e:
+            # the chart is still drawn from the candles stored by the previous runs
+            print(f"Error updating {interval} klines: {e}")
+
+    figure = Figure(figsize=(figure_width, figure_width * 9 / 16))
+    axes = figure.subplots(
+        2, len(chart_intervals),
+        gridspec_kw={'height_ratios': [3, 1]},
+        sharex='col',
+        squeeze=False
+    )
+    for column, (interval, shown) in enumerate(chart_intervals.items()):
+        candles = store.load(chart_symbol, interval, shown + volume_ma_period)
+        if not candles:
+            print(f"No {interval} klines available for the chart.")
+            return None
+        plot_candles(axes[0][column], axes[1][column], candles, interval, shown)
+
+    figure.subplots_adjust(left=0.02, right=0.95, top=0.95, bottom=0.05, hspace=0.08, wspace=0.1)
+    chart_path = os.path.join(folder_path, f'{prefix_filename}btc_chart.png')
+    # a light PNG compression saves most of the encoding time
+    figure.savefig(chart_path, dpi=100, pil_kwargs={'compress_level': 1})
+
+    print(
+        f"Chart rendered to {chart_path} in {time.perf_counter() - start_time:.3f}s"
+    )
+    return chart_path
@@ -0,0 +1,93 @@
+import json
+import os
+import time
+
+from plugins.settings import load_environment
+from plugins.structured_output import pestel_dimensions
+
+
+# Load environment variables from .env file
+load_environment()
+
+# full analyzes every summary of the run, incremental updates the PESTEL state of the previous run
+analysis_mode = os.getenv('ANALYSIS_MODE', 'full')
+# a state older than this is not updated but rebuilt from the summaries of the run
+pestel_state_max_age_days = float(os.getenv('PESTEL_STATE_MAX_AGE_DAYS', 3))
+# a point no article supported for this long is dropped
+pestel_point_ttl_days = float(os.getenv('PESTEL_POINT_TTL_DAYS', 7))
+
+
+def empty_state():
+    '''A PESTEL state with no point, "articles" keeps when each article was first analyzed'''
+    return {'dimensions': {name: [] for name in pestel_dimensions}, 'sentiment': '', 'articles': {}}
+
+
+def supported_points(dimensions, articles):
+    '''Keep the ids of the known articles in every point, and the points left with one'''
+    supported = {name: [] for name in pestel_dimensions}
+    for name in pestel_dimensions:
+        for point in dimensions.get(name, []):
+            article_ids = [article_id for article_id in point['article_ids'] if article_id in articles]
+            if article_ids:
+                supported[name].append({**point, 'article_ids': article_ids})
+    return supported
+
+
+def expire_points(state, now=None, ttl_days=pestel_point_ttl_days):
+    '''Forget the articles older than the TTL and drop the points none of the others supports'''
+    limit = (now or time.time()) - ttl_days * 86400
+    articles = {
+        article_id: seen_at for article_id, seen_at in state['articles'].items() if seen_at >= limit
+    }
+    return {
+        'dimensions': supported_points(state['dimensions'], articles),
+        'sentiment': state.get('sentiment', ''),
+        'articles': articles,
+    }
+
+
+def load_state(store, run_id, max_age_days=pestel_state_max_age_days):
+    '''The PESTEL state saved by the latest other run, an empty one when missing or too old'''
+    latest = store.latest_analysis('pestel_state', exclude_run_id=run_id)
+    if latest is None:
+        print("No previous PESTEL state, the analysis starts from scratch.")
+        return empty_state()
+    if time.time() - latest['created_at'] > max_age_days * 86400:
+        print(f"The PESTEL state of {latest['run_id']} is too old, the analysis starts from scratch.")
+        return empty_state()
+    try:
+        state = json.loads(latest['content'])
+    except ValueError:
+        return empty_state()
+    return expire_points(state)
+
+
+def compact_state(state):
+    '''The part of the state sent to Gemini, without the analysis times of the articles'''
+    return {'dimensions': state['dimensions'], 'sentiment': state['sentiment']}
+
+
+def merge_update(state, update, new_ids, now=None):
+    '''Take the points of an updated state, keeping only the ids of articles that were sent'''
+    articles = dict(state['articles'])
+    for article_id in new_ids:
+        articles.setdefault(article_id, now or time.time())
+    # a point with no known article is an invention of the model
+    return {
+        'dimensions': supported_points(update['dimensions'], articles),
+        'sentiment': update['sentiment'] or state['sentiment'],
+        'articles': articles,
+    }
+
+
+def render_state(state):
+    '''Write the state as the market analysis text read by the next tasks'''
+    lines = []
+    for name in pestel_dimensions:
+        points = state['dimensions'].get(name) or []
+        if points:
+            lines.append(f"{name.capitalize()}:")
+            lines.extend(f"- {point['point']} ({point['impact']})" for point in points)
+    if state['sentiment']:
+        lines.append(f"Market sentiment: {state['sentiment']}")
+    return '\n'.join(lines)
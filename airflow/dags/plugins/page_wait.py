@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+
+from urllib.parse import urlparse
+
+
+# per-domain ready times survive between runs, next to the Gemini cache
+ready_times_path = os.getenv(
+    'PAGE_READY_TIMES_PATH', '/opt/airflow/dags/cache/page_ready_times.json'
+)
+default_timeout = float(os.getenv('PAGE_WAIT_TIMEOUT', 15))
+min_timeout = float(os.getenv('PAGE_WAIT_MIN_TIMEOUT', 3))
+
+# number of ready times kept per domain
+history_size = 50
+
+ready_state_script = "return document.readyState === 'complete';"
+
+# the page is idle when no resource was added to the performance timeline for a while
+resource_count_script = "return performance.getEntriesByType('resource').length;"
+
+# a rendered canvas exports a much longer data URL than a blank one
+canvas_rendered_script = """
+const minimumLength = arguments[0];
+for (const canvas of document.querySelectorAll('canvas')) {
+    if (canvas.width < 100 || canvas.height < 100) { continue; }
+    try {
+        if (canvas.toDataURL().length > minimumLength) { return true; }
+    } catch (error) {
+        // a tainted canvas cannot be exported, it has been drawn on
+        return true;
+    }
+}
+return false;
+"""
+
+viewport_images_loaded_script = """
+for (const image of document.images) {
+    const box = image.getBoundingClientRect();
+    const visible = box.bottom > 0 && box.top < window.innerHeight && box.width > 0;
+    if (visible && !image.complete) { return false; }
+}
+return true;
+"""
+
+page_images_loaded_script = """
+for (const image of document.images) {
+    if (image.getBoundingClientRect().width > 0 && !image.complete) { return false; }
+}
+return true;
+"""
+
+
+class PageWaiter:
+    '''Wait on page readiness signals, with timeouts adapted to each domain'''
+    def __init__(self, history_path=ready_times_path, poll=0.1):
+        self.history_path = history_path
+        self.poll = poll
+        self._lock = threading.Lock()
+        self.ready_times = {}
+        try:
+            with open(self.history_path, 'r') as json_file:
+                self.ready_times = json.load(json_file)
+        except (OSError, ValueError):
+            pass
+
+    def timeout_for(self, domain):
+        '''Allow 1.5 times the 90th percentile of the past ready times of a domain'''
+        times = sorted(self.ready_times.get(domain, []))
+        if len(times) < 3:
+            return default_timeout
+        percentile = times[int(0.9 * (len(times) - 1))]
+        return min(max(1.5 * percentile, min_timeout), 2 * default_timeout)
+
+    def record(self, domain, elapsed):
+        '''Remember how long a page of the domain took to be ready'''
+        with self._lock:
+            times = self.ready_times.setdefault(domain, [])
+            times.append(round(elapsed, 3))
+            del times[:-history_size]
+
+    def save(self):
+        '''Persist the ready times for the next runs'''
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+                with open(self.history_path, 'w') as json_file:
+                    json.dump(self.ready_times, json_file)
+            except OSError as e:
+                print(f"Could not save the page ready times: {e}")
+
+    def wait_until(self, driver, script, timeout, *args):
+        '''Poll a script until it returns a truthy value, returns False on timeout'''
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if driver.execute_script(script, *args):
+                    return True
+            except Exception:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll)
+
+    def wait_ready_state(self, driver, timeout=default_timeout):
+        '''Wait for document.readyState to be complete'''
+        return self.wait_until(driver, ready_state_script, timeout)
+
+    def wait_network_idle(self, driver, timeout=default_timeout, idle_time=0.5):
+        '''Wait until no new resource has been requested for idle_time seconds'''
+        deadline = time.monotonic() + timeout
+        last_count = None
+        idle_since = time.monotonic()
+        while time.monotonic() < deadline:
+            try:
+                count = driver.execute_script(resource_count_script)
+            except Exception:
+                count = None
+            if count != last_count:
+                last_count = count
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= idle_time:
+                return True
+            time.sleep(self.poll)
+        return False
+
+    def wait_canvas_rendered(self, driver, timeout=default_timeout, minimum_length=20000):
+        '''Wait until a large canvas on the page has been drawn'''
+        return self.wait_until(driver, canvas_rendered_script, timeout, minimum_length)
+
+    def wait_viewport_images(self, driver, timeout=2):
+        '''Wait until the images in the viewport have finished loading'''
+        return self.wait_until(driver, viewport_images_loaded_script, timeout)
+
+    def wait_page_images(self, driver, timeout=3):
+        '''Wait until every displayed image of the page has finished loading'''
+        return self.wait_until(driver, page_images_loaded_script, timeout)
+
+    def wait_recorded(self, driver, key, *waits):
+        '''Run waits within the adaptive timeout of key and record the time they took'''
+        timeout = self.timeout_for(key)
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+
+        ready = True
+        for wait in waits:
+            ready = wait(driver, max(deadline - time.monotonic(), 0)) and ready
+
+        elapsed = time.monotonic() - start_time
+        if ready:
+            self.record(key, elapsed)
+        else:
+            # a timeout still teaches the next runs that the key is slow
+            self.record(key, timeout)
+            print(f"Not ready after {timeout:.1f}s: {key}")
+        return ready
+
+    def wait_for_page(self, driver, url):
+        '''Wait for a freshly loaded page to be complete and its network idle'''
+        return self.wait_recorded(
+            driver, urlparse(url).netloc, self.wait_ready_state, self.wait_network_idle
+        )
+
+
+_page_waiter = None
+_page_waiter_lock = threading.Lock()
+
+
+def get_page_waiter():
+    '''Return the process-wide page waiter'''
+    global _page_waiter
+    with _page_waiter_lock:
+        if _page_waiter is None:
+            _page_waiter = PageWaiter()
+    return _page_waiter
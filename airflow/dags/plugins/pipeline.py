@@ -0,0 +1,125 @@
+import os
+import queue
+import threading
+import time
+
+from threading import Thread
+
+from plugins.gemini_model import SummarizeArticle
+from plugins.image_preprocess import preprocess_article
+from plugins.snapshot import snapshot_articles
+from plugins.telemetry import in_context
+from plugins.telemetry import metrics
+
+
+# snapshots waiting for a summarizer, the browsers block when the queue is full
+stream_queue_size = int(os.getenv('STREAM_QUEUE_SIZE', 8))
+stream_consumers = int(os.getenv('STREAM_CONSUMERS', 4))
+
+
+def summarize_snapshot(snapshot):
+    '''Preprocess the screenshots of a snapshot if any, then summarize it'''
+    if not snapshot.get('text') and not snapshot['screenshots_path']:
+        return None
+
+    # a full-page capture is already tiled
+    if not snapshot.get('text') and not snapshot.get('tiled'):
+        result = preprocess_article(
+            snapshot['screenshots_path'],
+            scroll_offsets=snapshot.get('scroll_offsets'),
+            viewport_height=snapshot.get('viewport_height'),
+        )
+        snapshot['original_screenshots_path'] = snapshot['screenshots_path']
+        snapshot['screenshots_path'] = result['tiles_path']
+        snapshot['tiled'] = True
+        snapshot['bytes_before'] = result['bytes_before']
+        snapshot['bytes_after'] = result['bytes_after']
+
+    summary = SummarizeArticle(
+        snapshot['screenshots_path'],
+        article_text=snapshot.get('text')
+    ).generate_summarize_article()
+    return summary or None
+
+
+def stream_snapshot_summarize(
+    article_urls: list,
+    folder_path: str,
+    domains: list,
+    queue_size=stream_queue_size,
+    consumers=stream_consumers,
+    on_summary=None
+):
+    '''Summarize every article as soon as its snapshot is done, returns (snapshots, summaries)
+
+    on_summary(snapshot, summary) is called from the summarizer thread once an article is done.
+    '''
+    work_queue = queue.Queue(maxsize=queue_size)
+    summaries = [None] * len(article_urls)
+    stats = {'max_depth': 0, 'blocked': 0.0, 'summarize_busy': 0.0}
+    stats_lock = threading.Lock()
+
+
+    def produce(index, snapshot):
+        '''This function hands a finished snapshot to the summarizers'''
+        start_time = time.perf_counter()
+        # blocks the browser while the summarizers are behind
+        work_queue.put((index, snapshot))
+        metrics.set_gauge('stream_queue_depth', work_queue.qsize())
+        with stats_lock:
+            stats['blocked'] += time.perf_counter() - start_time
+            stats['max_depth'] = max(stats['max_depth'], work_queue.qsize())
+
+
+    def consume():
+        '''This function summarizes snapshots until it receives the end marker'''
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            index, snapshot = item
+            start_time = time.perf_counter()
+            try:
+                summaries[index] = summarize_snapshot(snapshot)
+            except Exception as e:
+                print(f"Error summarizing {snapshot['url']}: {e}")
+            finally:
+                # the snapshot is kept even when its summary failed
+                try:
+                    if on_summary:
+                        on_summary(snapshot, summaries[index])
+                except Exception as e:
+                    print(f"Error storing {snapshot['url']}: {e}")
+            with stats_lock:
+                stats['summarize_busy'] += time.perf_counter() - start_time
+
+
+    start_time = time.perf_counter()
+    threads = [Thread(target=in_context(consume)) for _ in range(consumers)]
+    for t in threads:
+        t.start()
+
+    try:
+        snapshot_list = snapshot_articles(
+            article_urls=article_urls,
+            folder_path=folder_path,
+            domains=domains,
+            on_snapshot=produce
+        )
+        snapshot_time = time.perf_counter() - start_time
+    finally:
+        # one end marker per summarizer, after the last snapshot
+        for _ in threads:
+            work_queue.put(None)
+        for t in threads:
+            t.join()
+
+    total_time = time.perf_counter() - start_time
+    print(
+        f"Streaming pipeline: {len(article_urls)} articles in {total_time:.1f}s "
+        f"(snapshots done after {snapshot_time:.1f}s, "
+        f"summarizers busy {stats['summarize_busy']:.1f}s over {consumers} threads), "
+        f"max queue depth {stats['max_depth']}/{queue_size}, "
+        f"browsers blocked {stats['blocked']:.1f}s by backpressure"
+    )
+    return snapshot_list, summaries
@@ -0,0 +1,231 @@
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+
+from plugins.settings import load_environment
+
+
+# Load environment variables from .env file
+load_environment()
+
+# quota of the Gemini project, requests and input tokens per minute
+requests_per_minute = float(os.getenv('GEMINI_RPM', 1000))
+tokens_per_minute = float(os.getenv('GEMINI_TPM', 1_000_000))
+
+# bounds of the adaptive number of requests in flight, the maximum is also the keep-alive pool size
+min_concurrency = int(os.getenv('GEMINI_MIN_CONCURRENCY', 1))
+max_concurrency = int(os.getenv('GEMINI_MAX_CONCURRENCY', 8))
+
+# jittered exponential backoff between two attempts, in seconds
+backoff_base = float(os.getenv('GEMINI_BACKOFF_BASE', 1))
+backoff_max = float(os.getenv('GEMINI_BACKOFF_MAX', 60))
+
+# Gemini averages about 4 characters per token on English text
+chars_per_token = 4
+
+# tokens billed for an inline image
+image_tokens = 258
+
+# the quota was hit or the service is overloaded: slow down and retry
+throttle_status_codes = {429, 503}
+# transient failures worth another attempt
+retryable_status_codes = {408, 500, 502, 504}
+
+
+def estimate_tokens(text):
+    '''Estimate the number of tokens of a text without calling the API'''
+    return math.ceil(len(text) / chars_per_token)
+
+
+def estimate_request_tokens(data):
+    '''Estimate the input tokens of a generateContent request'''
+    tokens = 0
+    for content in data.get('contents', []):
+        for part in content.get('parts', []):
+            if 'text' in part:
+                tokens += estimate_tokens(part['text'])
+            elif 'inline_data' in part or 'inlineData' in part:
+                tokens += image_tokens
+    return max(tokens, 1)
+
+
+def classify_status(status_code):
+    '''Tell whether an answer is ok, throttled, retryable or fatal'''
+    if status_code == 200:
+        return 'ok'
+    if status_code in throttle_status_codes:
+        return 'throttled'
+    if status_code in retryable_status_codes or status_code >= 500:
+        return 'retryable'
+    # bad request, authentication, unknown model: another attempt fails the same way
+    return 'fatal'
+
+
+def retry_after(headers, body=None):
+    '''Seconds the server asks to wait, from Retry-After or the RetryInfo of the error'''
+    value = (headers or {}).get('Retry-After')
+    if value:
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+    try:
+        for detail in body['error']['details']:
+            if detail.get('@type', '').endswith('RetryInfo'):
+                return float(detail['retryDelay'].rstrip('s'))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def backoff_delay(attempt, server_delay=None):
+    '''Full-jitter exponential backoff, never shorter than what the server asked for'''
+    delay = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+    if server_delay is not None:
+        delay = max(delay, server_delay)
+    return delay
+
+
+class TokenBucket:
+    '''Refill `rate` units per minute up to `capacity`, reservations may go into debt'''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate / 60
+        self.capacity = capacity or rate
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        '''Take amount units, returns the seconds to wait before using them'''
+        with self._lock:
+            now = time.monotonic()
+            self.available = min(
+                self.capacity, self.available + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.available -= amount
+            return max(-self.available / self.rate, 0) if self.rate else 0
+
+    def refund(self, amount):
+        '''Give back units reserved in excess, or take more with a negative amount'''
+        with self._lock:
+            self.available = min(self.capacity, self.available + amount)
+
+
+class GeminiGovernor:
+    '''Process-wide pacing of the Gemini requests: quota buckets and AIMD concurrency'''
+    def __init__(
+        self,
+        rpm=requests_per_minute,
+        tpm=tokens_per_minute,
+        minimum=min_concurrency,
+        maximum=max_concurrency
+    ):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.stats = {
+            'requests': 0,
+            'throttled': 0,
+            'retryable': 0,
+            'fatal': 0,
+            'waited': 0.0,
+            'min_limit': float(maximum),
+        }
+        self._condition = threading.Condition()
+
+    def _try_enter(self):
+        '''Take a concurrency slot if the current limit allows it'''
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def _quota_delay(self, tokens):
+        '''Reserve one request and the tokens in the buckets'''
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def acquire(self, tokens):
+        '''Block until a request of `tokens` input tokens may be sent'''
+        start_time = time.monotonic()
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        time.sleep(self._quota_delay(tokens))
+        self._waited(time.monotonic() - start_time)
+
+    async def aacquire(self, tokens):
+        '''Asyncio counterpart of acquire, never blocking the event loop'''
+        start_time = time.monotonic()
+        while not self._try_enter():
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(self._quota_delay(tokens))
+        self._waited(time.monotonic() - start_time)
+
+    def _waited(self, seconds):
+        with self._condition:
+            self.stats['requests'] += 1
+            self.stats['waited'] += seconds
+
+    def release(self, outcome, estimated_tokens=None, used_tokens=None):
+        '''Free the slot and adapt the concurrency to the outcome of the request'''
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == 'ok':
+                # additive increase: about one more slot per round of requests
+                self.limit = min(self.maximum, self.limit + 1 / max(self.limit, 1))
+            elif outcome in ('throttled', 'retryable'):
+                self.stats[outcome] += 1
+                now = time.monotonic()
+                # multiplicative decrease, once per burst of failures
+                if now - self.last_decrease > 1:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+                    self.stats['min_limit'] = min(self.stats['min_limit'], self.limit)
+            else:
+                self.stats['fatal'] += 1
+            self._condition.notify_all()
+
+        if estimated_tokens is not None and used_tokens is not None:
+            # settle the estimate against the usage reported by the API
+            self.tokens.refund(estimated_tokens - used_tokens)
+
+    def report(self):
+        '''Print the pacing statistics of the process'''
+        with self._condition:
+            stats = dict(self.stats, limit=round(self.limit, 2))
+        stats['waited'] = round(stats['waited'], 2)
+        print(
+            f"Gemini governor: {stats['requests']} requests, {stats['throttled']} throttled, "
+            f"{stats['retryable']} transient errors, {stats['fatal']} fatal, "
+            f"{stats['waited']}s waiting for quota or slots, "
+            f"concurrency {stats['limit']} (lowest {stats['min_limit']})"
+        )
+        return stats
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_gemini_governor():
+    '''Return the process-wide Gemini governor'''
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = GeminiGovernor()
+    return _governor
@@ -0,0 +1,139 @@
+import os
+import re
+import time
+import uuid
+
+import pandas as pd
+
+from datetime import datetime
+from datetime import timezone
+
+from plugins.structured_output import to_price
+from plugins.structured_output import zone_fields
+
+
+# date=YYYY-MM-DD/type=opinion|final/run_<run id>-<unique>.parquet
+recommendations_path = os.getenv(
+    'RECOMMENDATIONS_PATH', '/opt/airflow/dags/recommendations'
+)
+
+
+def recommendation_row(recommendation, run_id, kind, sample=None):
+    '''Flatten a recommendation into one row with the same columns for every file'''
+    row = {
+        'run_id': run_id,
+        'type': kind,
+        'sample': sample,
+        'date': recommendation.get('date'),
+        'created_at': time.time(),
+    }
+    for field in zone_fields:
+        zone = recommendation.get(field) or {}
+        for bound in ('min', 'max'):
+            row[f'{field}.{bound}'] = to_price(zone.get(bound))
+    for key, value in pd.json_normalize(recommendation).iloc[0].items():
+        # extra values, e.g. the dispersion of an aggregated recommendation
+        if key not in row and not key.startswith(zone_fields):
+            row[key] = value
+    return row
+
+
+def partition_path(root, day, kind):
+    '''Folder of the recommendations of one type on one day'''
+    return os.path.join(root, f'date={day}', f'type={kind}')
+
+
+def save_recommendation(recommendation, run_id, kind, sample=None, root=recommendations_path):
+    '''Append a recommendation to its partition without touching the other files'''
+    day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    folder = partition_path(root, day, kind)
+    os.makedirs(folder, exist_ok=True)
+
+    safe_run_id = re.sub(r'[^\w.-]', '_', run_id or 'manual')
+    # a unique name: concurrent writers never overwrite each other
+    file_path = os.path.join(folder, f'run_{safe_run_id}-{uuid.uuid4().hex[:8]}.parquet')
+    temporary_path = file_path + '.tmp'
+    pd.DataFrame([recommendation_row(recommendation, run_id, kind, sample)]).to_parquet(
+        temporary_path, index=False
+    )
+    # readers never see a half-written file
+    os.replace(temporary_path, file_path)
+    print(f"Recommendation saved to {file_path}")
+    return file_path
+
+
+def _partition_files(folder):
+    return sorted(
+        os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.parquet')
+    ) if os.path.isdir(folder) else []
+
+
+def _read_files(file_paths):
+    '''Read parquet files that may not share every column'''
+    frames = [pd.read_parquet(file_path) for file_path in file_paths]
+    frames = [frame for frame in frames if not frame.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def _days(root):
+    '''Days with a partition, newest first'''
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        (name.split('=', 1)[1] for name in os.listdir(root) if name.startswith('date=')),
+        reverse=True
+    )
+
+
+def compact_recommendations(root=recommendations_path, min_files=2):
+    '''Merge the small files of every partition into one file, returns the files removed'''
+    removed = 0
+    for day in _days(root):
+        day_folder = os.path.join(root, f'date={day}')
+        for kind_folder in os.listdir(day_folder):
+            folder = os.path.join(day_folder, kind_folder)
+            file_paths = _partition_files(folder)
+            if len(file_paths) < min_files:
+                continue
+
+            frame = _read_files(file_paths).sort_values('created_at', ignore_index=True)
+            compacted_path = os.path.join(folder, f'compacted-{uuid.uuid4().hex[:8]}.parquet')
+            frame.to_parquet(compacted_path + '.tmp', index=False)
+            os.replace(compacted_path + '.tmp', compacted_path)
+            # only the merged files are removed, a file written meanwhile is kept
+            for file_path in file_paths:
+                os.remove(file_path)
+            removed += len(file_paths)
+            print(f"Compacted {len(file_paths)} files of {folder}")
+    return removed
+
+
+def recommendations_between(start, end, kind=None, root=recommendations_path):
+    '''Recommendations created between two datetimes, reading only the partitions of those days'''
+    start_day = start.astimezone(timezone.utc).strftime('%Y-%m-%d')
+    end_day = end.astimezone(timezone.utc).strftime('%Y-%m-%d')
+    file_paths = []
+    for day in _days(root):
+        if start_day <= day <= end_day:
+            kinds = [kind] if kind else [
+                name.split('=', 1)[1] for name in os.listdir(os.path.join(root, f'date={day}'))
+            ]
+            for partition_kind in kinds:
+                file_paths += _partition_files(partition_path(root, day, partition_kind))
+
+    frame = _read_files(file_paths)
+    if frame.empty:
+        return frame
+    frame = frame[
+        (frame['created_at'] >= start.timestamp()) & (frame['created_at'] <= end.timestamp())
+    ]
+    return frame.sort_values('created_at', ignore_index=True)
+
+
+def latest_recommendation(kind='final', root=recommendations_path):
+    '''Newest recommendation of a type as a dict, None when there is none'''
+    for day in _days(root):
+        frame = _read_files(_partition_files(partition_path(root, day, kind)))
+        if not frame.empty:
+            return frame.sort_values('created_at').iloc[-1].to_dict()
+    return None
@@ -0,0 +1,52 @@
+import functools
+import os
+
+from dotenv import load_dotenv
+
+
+@functools.cache
+def load_environment():
+    '''Load the .env file once per process, every module reading the environment calls it first'''
+    return load_dotenv()
+
+
+# Load environment variables from .env file
+load_environment()
+
+
+def selenium_domains():
+    '''List the Selenium nodes from SELENIUM_DOMAINS, or from the DOMAIN_SELENIUMn variables'''
+    domains = os.getenv('SELENIUM_DOMAINS')
+    if domains:
+        return [domain.strip() for domain in domains.split(',') if domain.strip()]
+
+    domains = []
+    while os.getenv(f'DOMAIN_SELENIUM{len(domains)}'):
+        domains.append(os.getenv(f'DOMAIN_SELENIUM{len(domains)}'))
+    return domains
+
+
+# the settings the DAG reads while it is parsed, the scheduler parses it every few seconds
+# so this module and telemetry only import the standard library and dotenv
+
+warning_email = os.getenv('WARNING_EMAIL')
+
+# 'klines' renders the chart from exchange candles, 'selenium' snapshots binance.com
+chart_source = os.getenv('CHART_SOURCE', 'klines')
+
+# 'batch' runs snapshot, preprocess and summarize as separate tasks,
+# 'stream' summarizes every article as soon as its snapshot is done
+pipeline_mode = os.getenv('PIPELINE_MODE', 'batch')
+
+# 'auto' asks Gemini for the final recommendation only when the opinions disagree,
+# 'llm' always asks it, 'local' always merges the opinions without another request
+final_recommendation_mode = os.getenv('FINAL_RECOMMENDATION', 'auto')
+
+# the snapshot, preprocess and summarize tasks are mapped over batches of this many articles
+article_batch_size = int(os.getenv('ARTICLE_BATCH_SIZE', 25))
+
+# 'online' sends one summary request per article, 'batch' sends them all as batch jobs
+# polled by a sensor which frees its worker slot between two polls
+summary_mode = os.getenv('SUMMARY_MODE', 'online')
+summary_batch_poll = int(os.getenv('SUMMARY_BATCH_POLL', 60))
+summary_batch_timeout = int(os.getenv('SUMMARY_BATCH_TIMEOUT', 3600))
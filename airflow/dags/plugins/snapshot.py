@@ -1,16 +1,268 @@
+import atexit
+import base64
 import os
+import queue
+import threading
 import time
 import uuid
 
-import pandas as pd
+import requests
 
+from threading import Thread
 
 from selenium.webdriver import ChromeOptions
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webdriver import WebDriver as RemoteWebDriver
 
+from plugins.image_preprocess import tile_full_page
+from plugins.page_wait import get_page_waiter
+from plugins.settings import selenium_domains
+from plugins.telemetry import in_context
+from plugins.telemetry import metrics
+from plugins.telemetry import size_buckets
+from plugins.telemetry import span
 
-def snapshot_chart(folder_path=None, prefix_filename='', domain=None):
+
+# 'text' extracts the article body from the DOM and falls back to screenshots,
+# 'screenshot' always snapshots the page,
+# 'compare' does both and keeps the text, to measure the two modes on the same pages
+snapshot_mode = os.getenv('SNAPSHOT_MODE', 'text')
+
+# an extraction shorter than this is treated as a failure (paywall, consent page...)
+article_min_chars = int(os.getenv('ARTICLE_MIN_CHARS', 500))
+
+# 'full_page' takes one DevTools screenshot of the page and tiles it in memory,
+# 'scroll' scrolls the viewport and takes one screenshot per step
+screenshot_capture = os.getenv('SCREENSHOT_CAPTURE', 'full_page')
+# CSS pixels of a page captured at most, the rest of a longer page is left out
+full_page_max_height = int(os.getenv('FULL_PAGE_MAX_HEIGHT', 12000))
+
+
+# a warm session is recycled after this many pages to keep the browser memory bounded
+session_max_pages = int(os.getenv('SELENIUM_SESSION_MAX_PAGES', 25))
+
+# seconds a node that failed a health probe is left aside
+node_cooldown = int(os.getenv('SELENIUM_NODE_COOLDOWN', 60))
+
+# seconds a batch waits for a free node before it fails and is retried by Airflow
+node_wait_timeout = int(os.getenv('SELENIUM_NODE_WAIT_TIMEOUT', 600))
+
+# attempts of an article whose browser session died under it
+article_max_attempts = 2
+
+
+class NodeUnavailable(Exception):
+    '''No healthy Selenium node can open a browser session'''
+
+
+def create_driver(domain):
+    '''Connect to the Selenium node of a domain'''
+    # Set up remote WebDriver to connect to Selenium Grid
+    options = ChromeOptions()
+    options.add_argument('--start-maximized')
+    options.add_argument('--no-sandbox')  # Add for Docker
+    options.add_argument('--disable-dev-shm-usage')  # Overcome limited resource problems
+    
+    driver = RemoteWebDriver(
+        # selenium is service name in docker-compose, change if needed
+        command_executor=f'http://{domain}:4444/wd/hub',
+        options=options
+    )
+    # the Grid forwards the DevTools commands of a Chrome session to its node
+    driver.command_executor.add_command(
+        'executeCdpCommand', 'POST', '/session/$sessionId/goog/cdp/execute'
+    )
+    return driver
+
+
+def execute_cdp(driver, command, params=None):
+    '''Run a Chrome DevTools command in the browser of a session'''
+    if hasattr(driver, 'execute_cdp_cmd'):
+        return driver.execute_cdp_cmd(command, params or {})
+    return driver.execute('executeCdpCommand', {'cmd': command, 'params': params or {}})['value']
+
+
+def node_is_ready(domain):
+    '''Ask the Selenium node whether it accepts new sessions'''
+    try:
+        response = requests.get(f'http://{domain}:4444/status', timeout=3)
+        return response.json()['value']['ready']
+    except Exception:
+        return False
+
+
+def node_is_free(domain):
+    '''Ask the Selenium node whether one of its slots runs no session'''
+    try:
+        response = requests.get(f'http://{domain}:4444/status', timeout=3)
+        value = response.json()['value']
+        return value['ready'] and any(
+            slot.get('session') is None
+            for node in value.get('nodes', []) for slot in node.get('slots', [])
+        )
+    except Exception:
+        return False
+
+
+class WebDriverPool:
+    '''Keep warm browser sessions per Selenium node, health-probe them and fail over'''
+    def __init__(
+        self, 
+        domains, 
+        max_pages=session_max_pages, 
+        driver_factory=create_driver, 
+        node_probe=node_is_ready,
+        free_probe=node_is_free
+    ):
+        self.domains = list(domains)
+        self.max_pages = max_pages
+        self.driver_factory = driver_factory
+        self.node_probe = node_probe
+        self.free_probe = free_probe
+        self.idle = {domain: [] for domain in self.domains}
+        self.pages = {}
+        self.unhealthy_until = {}
+        self.stats = {'created': 0, 'reused': 0, 'recycled': 0, 'failovers': 0}
+        self._lock = threading.Lock()
+    
+    def healthy_domains(self):
+        '''List the nodes that are not cooling down after a failure'''
+        now = time.time()
+        return [
+            domain for domain in self.domains 
+            if self.unhealthy_until.get(domain, 0) <= now
+        ]
+    
+    def mark_unhealthy(self, domain):
+        '''Leave a node aside for a while and drop its warm sessions'''
+        print(f"Selenium node {domain} is unhealthy, retry it in {node_cooldown}s")
+        with self._lock:
+            self.unhealthy_until[domain] = time.time() + node_cooldown
+            drivers, self.idle[domain] = self.idle[domain], []
+        for driver in drivers:
+            self._quit(driver)
+    
+    @staticmethod
+    def is_alive(driver):
+        '''Probe a browser session with a trivial script'''
+        try:
+            return driver.execute_script('return 1') == 1
+        except Exception:
+            return False
+    
+    def acquire(self, domain):
+        '''Return a live session of the node, warm when possible'''
+        if domain not in self.healthy_domains():
+            raise NodeUnavailable(domain)
+        
+        while True:
+            with self._lock:
+                driver = self.idle[domain].pop() if self.idle[domain] else None
+            if driver is None:
+                break
+            if self.is_alive(driver):
+                self.stats['reused'] += 1
+                return driver
+            self._quit(driver)
+        
+        if not self.node_probe(domain):
+            self.mark_unhealthy(domain)
+            raise NodeUnavailable(domain)
+        try:
+            driver = self.driver_factory(domain)
+        except Exception as e:
+            print(f"{e}")
+            self.mark_unhealthy(domain)
+            raise NodeUnavailable(domain)
+        self.pages[id(driver)] = 0
+        self.stats['created'] += 1
+        return driver
+    
+    def acquire_any(self, preferred=None):
+        '''Return a session of the preferred node, failing over to the other healthy nodes'''
+        domains = sorted(self.healthy_domains(), key=lambda domain: domain != preferred)
+        for domain in domains:
+            try:
+                driver = self.acquire(domain)
+            except NodeUnavailable:
+                continue
+            if preferred and domain != preferred:
+                self.stats['failovers'] += 1
+            return domain, driver
+        raise NodeUnavailable('no healthy Selenium node')
+    
+    def claim_free(self, preferred=None, timeout=node_wait_timeout, poll=10):
+        '''Open a session on the first free node from the preferred one, returns the node
+
+        A node runs one session at a time, the warm session left in the pool holds
+        the node for this process until it is released or the process exits.
+        '''
+        start = self.domains.index(preferred) if preferred in self.domains else 0
+        domains = self.domains[start:] + self.domains[:start]
+        deadline = time.time() + timeout
+        while True:
+            for domain in domains:
+                if domain not in self.healthy_domains() or not self.free_probe(domain):
+                    continue
+                try:
+                    driver = self.acquire(domain)
+                except NodeUnavailable:
+                    continue
+                self.release(domain, driver)
+                return domain
+            if time.time() >= deadline:
+                raise NodeUnavailable(f'no free Selenium node after {timeout}s')
+            time.sleep(poll)
+    
+    def release(self, domain, driver, failed=False):
+        '''Give a session back, recycling it after max_pages pages or an error'''
+        self.pages[id(driver)] = self.pages.get(id(driver), 0) + 1
+        if failed or self.pages[id(driver)] >= self.max_pages:
+            self.stats['recycled'] += 1
+            self._quit(driver)
+            return
+        with self._lock:
+            self.idle[domain].append(driver)
+    
+    def _quit(self, driver):
+        self.pages.pop(id(driver), None)
+        try:
+            driver.quit()  # Close the browser
+        except Exception:
+            pass
+    
+    def close(self):
+        '''Quit every warm session'''
+        for domain in self.domains:
+            with self._lock:
+                drivers, self.idle[domain] = self.idle[domain], []
+            for driver in drivers:
+                self._quit(driver)
+    
+    def report(self):
+        '''Print how often warm sessions were reused'''
+        print(
+            f"Browser sessions created: {self.stats['created']}, "
+            f"reused: {self.stats['reused']}, recycled: {self.stats['recycled']}, "
+            f"failovers: {self.stats['failovers']}"
+        )
+        return dict(self.stats)
+
+
+_webdriver_pools = {}
+
+
+def get_webdriver_pool(domains):
+    '''Return the process-wide session pool of a list of nodes'''
+    key = tuple(domains)
+    if key not in _webdriver_pools:
+        _webdriver_pools[key] = WebDriverPool(domains)
+        # the warm sessions are released when the task process exits
+        atexit.register(_webdriver_pools[key].close)
+    return _webdriver_pools[key]
+
+
+def snapshot_chart(folder_path=None, prefix_filename='', domain=None, pool=None):
     '''Take a snapshot of the Bitcoin chart on Binance'''
     # Initialize snapshot_article_part_path
     snapshot_chart_path = None
@@ -20,73 +272,44 @@ def snapshot_chart(folder_path=None, prefix_filename='', domain=None):
         print(f"Folder path does not exist: {folder_path}")
         return None
     
-    # Set up remote WebDriver to connect to Selenium Grid
-    options = ChromeOptions()
-    options.add_argument('--no-sandbox')
-    options.add_argument('--disable-dev-shm-usage')
-    options.add_argument('--start-maximized')
-    options.add_argument('--window-size=1920,1080')
-
-    # retry connection to Selenium server
-
+    # take a warm session, failing over to another node when this one is down
+    pool = pool or get_webdriver_pool(selenium_domains())
     try:
-        driver = RemoteWebDriver(
-            # selenium is service name in docker-compose, change if needed
-            command_executor=f'http://{domain}:4444/wd/hub',  
-            options=options
-        )
-
-    except Exception as e:
+        domain, driver = pool.acquire_any(preferred=domain)
+    except NodeUnavailable as e:
         print(f"{e}")
         return None
+    failed = False
 
     try:
         # Open TradingView Bitcoin Chart
         driver.get('https://www.binance.com/en/trade/BTC_USDT?type=spot')
+        driver.set_window_size(1920, 1080)
 
         # Wait for the page to load
-        time.sleep(5)  # Adjust time as needed for the chart to load
+        waiter = get_page_waiter()
+        waiter.wait_for_page(driver, driver.current_url)
         
-        # Click on the chart to make it fullscreen
-        try:
-            fullscreen_chart_icon = driver.find_element(
-                By.CLASS_NAME, 'chart-fullscreen-icon'
-            )
-            fullscreen_chart_icon.click()
-            
-            # Wait for the chart to load in fullscreen
-            time.sleep(1)
-        except:
-            print("No fullscreen button found.")
-            
-        # Click on the button with the specified ID
-        try:
-            reject_cookie_button = driver.find_element(By.ID, 'onetrust-reject-all-handler')
-            reject_cookie_button.click()
-        except Exception:
+        # Reject the cookies first, the banner covers the chart buttons
+        reject_cookie_buttons = driver.find_elements(By.ID, 'onetrust-reject-all-handler')
+        if reject_cookie_buttons and reject_cookie_buttons[0].is_displayed():
+            reject_cookie_buttons[0].click()
+        else:
             print("No cookie rejection button found.")
-
+        
         # Click on the chart to make it fullscreen
-        try:
-            fullscreen_chart_icon = driver.find_element(
-                By.CLASS_NAME, 'chart-fullscreen-icon'
-            )
-            fullscreen_chart_icon.click()
-            
-            # Wait for the chart to load in fullscreen
-            time.sleep(1)
-        except:
+        fullscreen_chart_icons = driver.find_elements(By.CLASS_NAME, 'chart-fullscreen-icon')
+        if fullscreen_chart_icons:
+            try:
+                fullscreen_chart_icons[0].click()
+            except Exception as e:
+                print(f"Fullscreen button not clickable: {e}")
+        else:
             print("No fullscreen button found.")
-            
-        # Click on the button with the specified ID
-        try:
-            reject_cookie_button = driver.find_element(By.ID, 'onetrust-reject-all-handler')
-            reject_cookie_button.click()
-        except Exception:
-            print("No cookie rejection button found.")
-            
-        # Wait for the chart to update
-        time.sleep(1)  
+        
+        # Wait for the chart to be drawn in fullscreen
+        waiter.wait_recorded(driver, 'binance-chart-canvas', waiter.wait_canvas_rendered)
+        waiter.save()
 
         # Take a screenshot
         snapshot_chart_path = os.path.join(
@@ -99,83 +322,363 @@ def snapshot_chart(folder_path=None, prefix_filename='', domain=None):
             
     except Exception as e:
         print(f'An error occurred: {e}')
+        failed = True
         
     finally:
-        driver.quit()  # Close the browser
+        pool.release(domain, driver, failed=failed)
     
     return snapshot_chart_path
         
 
-def snapshot_article(article_urls: list, folder_path: str, domain=None):
-    '''Take a snapshot of the article'''
-    
-    # set scrolling height
-    scrolling_height=460
-    
-    # initialize screenshots_path
-    screenshots_path = []
-    
-    # Set up remote WebDriver to connect to Selenium Grid
-    options = ChromeOptions()
-    options.add_argument('--start-maximized')
-    options.add_argument('--no-sandbox')  # Add for Docker
-    options.add_argument('--disable-dev-shm-usage')  # Overcome limited resource problems
+# pick the element holding most of the paragraphs and read its title, paragraphs and tables
+extract_article_script = """
+const textOf = (element) => (element.innerText || '').replace(/\\s+/g, ' ').trim();
+let container = document.querySelector('article') || document.querySelector('main');
+if (!container) {
+    const scores = new Map();
+    for (const paragraph of document.querySelectorAll('p')) {
+        const parent = paragraph.parentElement;
+        scores.set(parent, (scores.get(parent) || 0) + textOf(paragraph).length);
+    }
+    let best = 0;
+    for (const [element, score] of scores) {
+        if (score > best) { best = score; container = element; }
+    }
+}
+if (!container) { return null; }
+const heading = document.querySelector('h1');
+const title = heading ? textOf(heading) : document.title;
+const paragraphs = [];
+for (const element of container.querySelectorAll('h2, h3, p, li, blockquote')) {
+    if (element.closest('nav, footer, aside, form, table')) { continue; }
+    const text = textOf(element);
+    if (text.length > 1) { paragraphs.push(text); }
+}
+const tables = [];
+for (const table of container.querySelectorAll('table')) {
+    const rows = [];
+    for (const row of table.querySelectorAll('tr')) {
+        rows.push(Array.from(row.querySelectorAll('th, td')).map(textOf).join(' | '));
+    }
+    tables.push(rows.join('\\n'));
+}
+return {title: title, paragraphs: paragraphs, tables: tables};
+"""
 
-    try:
-        driver = RemoteWebDriver(
-            # selenium is service name in docker-compose, change if needed
-            command_executor=f'http://{domain}:4444/wd/hub',
-            options=options
-        )
 
+# lazy images are loaded at once, the size of the page is read in the same round trip
+full_page_script = """
+for (const image of document.querySelectorAll('img[loading="lazy"]')) {
+    image.loading = 'eager';
+}
+return {
+    width: document.documentElement.clientWidth || window.innerWidth,
+    height: Math.max(document.body.scrollHeight, document.documentElement.scrollHeight),
+};
+"""
+
+
+def extract_article_text(driver):
+    '''Read the title, paragraphs and tables of the loaded article from the DOM'''
+    try:
+        article = driver.execute_script(extract_article_script)
     except Exception as e:
-        print(f"{e}")
+        print(f"Error extracting the article text: {e}")
         return None
     
-    snapshot_list = []
+    if not article:
+        return None
     
-    for article_url in article_urls:
-        prefix = uuid.uuid4()
-        folder_path_prefix = os.path.join(folder_path,str(prefix))
-        
+    # drop repeated blocks such as share buttons or newsletter banners
+    paragraphs = list(dict.fromkeys(article['paragraphs']))
+    text = "\n\n".join(
+        [f"Title: {article['title']}"] + paragraphs + article['tables']
+    )
+    if len(text) < article_min_chars:
+        return None
+    return text
+
+
+def capture_screenshots(driver, folder_path_prefix, scrolling_height=460):
+    '''Scroll through the loaded article and take a screenshot per segment'''
+    # Calculate total height of the document
+    total_height = driver.execute_script("return document.body.scrollHeight")
+    print(f"Total height of the page: {total_height}")
+    
+    screenshots_path = []
+    # the page stops scrolling at its bottom, keep the real offsets to crop the overlaps
+    scroll_offsets = []
+    
+    # Take screenshots in segments
+    for i in range(0, total_height, scrolling_height):
+        # Scroll to the current section
+        driver.execute_script(f"window.scrollTo(0, {i});")
+        get_page_waiter().wait_viewport_images(driver)  # Allow time for lazy images
+
+        part_num = i // scrolling_height + 1
         
+        # Take a snapshot of the current viewport
+        snapshot_article_part_path = f'{folder_path_prefix}_{part_num}.png'
+        driver.save_screenshot(snapshot_article_part_path)
+        print(f"Screenshot saved to: {snapshot_article_part_path}")
+        screenshots_path.append(snapshot_article_part_path)
+        scroll_offsets.append(driver.execute_script("return window.pageYOffset"))
+    return {
+        "screenshots_path": screenshots_path,
+        "scroll_offsets": scroll_offsets,
+        "viewport_height": driver.execute_script("return window.innerHeight"),
+    }
+
+
+def capture_full_page(driver, folder_path_prefix, max_height=full_page_max_height):
+    '''Take one DevTools screenshot of the whole article and tile it in memory'''
+    page = driver.execute_script(full_page_script)
+    get_page_waiter().wait_page_images(driver)
+    height = min(page['height'], max_height)
+    if page['height'] > max_height:
+        print(f"Page of {page['height']}px captured up to {max_height}px")
+
+    screenshot = execute_cdp(driver, 'Page.captureScreenshot', {
+        'format': 'png',
+        'captureBeyondViewport': True,
+        'clip': {'x': 0, 'y': 0, 'width': page['width'], 'height': height, 'scale': 1},
+    })
+    tiles = tile_full_page(base64.b64decode(screenshot['data']), folder_path_prefix)
+    print(f"Full page of {height}px cut into {tiles['tiles']} tiles: {folder_path_prefix}")
+    metrics.observe('snapshot_full_page_bytes', tiles['bytes_before'], size_buckets)
+    return {
+        "screenshots_path": tiles['tiles_path'],
+        # already cropped, deduplicated and encoded, preprocess_snapshots only counts its bytes
+        "tiled": True,
+        "page_height": page['height'],
+        "bytes_before": tiles['bytes_before'],
+        "bytes_after": tiles['bytes_after'],
+    }
+
+
+def capture_page(driver, folder_path_prefix, capture=screenshot_capture):
+    '''Capture the loaded article in one full-page screenshot, or by scrolling'''
+    if capture == 'full_page':
+        try:
+            return capture_full_page(driver, folder_path_prefix)
+        except Exception as e:
+            # e.g. a node without DevTools, the page is scrolled instead
+            print(f"Full-page capture failed, fall back to scrolling: {e}")
+    return capture_screenshots(driver, folder_path_prefix)
+
+
+def empty_snapshot(article_url: str):
+    '''Snapshot record of an article with nothing captured yet'''
+    return {
+        "url": article_url,
+        "mode": "screenshot",
+        "text": None,
+        "screenshots_path": [],
+        "payload_bytes": 0,
+        "elapsed": 0.0,
+    }
+
+
+def snapshot_one_article(driver, article_url: str, folder_path: str, mode=snapshot_mode):
+    '''Extract the text of one article, or snapshot it unless mode is screenshot'''
+    prefix = uuid.uuid4()
+    folder_path_prefix = os.path.join(folder_path,str(prefix))
+    snapshot = empty_snapshot(article_url)
+    start_time = time.perf_counter()
+    
+    with span('snapshot.article', url=article_url, mode=mode) as item_span:
         try:
             driver.get(article_url)  # Navigate to the article_URL
             driver.set_window_size(1750, 1080)
-            
-            time.sleep(4)  # Allow time for the page to load
-            
-            # Calculate total height of the document
-            total_height = driver.execute_script("return document.body.scrollHeight")
-            print(f"Total height of the page: {total_height}")
-            
-            screenshots_path = []
-            
-            # Take screenshots in segments
-            for i in range(0, total_height, scrolling_height):
-                # Scroll to the current section
-                driver.execute_script(f"window.scrollTo(0, {i});")
-                time.sleep(1)  # Allow time for scrolling
-
-                part_num = i // scrolling_height + 1
-                
-                # Take a snapshot of the current viewport
-                snapshot_article_part_path = f'{folder_path_prefix}_{part_num}.png'
-                driver.save_screenshot(snapshot_article_part_path)
-                print(f"Screenshot saved to: {snapshot_article_part_path}")
-                screenshots_path.append(snapshot_article_part_path)
-            snapshot_list.append({"screenshots_path": screenshots_path})
+        
+            # Wait until the page is loaded and its network is idle
+            get_page_waiter().wait_for_page(driver, article_url)
+            load_elapsed = time.perf_counter() - start_time
+            metrics.observe('snapshot_page_load_seconds', load_elapsed)
+        
+            if mode != 'screenshot':
+                text_start_time = time.perf_counter()
+                text = extract_article_text(driver)
+                if text:
+                    snapshot.update({
+                        "mode": "text",
+                        "text": text,
+                        "payload_bytes": len(text.encode('utf-8')),
+                        "elapsed": round(
+                            load_elapsed + time.perf_counter() - text_start_time, 3
+                        ),
+                    })
+                else:
+                    print(f"No readable text extracted, fall back to screenshots: {article_url}")
+        
+            if mode == 'compare' or not snapshot['text']:
+                screenshot_start_time = time.perf_counter()
+                screenshots = capture_page(driver, folder_path_prefix)
+                screenshot_bytes = sum(
+                    os.path.getsize(path) for path in screenshots['screenshots_path']
+                )
+                screenshot_elapsed = round(
+                    load_elapsed + time.perf_counter() - screenshot_start_time, 3
+                )
+                snapshot.update(screenshots)
+                snapshot.update({
+                    "screenshot_bytes": screenshot_bytes,
+                    "screenshot_elapsed": screenshot_elapsed,
+                })
+                if not snapshot['text']:
+                    snapshot['payload_bytes'] = screenshot_bytes
+                    snapshot['elapsed'] = screenshot_elapsed
         except Exception as e:
             print(f"Error fetching the article_URL: {e}")
             print(f"Error article_URL: {article_url}")
-            snapshot_list.append({"screenshots_path": []})
-        finally:
-            time.sleep(1)
+            snapshot['error'] = str(e)
+        
+        outcome = 'error' if 'error' in snapshot else snapshot['mode']
+        item_span.set(
+            extracted=snapshot['mode'], payload_bytes=snapshot['payload_bytes'], outcome=outcome
+        )
+        if outcome == 'error':
+            item_span.status = 'error'
+        metrics.inc('snapshot_pages_total', outcome=outcome)
+        metrics.observe(
+            'snapshot_page_seconds', time.perf_counter() - start_time, mode=snapshot['mode']
+        )
+        metrics.observe(
+            'snapshot_payload_bytes', snapshot['payload_bytes'], size_buckets, mode=snapshot['mode']
+        )
+    
+    # retrieve article_url, extracted text or screenshots, payload size and wall time
+    return snapshot
+
+
+def snapshot_article(
+    article_urls: list, 
+    folder_path: str, 
+    domain=None, 
+    mode=snapshot_mode
+):
+    '''Take a snapshot of the articles on a single Selenium node'''
+    return snapshot_articles(article_urls, folder_path, [domain], mode)
+
+
+def snapshot_articles(
+    article_urls: list, 
+    folder_path: str, 
+    domains: list, 
+    mode=snapshot_mode,
+    pool=None,
+    on_snapshot=None
+):
+    '''Share the articles between Selenium nodes, each node pulls the next URL when it is free
+
+    on_snapshot(index, snapshot) is called from the node thread as soon as an article is done.
+    '''
+    pool = pool or get_webdriver_pool(domains)
+    work_queue = queue.Queue()
+    for index, article_url in enumerate(article_urls):
+        work_queue.put((index, article_url, 1))
+    
+    snapshot_list = [None] * len(article_urls)
+    node_stats = {
+        domain: {'articles': 0, 'busy': 0.0, 'slowest': 0.0} for domain in domains
+    }
+    
+    
+    def work(domain):
+        '''This function snapshots articles from the shared queue until it is empty'''
+        stats = node_stats[domain]
+        while True:
+            try:
+                index, article_url, attempt = work_queue.get_nowait()
+            except queue.Empty:
+                break
+            metrics.set_gauge('snapshot_queue_depth', work_queue.qsize())
             
-    try:
-        driver.quit()  # Close the browser
-    except:
-        pass
-    # retrieve article_url, general file name, total number of screenshots
-    return snapshot_list
-        
\ No newline at end of file
+            try:
+                driver = pool.acquire(domain)
+            except NodeUnavailable:
+                # give the article back to the healthy nodes
+                work_queue.put((index, article_url, attempt))
+                print(f"Selenium node {domain} is not available, the other nodes take its share")
+                break
+            
+            start_time = time.perf_counter()
+            snapshot = snapshot_one_article(driver, article_url, folder_path, mode)
+            elapsed = time.perf_counter() - start_time
+            
+            session_alive = 'error' not in snapshot or pool.is_alive(driver)
+            pool.release(domain, driver, failed=not session_alive)
+            if not session_alive:
+                pool.mark_unhealthy(domain)
+                if attempt < article_max_attempts:
+                    work_queue.put((index, article_url, attempt + 1))
+                    continue
+            
+            snapshot_list[index] = snapshot
+            if on_snapshot:
+                on_snapshot(index, snapshot)
+            stats['articles'] += 1
+            stats['busy'] += elapsed
+            stats['slowest'] = max(stats['slowest'], elapsed)
+    
+    
+    start_time = time.perf_counter()
+    # run again while articles were handed back and some node is still healthy
+    while not work_queue.empty() and pool.healthy_domains():
+        # the node threads keep the stage span as the parent of their article spans
+        threads = [
+            Thread(target=in_context(work), args=(domain,)) 
+            for domain in domains if domain in pool.healthy_domains()
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    wall_time = time.perf_counter() - start_time
+    
+    for domain, stats in node_stats.items():
+        throughput = stats['articles'] / stats['busy'] * 60 if stats['busy'] else 0.0
+        print(
+            f"Selenium node {domain}: {stats['articles']} articles, "
+            f"busy {stats['busy']:.1f}s, slowest article {stats['slowest']:.1f}s, "
+            f"{throughput:.1f} articles/min"
+        )
+    print(f"Snapshot wall time: {wall_time:.1f}s for {len(article_urls)} articles")
+    pool.report()
+    get_page_waiter().save()
+    
+    # articles left in the queue when no node could be reached
+    return [
+        snapshot or empty_snapshot(article_url)
+        for snapshot, article_url in zip(snapshot_list, article_urls)
+    ]
+
+
+def report_snapshot_modes(snapshot_list):
+    '''Print the payload size and the wall time per article of each extraction mode'''
+    measures = {
+        'text': [
+            (snapshot['payload_bytes'], snapshot['elapsed']) 
+            for snapshot in snapshot_list if snapshot.get('mode') == 'text'
+        ],
+        'screenshot': [
+            (snapshot['screenshot_bytes'], snapshot['screenshot_elapsed']) 
+            for snapshot in snapshot_list if 'screenshot_elapsed' in snapshot
+        ],
+    }
+    
+    report = {}
+    for mode, values in measures.items():
+        if not values:
+            continue
+        report[mode] = {
+            'articles': len(values),
+            'avg_payload_bytes': sum(value[0] for value in values) // len(values),
+            'avg_elapsed': round(sum(value[1] for value in values) / len(values), 3),
+        }
+        print(
+            f"{mode} mode: {report[mode]['articles']} articles, "
+            f"{report[mode]['avg_payload_bytes']} bytes and "
+            f"{report[mode]['avg_elapsed']}s per article"
+        )
+    return report
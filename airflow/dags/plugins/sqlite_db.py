@@ -0,0 +1,17 @@
+import contextlib
+import sqlite3
+
+
+@contextlib.contextmanager
+def connect(path, timeout=30, row_factory=None):
+    '''Open a SQLite connection, commit its transaction when the block succeeds and always close it
+
+    A sqlite3 connection used as a context manager only commits or rolls back, it stays open.
+    '''
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.row_factory = row_factory
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
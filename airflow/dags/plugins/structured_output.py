@@ -0,0 +1,298 @@
+import ast
+import json
+import re
+
+from dataclasses import asdict
+from dataclasses import dataclass
+from datetime import datetime
+
+
+zone_fields = ('buy_zone', 'sell_zone', 'stop_loss')
+
+# other names the model gives the zones, compared without case, spaces or underscores
+zone_aliases = {
+    'buyzone': 'buy_zone',
+    'buy': 'buy_zone',
+    'sellzone': 'sell_zone',
+    'sell': 'sell_zone',
+    'takeprofit': 'sell_zone',
+    'takeprofitzone': 'sell_zone',
+    'stoploss': 'stop_loss',
+    'stoplosszone': 'stop_loss',
+}
+
+pestel_dimensions = ('political', 'economic', 'social', 'technological', 'environmental', 'legal')
+impacts = ('bullish', 'bearish', 'neutral')
+
+fence_pattern = re.compile(r'```[a-zA-Z]*\s*(.*?)```', re.DOTALL)
+range_pattern = re.compile(r'^\s*(\$?[\d,.]+)\s*(?:-|–|to)\s*(\$?[\d,.]+)\s*$')
+
+
+def to_price(value):
+    '''Read a price written as 95000, "95,000" or "$95,000.5", None when it is not a number'''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(re.sub(r'[^\d.\-]', '', str(value)))
+    except ValueError:
+        return None
+
+
+def closing_index(text, start):
+    '''Index just after the bracket closing the one at start, None when the answer is cut'''
+    depth, in_string, escaped = 0, False, False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return None
+
+
+def json_candidates(text):
+    '''Pieces of an answer that may hold its JSON, the most likely first'''
+    yield text.strip()
+    for match in fence_pattern.finditer(text):
+        yield match.group(1).strip()
+    # the first object or list of a chatty answer
+    for opener in '{[':
+        start = text.find(opener)
+        if start >= 0:
+            yield text[start:closing_index(text, start)]
+
+
+def repair_json(candidate):
+    '''Fix the usual small defects of generated JSON: curly quotes and trailing commas'''
+    candidate = (
+        candidate
+        .replace('“', '"').replace('”', '"')
+        .replace('‘', "'").replace('’', "'")
+    )
+    return re.sub(r',\s*([}\]])', r'\1', candidate)
+
+
+def load_json(text, expected=(dict, list)):
+    '''Extract the JSON value of an answer, repairing it locally, ValueError when there is none'''
+    if not isinstance(text, str):
+        raise ValueError("The answer is not a text")
+    for candidate in json_candidates(text):
+        for attempt in (candidate, repair_json(candidate)):
+            try:
+                value = json.loads(attempt)
+            except ValueError:
+                try:
+                    # single quotes, True/None written the Python way
+                    value = ast.literal_eval(attempt)
+                except (ValueError, SyntaxError, MemoryError, RecursionError):
+                    continue
+            if isinstance(value, expected):
+                return value
+    raise ValueError("No JSON value found in the answer")
+
+
+@dataclass
+class PriceZone:
+    min: float
+    max: float
+
+    @classmethod
+    def from_value(cls, value):
+        '''Read a zone written as {"min", "max"}, [min, max], "min - max" or a single price'''
+        if isinstance(value, dict):
+            bounds = {str(key).lower(): bound for key, bound in value.items()}
+            low = to_price(bounds.get('min', bounds.get('low', bounds.get('from'))))
+            high = to_price(bounds.get('max', bounds.get('high', bounds.get('to'))))
+        elif isinstance(value, (list, tuple)) and value:
+            low, high = to_price(value[0]), to_price(value[-1])
+        elif isinstance(value, str) and range_pattern.match(value):
+            low, high = (to_price(bound) for bound in range_pattern.match(value).groups())
+        else:
+            low = high = to_price(value)
+        if low is None and high is None:
+            raise ValueError(f"No price in the zone {value!r}")
+        low = high if low is None else low
+        high = low if high is None else high
+        if low <= 0:
+            raise ValueError(f"The zone {value!r} has no positive price")
+        # bounds given in the wrong order are swapped
+        return cls(min(low, high), max(low, high))
+
+
+@dataclass
+class Recommendation:
+    buy_zone: PriceZone
+    sell_zone: PriceZone
+    stop_loss: PriceZone
+
+    @classmethod
+    def from_json(cls, data):
+        '''Validate a parsed answer, ValueError when a zone is missing or has no price'''
+        if not isinstance(data, dict):
+            raise ValueError("The recommendation is not a JSON object")
+        zones = {}
+        for key, value in data.items():
+            name = re.sub(r'[^a-z]', '', str(key).lower())
+            field = zone_aliases.get(name)
+            if field and field not in zones:
+                zones[field] = PriceZone.from_value(value)
+        missing = [field for field in zone_fields if field not in zones]
+        if missing:
+            raise ValueError(f"The recommendation has no {', '.join(missing)}")
+        return cls(**zones)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def parse_recommendation(text):
+    '''Parse a buy/sell/stop loss answer into a validated dict stamped with the current date'''
+    recommendation = Recommendation.from_json(load_json(text, dict)).to_dict()
+    recommendation['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return recommendation
+
+
+def parse_id_list(text):
+    '''Parse a list of article ids, "3" and "id 3" are read as 3 and the other items dropped'''
+    value = load_json(text, (list, dict))
+    if isinstance(value, dict):
+        # e.g. {"ids": [1, 3]}
+        value = next((item for item in value.values() if isinstance(item, list)), None)
+        if value is None:
+            raise ValueError("The answer holds no list of ids")
+    ids = []
+    for item in value:
+        if isinstance(item, dict):
+            item = item.get('id')
+        if isinstance(item, bool):
+            continue
+        if isinstance(item, int):
+            ids.append(item)
+        elif isinstance(item, float) and item.is_integer():
+            ids.append(int(item))
+        elif isinstance(item, str):
+            digits = re.findall(r'\d+', item)
+            if len(digits) == 1:
+                ids.append(int(digits[0]))
+    return ids
+
+
+@dataclass
+class PestelPoint:
+    point: str
+    impact: str
+    article_ids: list
+
+    @classmethod
+    def from_value(cls, value):
+        '''Read a point written as {"point", "impact", "article_ids"} or as its text only'''
+        if isinstance(value, str):
+            value = {'point': value}
+        if not isinstance(value, dict):
+            raise ValueError(f"The PESTEL point {value!r} is not an object")
+        text = value.get('point') or value.get('text') or value.get('summary')
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError(f"The PESTEL point {value!r} has no text")
+        impact = str(value.get('impact') or '').lower()
+        ids = value.get('article_ids', value.get('ids')) or []
+        return cls(
+            ' '.join(text.split()),
+            next((name for name in impacts if impact.startswith(name[:4])), 'neutral'),
+            [str(item) for item in (ids if isinstance(ids, list) else [ids])]
+        )
+
+
+@dataclass
+class PestelState:
+    dimensions: dict
+    sentiment: str
+
+    @classmethod
+    def from_json(cls, data):
+        '''Validate an updated PESTEL state, the points that cannot be read are dropped'''
+        if not isinstance(data, dict):
+            raise ValueError("The PESTEL state is not a JSON object")
+        # the dimensions may also be given at the top level, e.g. {"Political": [...]}
+        found = data.get('dimensions') if isinstance(data.get('dimensions'), dict) else data
+        dimensions = {name: [] for name in pestel_dimensions}
+        for key, points in found.items():
+            name = next(
+                (name for name in pestel_dimensions if str(key).lower().startswith(name[:4])), None
+            )
+            if name is None or not isinstance(points, list):
+                continue
+            for point in points:
+                try:
+                    dimensions[name].append(PestelPoint.from_value(point))
+                except ValueError:
+                    continue
+        if not any(dimensions.values()):
+            raise ValueError("The PESTEL state has no point")
+        sentiment = data.get('sentiment')
+        return cls(dimensions, sentiment if isinstance(sentiment, str) else '')
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def parse_pestel_state(text):
+    '''Parse an updated PESTEL state into a validated dict'''
+    return PestelState.from_json(load_json(text, dict)).to_dict()
+
+
+price_zone_schema = {
+    'type': 'OBJECT',
+    'properties': {'min': {'type': 'NUMBER'}, 'max': {'type': 'NUMBER'}},
+    'required': ['min', 'max'],
+}
+
+recommendation_schema = {
+    'type': 'OBJECT',
+    'properties': {field: price_zone_schema for field in zone_fields},
+    'required': list(zone_fields),
+}
+
+id_list_schema = {'type': 'ARRAY', 'items': {'type': 'INTEGER'}}
+
+pestel_point_schema = {
+    'type': 'OBJECT',
+    'properties': {
+        'point': {'type': 'STRING'},
+        'impact': {'type': 'STRING', 'enum': list(impacts)},
+        'article_ids': {'type': 'ARRAY', 'items': {'type': 'STRING'}},
+    },
+    'required': ['point', 'impact', 'article_ids'],
+}
+
+pestel_state_schema = {
+    'type': 'OBJECT',
+    'properties': {
+        'dimensions': {
+            'type': 'OBJECT',
+            'properties': {
+                name: {'type': 'ARRAY', 'items': pestel_point_schema} for name in pestel_dimensions
+            },
+            'required': list(pestel_dimensions),
+        },
+        'sentiment': {'type': 'STRING'},
+    },
+    'required': ['dimensions', 'sentiment'],
+}
+
+
+def json_generation_config(schema):
+    '''generationConfig asking Gemini for JSON following a response schema'''
+    return {'responseMimeType': 'application/json', 'responseSchema': schema}
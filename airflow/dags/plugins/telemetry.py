@@ -0,0 +1,304 @@
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+from plugins.settings import load_environment
+
+
+# Load environment variables from .env file
+load_environment()
+
+# spans.jsonl keeps the spans of every run, metrics/<stage>.prom the metrics of the last run of a stage
+telemetry_enabled = os.getenv('TELEMETRY', 'on').lower() not in ('off', 'false', '0')
+telemetry_path = os.getenv('TELEMETRY_PATH', '/opt/airflow/dags/stats/telemetry')
+
+# optional Prometheus pushgateway, e.g. http://pushgateway:9091
+pushgateway_url = os.getenv('TELEMETRY_PUSHGATEWAY')
+
+job_name = 'recommend_order_etl'
+
+# seconds
+duration_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# bytes
+size_buckets = (1_000, 10_000, 100_000, 500_000, 1_000_000, 5_000_000, 20_000_000)
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_write_lock = threading.Lock()
+
+
+def run_trace_id(run_id):
+    '''Trace id shared by every task of a DAG run, each task being its own process'''
+    return hashlib.sha256(f'trace:{run_id}'.encode('utf-8')).hexdigest()[:32]
+
+
+def run_span_id(run_id):
+    '''Id of the run span, parent of the stage spans'''
+    return hashlib.sha256(f'run:{run_id}'.encode('utf-8')).hexdigest()[:16]
+
+
+class Span:
+    '''A timed operation: run, stage, item (an article, a source) or call (a Gemini request)'''
+    def __init__(self, name, kind, trace_id, parent_id=None, span_id=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = span_id or uuid.uuid4().hex[:16]
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.start_time = time.time()
+        self.end_time = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': round(self.end_time - self.start_time, 6),
+            'status': self.status,
+            'attributes': self.attributes,
+        }
+
+
+def write_span(span):
+    '''Append a finished span to spans.jsonl'''
+    if not telemetry_enabled:
+        return
+    line = json.dumps(span.record(), default=str)
+    try:
+        with _write_lock:
+            os.makedirs(telemetry_path, exist_ok=True)
+            with open(os.path.join(telemetry_path, 'spans.jsonl'), 'a') as f:
+                f.write(line + '\n')
+    except OSError as e:
+        print(f"Could not write the span {span.name}: {e}")
+
+
+@contextmanager
+def span(name, kind='item', trace_id=None, parent_id=None, span_id=None, **attributes):
+    '''Time a block as a child of the current span, an exception marks it as failed'''
+    parent = _current_span.get()
+    current = Span(
+        name,
+        kind,
+        trace_id or (parent.trace_id if parent else uuid.uuid4().hex),
+        parent_id or (parent.span_id if parent else None),
+        span_id,
+        attributes
+    )
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = 'error'
+        current.set(error=f'{type(e).__name__}: {e}')
+        raise
+    finally:
+        current.end_time = time.time()
+        _current_span.reset(token)
+        write_span(current)
+
+
+def in_context(function):
+    '''Bind a function to a copy of the current context, so a new thread keeps the current span'''
+    context = contextvars.copy_context()
+    return functools.partial(context.run, function)
+
+
+def context_map(executor, function, items):
+    '''executor.map keeping the current span as the parent of the spans of every call'''
+    # a context can only be entered by one thread at a time, each call gets its own copy
+    items = list(items)
+    return executor.map(
+        lambda bound, item: bound(item), [in_context(function) for _ in items], items
+    )
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        f'{key}="{escape_label(value)}"' for key, value in sorted(labels.items())
+    ) + '}'
+
+
+class Metrics:
+    '''Counters, gauges and histograms of the process, written in the Prometheus text format'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=duration_buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                key, {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            )
+            for position, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][position] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def exposition(self, **common_labels):
+        '''The metrics in the Prometheus text format, with labels added to every series'''
+        lines = []
+        with self._lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    for (series_name, labels), value in sorted(
+                        series.items(), key=lambda item: str(item[0])
+                    ):
+                        if series_name == name:
+                            lines.append(f'{name}{label_text({**common_labels, **dict(labels)})} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (series_name, labels), histogram in sorted(
+                    self.histograms.items(), key=lambda item: str(item[0])
+                ):
+                    if series_name != name:
+                        continue
+                    labels = {**common_labels, **dict(labels)}
+                    for bound, count in zip(histogram['buckets'], histogram['counts']):
+                        lines.append(f'{name}_bucket{label_text({**labels, "le": bound})} {count}')
+                    lines.append(f'{name}_bucket{label_text({**labels, "le": "+Inf"})} {histogram["count"]}')
+                    lines.append(f'{name}_sum{label_text(labels)} {round(histogram["sum"], 6)}')
+                    lines.append(f'{name}_count{label_text(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of the process, each DAG task runs in its own process
+metrics = Metrics()
+
+
+def flush_metrics(stage, batch=None):
+    '''Write the metrics of a stage, or of one batch of a mapped stage, to metrics/ and push them to the gateway'''
+    if not telemetry_enabled:
+        return
+    # every batch of a mapped stage keeps its own file and grouping key
+    labels = {'stage': stage} if batch is None else {'stage': stage, 'batch': batch}
+    text = metrics.exposition(**labels)
+    name = stage if batch is None else f'{stage}-batch-{batch}'
+    folder = os.path.join(telemetry_path, 'metrics')
+    try:
+        os.makedirs(folder, exist_ok=True)
+        file_path = os.path.join(folder, f'{name}.prom')
+        # a textfile collector never reads a half-written file
+        with open(file_path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(file_path + '.tmp', file_path)
+    except OSError as e:
+        print(f"Could not write the metrics of {name}: {e}")
+    if pushgateway_url:
+        # imported here, the DAG file imports this module every time it is parsed
+        import requests
+
+        grouping = '/'.join(f'{key}/{value}' for key, value in labels.items())
+        try:
+            requests.put(
+                f'{pushgateway_url.rstrip("/")}/metrics/job/{job_name}/{grouping}',
+                data=text.encode('utf-8'),
+                timeout=5
+            )
+        except requests.RequestException as e:
+            print(f"Could not push the metrics of {name}: {e}")
+
+
+def traced_stage(function):
+    '''Run a DAG callable in a stage span of its run and write the stage metrics afterwards'''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        ti = kwargs.get('ti') or next((arg for arg in args if hasattr(arg, 'run_id')), None)
+        run_id = ti.run_id if ti else 'manual'
+        stage = function.__name__
+        # the batch of a mapped task instance
+        batch = kwargs.get('batch')
+        metrics.reset()
+        start_time = time.perf_counter()
+        try:
+            with span(
+                stage,
+                kind='stage',
+                trace_id=run_trace_id(run_id),
+                parent_id=run_span_id(run_id),
+                run_id=run_id
+            ) as stage_span:
+                result = function(*args, **kwargs)
+                if isinstance(result, (int, float)):
+                    stage_span.set(result=result)
+                return result
+        finally:
+            metrics.observe('dag_stage_seconds', time.perf_counter() - start_time)
+            flush_metrics(stage, batch)
+    return wrapper
+
+
+def stage_durations(run_id):
+    '''Seconds spent in each stage of a run, read from spans.jsonl'''
+    trace_id = run_trace_id(run_id)
+    durations = {}
+    file_path = os.path.join(telemetry_path, 'spans.jsonl')
+    if not os.path.exists(file_path):
+        return durations
+    with open(file_path) as f:
+        for line in f:
+            if trace_id not in line:
+                continue
+            record = json.loads(line)
+            if record['trace_id'] == trace_id and record['kind'] == 'stage':
+                durations[record['name']] = durations.get(record['name'], 0.0) + record['duration']
+    return durations
+
+
+def end_run(run_id, started_at=None):
+    '''Write the run span, parent of every stage span, and print the slowest stages'''
+    durations = stage_durations(run_id)
+    run_span = Span(
+        job_name,
+        'run',
+        run_trace_id(run_id),
+        span_id=run_span_id(run_id),
+        attributes={'run_id': run_id, 'stage_seconds': durations}
+    )
+    if started_at:
+        run_span.start_time = started_at
+    run_span.end_time = time.time()
+    write_span(run_span)
+
+    for stage, duration in sorted(durations.items(), key=lambda item: -item[1]):
+        print(f"Stage {stage}: {duration:.1f}s")
+    return durations
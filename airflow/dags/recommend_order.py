@@ -1,50 +1,49 @@
+import fcntl
 import json
 import os
 import random
-
-import pandas as pd
-
+import time
 
 from datetime import datetime
 from datetime import timedelta
-from threading import Thread
+from datetime import timezone
 
 from airflow.providers.standard.operators.python import PythonOperator
+from airflow.providers.standard.sensors.python import PythonSensor
 from airflow.sdk import DAG
-from dotenv import load_dotenv
 
-from plugins.crawl_news import crawl_api_news
-from plugins.crawl_news import CrawlRSSNews
-from plugins.gemini_model import AnalyzeAI
-from plugins.gemini_model import FilterArticle
-from plugins.gemini_model import InvestmentAI
-from plugins.gemini_model import SummarizeArticle
-from plugins.snapshot import snapshot_article
-from plugins.snapshot import snapshot_chart
+# only the settings and telemetry are imported while the scheduler parses the DAG,
+# the callables import the plugins they need, with pandas, Selenium and the HTTP clients
+from plugins.settings import article_batch_size
+from plugins.settings import chart_source
+from plugins.settings import final_recommendation_mode
+from plugins.settings import pipeline_mode
+from plugins.settings import selenium_domains
+from plugins.settings import summary_batch_poll
+from plugins.settings import summary_batch_timeout
+from plugins.settings import summary_mode
+from plugins.settings import warning_email
+from plugins.telemetry import traced_stage
 
 
-# Load environment variables from .env file
-load_dotenv()
-
 images_folder_path = '/opt/airflow/dags/images'
 buffer_memory_folder_path = '/opt/airflow/dags/buffer_memory'
+stats_folder_path = '/opt/airflow/dags/stats'
 
-# Selenium server configuration
-domain_selenium0 = os.getenv('DOMAIN_SELENIUM0') 
-domain_selenium1 = os.getenv('DOMAIN_SELENIUM1') 
-domain_selenium2 = os.getenv('DOMAIN_SELENIUM2')
-domain_selenium3 = os.getenv('DOMAIN_SELENIUM3')
-    
-# list of all the ports
-domains_selenium = [
-    domain_selenium0, 
-    domain_selenium1, 
-    domain_selenium2, 
-    domain_selenium3
-]
+# Selenium server configuration, from SELENIUM_DOMAINS or DOMAIN_SELENIUMn
+domains_selenium = selenium_domains()
+domain_selenium0 = domains_selenium[0] if domains_selenium else None
+
+
+def article_batches(count, batch_size=article_batch_size, nodes=len(domains_selenium)):
+    '''This function splits the selected articles into the batches of the mapped tasks'''
+    # a batch runs on one Selenium node, a small run is still shared by every node
+    batch_size = max(min(batch_size, -(-count // max(nodes, 1))), 1)
+    return [
+        {'batch': batch, 'start': start, 'stop': min(start + batch_size, count)}
+        for batch, start in enumerate(range(0, count, batch_size))
+    ]
 
-# initial number_of_flow
-number_of_flow = 4
 
 def prepare_folder(folder_path: str, folder_name: str, is_clean:bool = True):
     '''This function cleans old data in a folder or creates a new folder.'''
@@ -66,75 +65,68 @@ def prepare_folder(folder_path: str, folder_name: str, is_clean:bool = True):
         print(f"{folder_name} folder cleaned.")
 
 
-def save_recommendation_to_parquet(recommendation):
-    """
-    This function is used to save the recommendation to a Parquet file.
-    """
-    # Flatten the JSON if necessary
-    recommendation_normalize = pd.json_normalize(recommendation)  
-    date = recommendation['date'].replace(' ','_').replace(':','_')
-    
-    # Save as Parquet
-    parquet_file_path =  \
-        f'/opt/airflow/dags/recommendations/recommendation_{date}.parquet'  
-    recommendation_normalize.to_parquet(parquet_file_path, index=False)
-    print(f"Recommendation saved to {parquet_file_path}")
-    
-
-def prepare_DAG():
+@traced_stage
+def prepare_DAG(ti):
     '''This function is used to prepare the DAG task.'''
+    from plugins.artifact_store import ArtifactStore
+
     folder_path = '/opt/airflow/dags'
     
     prepare_folder(folder_path=folder_path, folder_name='images')
     prepare_folder(folder_path=folder_path, folder_name='buffer_memory')
     prepare_folder(folder_path=folder_path, folder_name='recommendations', is_clean=False)
+    prepare_folder(folder_path=folder_path, folder_name='cache', is_clean=False)
+    prepare_folder(folder_path=folder_path, folder_name='stats', is_clean=False)
+    prepare_folder(folder_path=folder_path, folder_name='market_data', is_clean=False)
+    prepare_folder(folder_path=folder_path, folder_name='artifacts', is_clean=False)
+    
+    # the stages of every run share one artifact store, old runs are pruned
+    store = ArtifactStore()
+    store.start_run(ti.run_id)
+    pruned = store.prune()
+    print(f"{pruned} old runs pruned from the artifact store.")
 
     
+@traced_stage
 def crawl_relate_news(ti):
     """
     This function is used to crawl macroeconomics and cryptocurrency news articles from different sources.
     """
-    # Initialize article_urls
-    article_urls = []
-    
-    
-    def filter_article(sub_articles: list):
-        nonlocal article_urls
-        filter_article = FilterArticle(sub_articles)
-        article_urls += filter_article.AI_filter_article()
-    
+    from plugins.article_index import ArticleIndex
+    from plugins.article_index import index_enabled
+    from plugins.artifact_store import ArtifactStore
+    from plugins.batching import filter_articles
+    from plugins.crawl_news import crawl_sources
+    from plugins.crawl_news import news_sources
+    from plugins.dedup import dedup_articles
+    from plugins.gemini_model import gemini_client
+
+    # only the articles not seen by the previous runs go downstream
+    index = ArticleIndex() if index_enabled else None
     
-    # Initialize the news crawler
-    news_crawler = CrawlRSSNews()
+    # every RSS, Atom and NewsAPI source is read at the same time
+    articles = list(crawl_sources(news_sources(), index=index, run_id=ti.run_id))
     
-    articles = news_crawler.parse_data() + crawl_api_news()
-    log_full_articles_path = os.path.join(buffer_memory_folder_path, 'article')
+    # the same story can be listed by several sources under different titles and links
+    crawled_count = len(articles)
+    articles, cluster_sizes = dedup_articles(articles)
     
-    # save the articles to buffer memory as json file
-    with open(log_full_articles_path, 'w') as json_file:
-        json.dump(articles, json_file, indent=4)
+    # save the articles to the artifact store
+    store = ArtifactStore()
+    store.start_run(ti.run_id)
+    store.add_articles(ti.run_id, articles)
     print("number of articles before filtering:", len(articles))
     
-    # Filter the articles in batches to avoid wrong issues
-
-    step = len(articles) // number_of_flow
-    threads = []
-    for i in range (number_of_flow):
-        # determine the indices of the list this thread will handle             
-        start = i * step                                                  
-        # special case on the last chunk to account for uneven splits           
-        end = None if i+1 == number_of_flow else (i+1) * step
-        sub_articles = articles[start:end].copy()
-        threads.append(                                                         
-            Thread(
-                target=filter_article, args=(sub_articles,)
-            )
-        )         
-        threads[-1].start() # start the thread we just created           
-               
-    # wait for all threads to finish                                            
-    for t in threads:                                                           
-        t.join()
+    # Filter the articles in batches packed up to the token budget
+    article_urls = filter_articles(articles)
+    
+    # every duplicate of a kept story would have been snapshotted and summarized too
+    avoided = sum(cluster_sizes.get(link, 1) - 1 for link in article_urls)
+    print(
+        f"Deduplication avoided {crawled_count - len(articles)} filtered articles, "
+        f"{avoided} browser snapshots and {avoided} summary requests"
+    )
+    gemini_client.report()
         
     print("number of articles after filtering:", len(article_urls))
     
@@ -142,248 +134,426 @@ def crawl_relate_news(ti):
     random.shuffle(article_urls)
     # article_urls = article_urls[:4]
     
-    output_file_path = os.path.join(buffer_memory_folder_path, 'article_urls')
-    
-    # save the articles urls to buffer memory as json file
-    with open(output_file_path, 'w') as json_file:
-        json.dump(article_urls, json_file, indent=4)
-
-    print(f"Data saved to {output_file_path}")
+    # mark the articles to snapshot in the artifact store
+    store.select_articles(ti.run_id, article_urls)
     
-    ti.xcom_push(
-        key='article_urls',     
-        value=output_file_path
-    )
     ti.xcom_push(
         key='number_of_articles',     
         value=len(article_urls)
     )
     
+    # the mapped tasks get one batch of the selected articles each
+    return article_batches(len(article_urls))
     
-def snapshot_article_flow(ti):
-    """This function is used to snapshot the articles"""
-    article_urls_path = ti.xcom_pull(task_ids='crawl_news', key='article_urls')
-    number_of_articles = ti.xcom_pull(task_ids='crawl_news', key='number_of_articles')
     
-    print(article_urls_path)
-    with open(article_urls_path, 'r') as json_file:
-        article_urls = json.load(json_file)
+@traced_stage
+def snapshot_article_flow(ti, batch=None, start=0, stop=None):
+    """This function is used to snapshot the articles of a batch, all of them when batch is None"""
+    from plugins.artifact_store import ArtifactStore
+    from plugins.snapshot import get_webdriver_pool
+    from plugins.snapshot import report_snapshot_modes
+    from plugins.snapshot import snapshot_articles
+
+    store = ArtifactStore()
+    article_urls = store.selected_links(ti.run_id)[start:stop]
+    
+    pool = get_webdriver_pool(domains_selenium)
+    domains = domains_selenium
+    if batch is not None and domains_selenium:
+        # a batch runs on one node, the first free one from the node of the batch,
+        # the next one when the batch is retried
+        try_number = getattr(ti, 'try_number', 1) or 1
+        preferred = domains_selenium[(batch + try_number - 1) % len(domains_selenium)]
+        domains = [pool.claim_free(preferred)]
+    
+    # every node pulls the next article as soon as it is free, 
+    # each snapshot is stored as soon as it is done
+    snapshot_list = snapshot_articles(
+        article_urls=article_urls, 
+        folder_path=images_folder_path, 
+        domains=domains,
+        pool=pool,
+        on_snapshot=lambda index, snapshot: store.add_snapshot(ti.run_id, snapshot)
+    )
+    report_snapshot_modes(snapshot_list)
+    
+    # nothing captured: the batch is retried by Airflow instead of the whole stage
+    if article_urls and not any(
+        snapshot.get('text') or snapshot['screenshots_path'] for snapshot in snapshot_list
+    ):
+        raise RuntimeError(f"No article of batch {batch} could be captured on {domains}")
+    
+    return len(snapshot_list)
+    
+    
+def save_preprocess_stats(run_id, batch, stats):
+    '''This function keeps the byte counts of every run, a retry replaces the line of its batch'''
+    stats['run_id'] = run_id
+    stats['batch'] = batch
+    stats['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open(os.path.join(stats_folder_path, 'preprocess_stats.jsonl'), 'a+') as f:
+        # the batches of a run may write at the same time
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        entries = [json.loads(line) for line in f if line.strip()]
+        lines = [
+            json.dumps(entry) + '\n' for entry in entries
+            if (entry.get('run_id'), entry.get('batch')) != (run_id, batch)
+        ]
+        f.seek(0)
+        f.truncate()
+        f.writelines(lines + [json.dumps(stats) + '\n'])
+    
+    
+@traced_stage
+def preprocess_snapshot_flow(ti, batch=None, start=0, stop=None):
+    '''This function crops, deduplicates and re-encodes the screenshots before uploading them'''
+    from plugins.artifact_store import ArtifactStore
+    from plugins.image_preprocess import preprocess_snapshots
 
-    number_of_selenium_domain = len(domains_selenium)
+    store = ArtifactStore()
+    article_urls = store.selected_links(ti.run_id)[start:stop]
+    snapshot_list = list(store.snapshots(ti.run_id, article_urls))
+        
+    stats = preprocess_snapshots(snapshot_list)
+    save_preprocess_stats(ti.run_id, batch, stats)
     
-    snapshot_list = []
+    # the snapshots now point to the tiles and are marked tiled
+    for snapshot in snapshot_list:
+        if snapshot.get('original_screenshots_path'):
+            store.add_snapshot(ti.run_id, snapshot)
     
+    return stats['tiles']
     
-    def get_snapshot_result(urls, domain_selenium):
-        '''This function is used to get data from the snapshot article'''
-        nonlocal snapshot_list
-        snapshot_list += snapshot_article(
-            article_urls=urls, 
-            folder_path=images_folder_path, 
-            domain=domain_selenium
-        )
     
+def summarize_snapshots(store, run_id, snapshot_list):
+    '''This function sends one summary request per article and returns how many succeeded'''
+    from plugins.gemini_model import gemini_client
+    from plugins.gemini_model import SummarizeArticle
+
     
-    step = number_of_articles // number_of_selenium_domain
-    threads = []
-    
-    for i in range (number_of_selenium_domain):
-        # determine the indices of the list this thread will handle             
-        start = i * step                                                  
-        # special case on the last chunk to account for uneven splits           
-        end = None if i+1 == number_of_selenium_domain else (i+1) * step
-        sub_articles = article_urls[start:end].copy()
-        threads.append(                                                         
-            Thread(
-                target=get_snapshot_result, 
-                args=(sub_articles, domains_selenium[i])
-            )
-        )         
-        threads[-1].start() # start the thread we just created        
-                  
-    # wait for all threads to finish                                            
-    for t in threads:                                                           
-        t.join()
-
-    output_snapshot_path = os.path.join(buffer_memory_folder_path,f'snapshot_list')
-    
-    # save the articles to buffer memory as json file
-    with open(os.path.join(output_snapshot_path), 'w') as json_file:
-        json.dump(snapshot_list, json_file, indent=4)
-    print(f"Data saved to {output_snapshot_path}")
-    
-    return output_snapshot_path
-    
-    
-def summarize_article_flow(ti):
-    '''This function is used to summerize article from its images'''
-    article_snapshot_urls = []
-    summarized_list = []
-    
-    
-    def get_result_summarize_article(sub_article_snapshot_urls):
-        '''This function is used to get the result from the summary function'''
-        nonlocal summarized_list
-        for snapshot in sub_article_snapshot_urls:
-            summarize_article=SummarizeArticle(snapshot['screenshots_path'])
-            summary = summarize_article.generate_summarize_article()
-            if summary:
-                summarized_list.append(summary)
-    
-    
-    article_snapshot_urls_path = ti.xcom_pull(
-            task_ids='snapshot_article_flow', 
-            key='return_value'
+    
+    async def summarize_article(snapshot):
+        '''This function summarizes an article and stores its summary once it is ready'''
+        summary = await SummarizeArticle(
+            snapshot['screenshots_path'], 
+            article_text=snapshot.get('text')
+        ).agenerate_summarize_article()
+        if summary:
+            store.add_summary(run_id, snapshot['url'], summary)
+        return summary
+    
+    
+    async def get_result_summarize_article():
+        '''This function keeps the summary requests in flight on one event loop'''
+        return await gemini_client.gather(
+            summarize_article(snapshot) for snapshot in snapshot_list
         )
-    with open(article_snapshot_urls_path, 'r') as json_file:
-        article_snapshot_urls = json.load(json_file)
-    
-    step = len(article_snapshot_urls) // number_of_flow
-    threads = []
-    for i in range (number_of_flow):
-        # determine the indices of the list this thread will handle             
-        start = i * step                                                  
-        # special case on the last chunk to account for uneven splits           
-        end = None if i+1 == number_of_flow else (i+1) * step
-        sub_article_snapshot_urls = article_snapshot_urls[start:end].copy()
-        threads.append(                                                         
-            Thread(
-                target=get_result_summarize_article, 
-                args=(sub_article_snapshot_urls,)
-            )
-        )         
-        threads[-1].start() # start the thread we just created   
-                       
-    # wait for all threads to finish                                            
-    for t in threads:                                                           
-        t.join()
-        
-    output_path = os.path.join(buffer_memory_folder_path,f'summarized_list')
     
-    with open(output_path, 'w') as text_file:
-        text_file.write("\n\n".join(summarized_list))
-        text_file.write('\n')
-    print(f"Data saved to {output_path}")
     
-    return output_path
+    summaries = gemini_client.run(get_result_summarize_article())
+    gemini_client.report()
     
+    return len([summary for summary in summaries if summary])
+
+
+@traced_stage
+def summarize_article_flow(ti, batch=None, start=0, stop=None):
+    '''This function is used to summerize article from its text or its images'''
+    from plugins.artifact_store import ArtifactStore
+    from plugins.gemini_batch import GeminiBatch
+    from plugins.gemini_model import SummarizeArticle
+
+    store = ArtifactStore()
+    article_urls = store.selected_links(ti.run_id)[start:stop]
+    snapshot_list = [
+        snapshot for snapshot in store.snapshots(ti.run_id, article_urls)
+        if snapshot.get('text') or snapshot['screenshots_path']
+    ]
+    
+    if summary_mode != 'batch':
+        return summarize_snapshots(store, ti.run_id, snapshot_list)
+    
+    # the summaries already cached are stored now, the others are sent in batch jobs
+    gemini_batch = GeminiBatch()
+    cached_summaries, payloads = gemini_batch.cached(
+        {
+            snapshot['url']: SummarizeArticle(
+                snapshot['screenshots_path'], 
+                article_text=snapshot.get('text')
+            ).summarize_payload()
+            for snapshot in snapshot_list
+        },
+        call_type='summary'
+    )
+    for url, summary in cached_summaries.items():
+        store.add_summary(ti.run_id, url, summary)
     
-def analysis_market(ti):
-    '''This function will generate the analysis market'''
-    summarized_list = []
-    summarized_article_path = ti.xcom_pull(
-        task_ids=f'summarize_article_flow', 
-        key='return_value'
+    jobs, unsent = gemini_batch.submit(
+        payloads, display_name=f'summaries-{ti.run_id}', call_type='summary'
     )
-    with open(summarized_article_path, 'r') as text_file:
-        summarized_list = text_file.read()
-        
-    # analyze the market
-    analyze_AI = AnalyzeAI(summarized_list)
-    analyze = analyze_AI.AI_analysis_market()
+    print(
+        f"{len(cached_summaries)} cached summaries, "
+        f"{len(payloads) - len(unsent)} sent in {len(jobs)} batch jobs."
+    )
+    
+    # the direct requests stay the fallback of the jobs that could not be submitted
+    if unsent:
+        print(f"{len(unsent)} articles summarized with direct requests.")
+        summarize_snapshots(
+            store, ti.run_id, [snapshot for snapshot in snapshot_list if snapshot['url'] in unsent]
+        )
+    
+    ti.xcom_push(key='batch_jobs', value=jobs)
+    ti.xcom_push(key='submitted_at', value=time.time())
+    
+    return len(payloads)
+
 
-    output_path = os.path.join (buffer_memory_folder_path, 'analysis_market.txt')
+@traced_stage
+def summarize_batch_wait(ti):
+    '''This function collects the finished batch jobs and summarizes the articles left directly'''
+    from plugins.artifact_store import article_id
+    from plugins.artifact_store import ArtifactStore
+    from plugins.gemini_batch import GeminiBatch
+
+    jobs = ti.xcom_pull(task_ids='summarize_article_flow', key='batch_jobs') or []
+    submitted_at = ti.xcom_pull(task_ids='summarize_article_flow', key='submitted_at') or time.time()
+    store = ArtifactStore()
+    gemini_batch = GeminiBatch()
+    
+    summarized_ids = store.summarized_ids(ti.run_id)
+    unfinished = []
+    for job in jobs:
+        # a job collected by a previous poke is not downloaded again
+        if all(article_id(url) in summarized_ids for url in job['keys']):
+            continue
+        finished, summaries = gemini_batch.collect(job)
+        for url, summary in summaries.items():
+            store.add_summary(ti.run_id, url, summary)
+        if not finished:
+            unfinished.append(job)
+    
+    timed_out = time.time() - submitted_at > summary_batch_timeout
+    if unfinished and not timed_out:
+        print(f"{len(unfinished)} of {len(jobs)} batch jobs still running.")
+        return False
+    
+    for job in unfinished:
+        print(f"Batch {job['name']} timed out.")
+        gemini_batch.cancel(job['name'])
+    
+    # the articles the batch jobs did not summarize fall back to direct requests
+    summarized_ids = store.summarized_ids(ti.run_id)
+    missing = [
+        snapshot for snapshot in store.snapshots(ti.run_id)
+        if (snapshot.get('text') or snapshot['screenshots_path'])
+        and snapshot['article_id'] not in summarized_ids
+    ]
+    if missing:
+        print(f"{len(missing)} articles summarized with direct requests.")
+        summarize_snapshots(store, ti.run_id, missing)
+    return True
+    
+    
+@traced_stage
+def gather_summaries(ti):
+    '''This function gathers the results of the mapped batches before the analysis'''
+    from plugins.artifact_store import article_id
+    from plugins.artifact_store import ArtifactStore
+
+    store = ArtifactStore()
+    article_urls = store.selected_links(ti.run_id)
+    snapshot_ids = {snapshot['article_id'] for snapshot in store.snapshots(ti.run_id)}
+    summarized_ids = store.summarized_ids(ti.run_id)
+    
+    # the articles of a failed batch are only missing from the analysis
+    missing = [url for url in article_urls if article_id(url) not in summarized_ids]
+    print(
+        f"{len(article_urls)} selected articles, {len(snapshot_ids)} snapshots, "
+        f"{len(summarized_ids)} summaries, {len(missing)} articles missing"
+    )
+    for url in missing:
+        print(f"Not summarized: {url}")
     
-    # save the analysis result
-    with open(output_path, 'w') as f:
-        f.write(analyze)
-    print(f"Analysis result saved to {output_path}")
+    return len(summarized_ids)
     
-    return output_path
     
+@traced_stage
+def snapshot_summarize_stream_flow(ti):
+    '''This function snapshots and summarizes the articles in one streaming pipeline'''
+    from plugins.artifact_store import ArtifactStore
+    from plugins.gemini_model import gemini_client
+    from plugins.image_preprocess import preprocess_stats
+    from plugins.pipeline import stream_snapshot_summarize
+    from plugins.snapshot import report_snapshot_modes
 
-def opinion_order(domain_selenium: str, ti):
-    '''This function will recommend the orders in order to determine at the final order'''
+    store = ArtifactStore()
     
     
-    def push_output_to_Xcom(investment_AI, counter):
-        '''This function pushes all order recommendations into the task instance (ti)'''
-        recommendation = investment_AI.generate_opinion_investment_advice()
-        if recommendation:
-            save_recommendation_to_parquet(recommendation)
-        
-        ti.xcom_push(
-            key=f'return_value{counter}',
-            value=recommendation
-        )
-        
+    def save_article(snapshot, summary):
+        '''This function stores the snapshot and the summary of an article once it is done'''
+        store.add_snapshot(ti.run_id, snapshot)
+        if summary:
+            store.add_summary(ti.run_id, snapshot['url'], summary)
+    
+    
+    snapshot_list, summaries = stream_snapshot_summarize(
+        article_urls=store.selected_links(ti.run_id), 
+        folder_path=images_folder_path, 
+        domains=domains_selenium,
+        on_summary=save_article
+    )
+    report_snapshot_modes(snapshot_list)
+    save_preprocess_stats(ti.run_id, None, preprocess_stats(snapshot_list))
+    gemini_client.report()
+    
+    return len([summary for summary in summaries if summary])
+    
+    
+@traced_stage
+def analysis_market(ti):
+    '''This function will generate the analysis market'''
+    from plugins.artifact_store import ArtifactStore
+    from plugins.batching import analyze_market
+    from plugins.batching import update_market_state
+    from plugins.gemini_model import gemini_client
+    from plugins.market_state import analysis_mode
+    from plugins.market_state import load_state
+    from plugins.market_state import render_state
+
+    store = ArtifactStore()
+
+    if analysis_mode == 'incremental':
+        # only the articles the previous PESTEL state does not know are sent, with that state
+        state = load_state(store, ti.run_id)
+        new_articles = [
+            (article, summary) for article, summary in store.article_summaries(ti.run_id)
+            if article not in state['articles']
+        ]
+        state = update_market_state(state, new_articles)
+        store.set_analysis(ti.run_id, 'pestel_state', json.dumps(state))
+        analyze = render_state(state)
+    else:
+        # analyze the market, in token-bounded shards merged afterwards when the summaries are many
+        analyze = analyze_market(store.summaries(ti.run_id))
+    gemini_client.report()
+
+    # save the analysis result
+    store.set_analysis(ti.run_id, 'market', analyze)
+    print(f"Analysis result saved for {ti.run_id}")
+    
+    return len(analyze)
+    
+
+def take_chart_image(domain_selenium: str):
+    '''This function renders the chart from local klines, or snapshots it on Binance'''
+    from plugins.market_data import render_btc_chart
+    from plugins.snapshot import snapshot_chart
+
+    if chart_source == 'klines':
+        image_path = render_btc_chart(folder_path=images_folder_path)
+        if image_path:
+            return image_path
+        print("Chart rendering failed, fall back to the Binance snapshot.")
         
-    # take a snapshot of the chart
-    image_path = snapshot_chart(
+    return snapshot_chart(
         folder_path=images_folder_path,
         domain=domain_selenium
     )
     
-    analysis_market_path = ti.xcom_pull(
-        task_ids='analysis_market',
-        key='return_value'
-    )
-    with open(analysis_market_path, 'r') as text_file:
-        market_analysis = text_file.read()
+
+@traced_stage
+def opinion_order(domain_selenium: str, ti):
+    '''This function will recommend the orders in order to determine at the final order'''
+    from plugins.artifact_store import ArtifactStore
+    from plugins.ensemble import run_opinion_ensemble
+    from plugins.gemini_model import gemini_client
+    from plugins.gemini_model import InvestmentAI
+    from plugins.recommendation_store import save_recommendation
+
+    # render or snapshot the chart, recommend_order reuses it
+    image_path = take_chart_image(domain_selenium)
+    ti.xcom_push(key='chart_path', value=image_path)
+    
+    market_analysis = ArtifactStore().analysis(ti.run_id, 'market')
         
-    # Generate recommendation using InvestmentAI
-    threads = []
+    # Generate recommendations using InvestmentAI, by waves until they agree
     investment_AI = InvestmentAI(image_path, market_analysis=market_analysis)
-    for i in range(number_of_flow):
-        threads.append(                                                         
-            Thread(
-                target=push_output_to_Xcom, 
-                args=(investment_AI,i,)
-            )
-        )    
-        threads[-1].start() # start the thread we just created                  
-    # wait for all threads to finish                                            
-    for t in threads:                                                           
-        t.join()
+    opinions, agreed = gemini_client.run(run_opinion_ensemble(investment_AI, gemini_client))
+    gemini_client.report()
+    
+    for sample, recommendation in opinions:
+        save_recommendation(recommendation, ti.run_id, 'opinion', sample=sample)
+    
+    # push all order recommendations into the task instance (ti)
+    ti.xcom_push(key='opinions', value=[recommendation for _, recommendation in opinions])
+    ti.xcom_push(key='opinions_agreed', value=agreed)
     
 
+@traced_stage
 def recommend_order(ti):
     """
-    This function is used to take a snapshot of the chart and generate a recommendation using InvestmentAI.
+    This function is used to merge the opinions into the final recommendation, locally or with InvestmentAI.
     """
-    
-    # Initalize the opinion recommendations
-    recommendations = []
-    for i in range (number_of_flow):
-        opinion_idea = ti.xcom_pull(
-            task_ids='opinion_order', key=f'return_value{i}'
-        ) 
-        recommendations.append(opinion_idea)
-    
+    from plugins.artifact_store import ArtifactStore
+    from plugins.ensemble import aggregate_opinions
+    from plugins.gemini_model import gemini_client
+    from plugins.gemini_model import InvestmentAI
+    from plugins.recommendation_store import save_recommendation
+
+    recommendations = ti.xcom_pull(task_ids='opinion_order', key='opinions') or []
+    agreed = ti.xcom_pull(task_ids='opinion_order', key='opinions_agreed')
     print(f"Recommendations: {recommendations}")
     
-    # Generate a final recommendation using InvestmentAI
-    image_path = snapshot_chart(
-        folder_path=images_folder_path,
-        domain=domain_selenium0
-    )
+    # median zones of the opinions, with their dispersion
+    recommendation = aggregate_opinions(recommendations)
     
-    analysis_market_path = ti.xcom_pull(
-        task_ids='analysis_market',
-        key='return_value'
+    use_llm = final_recommendation_mode == 'llm' or (
+        final_recommendation_mode == 'auto' and not agreed
     )
-    
-    with open(analysis_market_path, 'r') as text_file:
-        market_analysis = text_file.read()
+    if use_llm or recommendation is None:
+        # Generate a final recommendation using InvestmentAI on the chart of the opinions
+        image_path = ti.xcom_pull(task_ids='opinion_order', key='chart_path')
+        if not image_path or not os.path.exists(image_path):
+            image_path = take_chart_image(domain_selenium0)
         
-    investment_AI = InvestmentAI(
-        image_path=image_path, 
-        recommendation_opinions=recommendations, 
-        market_analysis=market_analysis
-    )
-    recommendation = investment_AI.generate_final_investment_advice()
+        investment_AI = InvestmentAI(
+            image_path=image_path, 
+            recommendation_opinions=recommendations, 
+            market_analysis=ArtifactStore().analysis(ti.run_id, 'market')
+        )
+        recommendation = investment_AI.generate_final_investment_advice() or recommendation
+        gemini_client.report()
+    
     if recommendation:
-        save_recommendation_to_parquet(recommendation)
+        save_recommendation(recommendation, ti.run_id, 'final')
+
+
+@traced_stage
+def compact_recommendations_flow(ti):
+    '''This function merges the small recommendation files of every partition'''
+    from plugins.artifact_store import ArtifactStore
+    from plugins.recommendation_store import compact_recommendations
+    from plugins.telemetry import end_run
+
+    removed = compact_recommendations()
+    print(f"{removed} recommendation files merged.")
     
+    # the last task of the run closes its trace and prints the slowest stages
+    end_run(ti.run_id, ArtifactStore().run_started_at(ti.run_id))
+    
+
 # Define or Instantiate DAG
 dag = DAG(
     dag_id = 'recommend_order_etl',
-    start_date = datetime.now() - timedelta(days=1),
+    # a fixed date, catchup is off so the first run is the next schedule after the deployment
+    start_date = datetime(2025, 1, 1, tzinfo=timezone.utc),
     schedule = '30 0 * * *',
     default_args = {
         "retries": 2, 
         "retry_delay": timedelta(minutes = 5),
-        "email": os.getenv('WARNING_EMAIL'),
+        "email": warning_email,
         "email_on_success": True,
     },
     dagrun_timeout = timedelta(hours=2),
@@ -404,19 +574,76 @@ crawl_news_task = PythonOperator(
     dag=dag,
 )
 
-snapshot_article_flow_task = PythonOperator(
-    task_id='snapshot_article_flow',
-    python_callable=snapshot_article_flow,
-    # trigger_rule="all_success",
-    dag=dag,       
-)
+if pipeline_mode == 'stream':
+    # one task keeps the browsers and the summary requests busy at the same time
+    summary_tasks = [
+        PythonOperator(
+            task_id='snapshot_summarize_stream_flow',
+            python_callable=snapshot_summarize_stream_flow,
+            # trigger_rule="all_success",
+            dag=dag,
+        )
+    ]
+else:
+    # one mapped task instance per batch of articles, retried on its own,
+    # the executor spreads the instances over the workers
+    snapshot_article_flow_task = PythonOperator.partial(
+        task_id='snapshot_article_flow',
+        python_callable=snapshot_article_flow,
+        # at most one batch per Selenium node, each batch claims a free node when it starts
+        max_active_tis_per_dagrun=max(len(domains_selenium), 1),
+        dag=dag,       
+    ).expand(op_kwargs=crawl_news_task.output)
 
-summarize_article_flow_task = PythonOperator(
-    task_id='summarize_article_flow',
-    python_callable=summarize_article_flow,
-    # trigger_rule="all_success",
-    dag=dag,
-)
+    preprocess_snapshot_flow_task = PythonOperator.partial(
+        task_id='preprocess_snapshot_flow',
+        python_callable=preprocess_snapshot_flow,
+        # a failed batch does not hold the others
+        trigger_rule="all_done",
+        dag=dag,
+    ).expand(op_kwargs=crawl_news_task.output)
+
+    if summary_mode == 'batch':
+        # the summaries of every batch are sent together in Gemini batch jobs
+        summarize_article_flow_task = PythonOperator(
+            task_id='summarize_article_flow',
+            python_callable=summarize_article_flow,
+            trigger_rule="all_done",
+            dag=dag,
+        )
+        summarize_batch_wait_task = PythonSensor(
+            task_id='summarize_batch_wait',
+            python_callable=summarize_batch_wait,
+            # the worker slot is released between two polls
+            mode='reschedule',
+            poke_interval=summary_batch_poll,
+            # the callable gives up on the jobs first and falls back to direct requests
+            timeout=summary_batch_timeout + 10 * summary_batch_poll,
+            dag=dag,
+        )
+        summarize_tasks = [summarize_article_flow_task, summarize_batch_wait_task]
+    else:
+        summarize_article_flow_task = PythonOperator.partial(
+            task_id='summarize_article_flow',
+            python_callable=summarize_article_flow,
+            trigger_rule="all_done",
+            dag=dag,
+        ).expand(op_kwargs=crawl_news_task.output)
+        summarize_tasks = [summarize_article_flow_task]
+
+    # reducer of the mapped batches
+    gather_summaries_task = PythonOperator(
+        task_id='gather_summaries',
+        python_callable=gather_summaries,
+        trigger_rule="all_done",
+        dag=dag,
+    )
+    summary_tasks = [
+        snapshot_article_flow_task, 
+        preprocess_snapshot_flow_task, 
+        *summarize_tasks,
+        gather_summaries_task
+    ]
 
 # Define the task to crawl news
 analysis_market_task = PythonOperator(
@@ -445,5 +672,16 @@ recommend_order_task = PythonOperator(
     dag=dag,
 )
 
+compact_recommendations_task = PythonOperator(
+    task_id='compact_recommendations',
+    python_callable=compact_recommendations_flow,
+    # the dataset is compacted even when the recommendation failed
+    trigger_rule="all_done",
+    dag=dag,
+)
+
 # Define Task Dependencies
-prepare_DAG_task >> crawl_news_task >> snapshot_article_flow_task >> summarize_article_flow_task >> analysis_market_task >> opinion_order_task >> recommend_order_task
+prepare_DAG_task >> crawl_news_task >> summary_tasks[0]
+for upstream_task, downstream_task in zip(summary_tasks, summary_tasks[1:]):
+    upstream_task >> downstream_task
+summary_tasks[-1] >> analysis_market_task >> opinion_order_task >> recommend_order_task >> compact_recommendations_task
@@ -0,0 +1,481 @@
+'''
+Offline benchmark of the DAG stages at scaled article counts.
+
+A stub Gemini server, stub RSS, NewsAPI and klines endpoints and static
+fixture article pages stand in for the live services. Pages are opened by a
+fixture driver instead of a Selenium browser. Every stage callable of
+recommend_order.py runs in turn and reports its wall time, throughput, peak
+Python memory and the bytes uploaded to Gemini.
+
+    python tools/benchmark.py --articles 10 100 1000 --latency 0.05 --output bench.json
+'''
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import requests
+
+tools_folder = os.path.dirname(os.path.abspath(__file__))
+dags_folder = os.path.join(os.path.dirname(tools_folder), 'airflow', 'dags')
+sys.path.insert(0, tools_folder)
+
+from stub_gemini import serve as serve_gemini
+
+
+words = (
+    'inflation fed rates bitcoin etf inflows treasury yields dollar jobs payrolls tariffs china '
+    'europe ecb oil gold stocks nasdaq crypto regulation sec stablecoin mining halving liquidity '
+    'recession growth earnings banks housing consumer spending deficit debt ceiling election '
+    'senate bill exchange hack outflows miners hashrate volatility options futures whales'
+).split()
+
+# run once per batch returned by crawl_relate_news, as the mapped tasks of the DAG
+mapped_stages = ('snapshot_article_flow', 'preprocess_snapshot_flow', 'summarize_article_flow')
+
+stages = (
+    'crawl_relate_news',
+    'snapshot_article_flow',
+    'preprocess_snapshot_flow',
+    'summarize_article_flow',
+    'gather_summaries',
+    'analysis_market',
+    'opinion_order',
+    'recommend_order',
+)
+
+
+def fixture_articles(count, seed=0):
+    '''Distinct titles, links and publish dates of the fixture articles'''
+    rng = random.Random(seed)
+    now = time.time()
+    return [
+        {
+            'id': index,
+            'title': ' '.join(rng.sample(words, 7)).capitalize() + f' {index}',
+            'pub_date': time.strftime(
+                '%a, %d %b %Y %H:%M:%S GMT', time.gmtime(now - rng.uniform(0, 86400))
+            ),
+        }
+        for index in range(count)
+    ]
+
+
+def article_page(article, paragraphs=8):
+    '''Static HTML of a fixture article'''
+    rng = random.Random(article['id'])
+    body = '\n'.join(
+        f"<p>{' '.join(rng.choices(words, k=45))}.</p>" for _ in range(paragraphs)
+    )
+    return (
+        f"<html><head><title>{article['title']}</title></head><body>"
+        f"<nav><a href='/'>Home</a></nav><article><h1>{article['title']}</h1>\n{body}\n</article>"
+        f"<footer>Fixture news</footer></body></html>"
+    )
+
+
+class FixtureState:
+    '''Articles served by the fixture endpoints for the current scale'''
+    def __init__(self, rss_feeds=2):
+        self.rss_feeds = rss_feeds
+        self.articles = []
+        self.base_url = None
+
+    def feed_articles(self, feed):
+        '''Articles of an RSS feed, the last share goes to NewsAPI'''
+        return [article for article in self.articles if article['id'] % (self.rss_feeds + 1) == feed]
+
+    def link(self, article):
+        return f"{self.base_url}/articles/{article['id']}.html"
+
+
+def make_fixture_handler(state):
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path.startswith('/rss/'):
+                feed = int(url.path[len('/rss/'):].split('.')[0])
+                items = ''.join(
+                    f"<item><title>{article['title']}</title><link>{state.link(article)}</link>"
+                    f"<pubDate>{article['pub_date']}</pubDate></item>"
+                    for article in state.feed_articles(feed)
+                )
+                self._send(200, f'<?xml version="1.0"?><rss><channel>{items}</channel></rss>', 'application/rss+xml')
+            elif url.path == '/newsapi':
+                articles = state.feed_articles(state.rss_feeds)
+                page, page_size = int(query['page'][0]), int(query['pageSize'][0])
+                self._send(200, json.dumps({
+                    'status': 'ok',
+                    'totalResults': len(articles),
+                    'articles': [
+                        {'title': article['title'], 'url': state.link(article), 'publishedAt': article['pub_date']}
+                        for article in articles[(page - 1) * page_size:page * page_size]
+                    ],
+                }), 'application/json')
+            elif url.path.startswith('/articles/'):
+                article_id = int(url.path[len('/articles/'):].split('.')[0])
+                self._send(200, article_page(state.articles[article_id]), 'text/html')
+            elif url.path == '/klines':
+                self._send(200, json.dumps(klines(query)), 'application/json')
+            else:
+                self._send(404, '', 'text/plain')
+
+    return FixtureHandler
+
+
+interval_milliseconds = {'1h': 3_600_000, '4h': 14_400_000, '1d': 86_400_000}
+
+
+def klines(query):
+    '''Binance-style candles of a random walk, from startTime to now'''
+    step = interval_milliseconds[query['interval'][0]]
+    now = int(time.time() * 1000)
+    open_time = int(query.get('startTime', [now - 200 * step])[0]) // step * step
+    limit = int(query.get('limit', [1000])[0])
+    rng = random.Random(open_time)
+    rows, price = [], 95000.0
+    while open_time <= now and len(rows) < limit:
+        close = price * (1 + rng.uniform(-0.02, 0.02))
+        rows.append([
+            open_time, f'{price:.2f}', f'{max(price, close) * 1.005:.2f}',
+            f'{min(price, close) * 0.995:.2f}', f'{close:.2f}', f'{rng.uniform(1e3, 5e4):.2f}',
+            open_time + step - 1,
+        ])
+        price = close
+        open_time += step
+    return rows
+
+
+def serve_fixtures():
+    '''Start the feeds, article pages and klines server in a background thread'''
+    state = FixtureState()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_fixture_handler(state))
+    server.daemon_threads = True
+    state.base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+class ArticleParser(HTMLParser):
+    '''Title and paragraphs of a fixture page, what extract_article_script reads in a browser'''
+    def __init__(self):
+        super().__init__()
+        self.title = ''
+        self.paragraphs = []
+        self._tag = None
+        self._in_article = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'article':
+            self._in_article = True
+        self._tag = tag
+
+    def handle_endtag(self, tag):
+        if tag == 'article':
+            self._in_article = False
+        self._tag = None
+
+    def handle_data(self, data):
+        text = ' '.join(data.split())
+        if not text:
+            return
+        if self._tag == 'h1':
+            self.title = text
+        elif self._tag == 'p' and self._in_article:
+            self.paragraphs.append(text)
+
+
+class FixtureDriver:
+    '''Stand-in for a remote browser session: pages are downloaded and parsed, screenshots drawn'''
+    viewport_height = 1080
+    page_height = 2400
+
+    def __init__(self, domain=None):
+        from plugins.page_wait import resource_count_script
+        from plugins.snapshot import extract_article_script
+        from plugins.snapshot import full_page_script
+
+        self.scripts = {
+            extract_article_script: 'article',
+            resource_count_script: 'resources',
+            full_page_script: 'full_page',
+        }
+        self.session = requests.Session()
+        self.current_url = None
+        self.article = None
+        self.offset = 0
+
+    def get(self, url):
+        response = self.session.get(url, timeout=10)
+        response.raise_for_status()
+        parser = ArticleParser()
+        parser.feed(response.text)
+        self.current_url = url
+        self.article = {'title': parser.title, 'paragraphs': parser.paragraphs, 'tables': []}
+        self.offset = 0
+
+    def set_window_size(self, width, height):
+        self.viewport_height = height
+
+    def execute_script(self, script, *args):
+        if self.scripts.get(script) == 'article':
+            return self.article
+        if self.scripts.get(script) == 'resources':
+            return 0
+        if self.scripts.get(script) == 'full_page':
+            return {'width': 1750, 'height': self.page_height}
+        if script == 'return document.body.scrollHeight':
+            return self.page_height
+        if script == 'return window.pageYOffset':
+            return self.offset
+        if script == 'return window.innerHeight':
+            return self.viewport_height
+        if script.startswith('window.scrollTo'):
+            self.offset = min(
+                int(script.split(',')[1].strip(' );')), self.page_height - self.viewport_height
+            )
+            return None
+        # readyState, viewport images, liveness probes
+        return 1
+
+    def draw_page(self, height, seed):
+        from PIL import Image
+        from PIL import ImageDraw
+
+        image = Image.new('RGB', (1750, height), 'white')
+        draw = ImageDraw.Draw(image)
+        rng = random.Random(seed)
+        for line in range(40, height - 40, 28):
+            draw.text((60, line), ' '.join(rng.choices(words, k=20)), fill='black')
+        return image
+
+    def save_screenshot(self, path):
+        self.draw_page(self.viewport_height, f'{self.current_url}{self.offset}').save(path)
+        return True
+
+    def execute_cdp_cmd(self, command, params):
+        # Page.captureScreenshot of the clip, as the browser encodes it
+        output = io.BytesIO()
+        self.draw_page(params['clip']['height'], self.current_url).save(output, format='PNG')
+        return {'data': base64.b64encode(output.getvalue()).decode('ascii')}
+
+    def quit(self):
+        self.session.close()
+
+
+class TaskInstance:
+    '''The part of an Airflow task instance the stage callables use'''
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.xcoms = {}
+
+    def xcom_push(self, key, value):
+        self.xcoms[key] = value
+
+    def xcom_pull(self, task_ids=None, key='return_value'):
+        return self.xcoms.get(key)
+
+
+def configure_environment(work_folder, gemini_api_path, fixtures_url, args):
+    '''Point every path and endpoint of the DAG to the work folder and the stubs'''
+    os.environ.update({
+        'API_PATH': gemini_api_path,
+        'MODEL_GEMINI': 'stub',
+        'NEWSAPI': 'benchmark',
+        'NEWSAPI_URL': f'{fixtures_url}/newsapi',
+        'NEWSAPI_MAX_PAGES': '100',
+        'KLINES_API_URL': f'{fixtures_url}/klines',
+        'SELENIUM_DOMAINS': ','.join(f'fixture{node}' for node in range(args.nodes)),
+        'SNAPSHOT_MODE': args.snapshot_mode,
+        'SCREENSHOT_CAPTURE': args.screenshot_capture,
+        'GEMINI_CACHE': 'on' if args.cache else 'off',
+        'GEMINI_CACHE_PATH': os.path.join(work_folder, 'cache', 'gemini_cache.sqlite'),
+        'ARTICLE_INDEX_PATH': os.path.join(work_folder, 'cache', 'article_index.sqlite'),
+        'PAGE_READY_TIMES_PATH': os.path.join(work_folder, 'cache', 'page_ready_times.json'),
+        'ARTIFACT_STORE_PATH': os.path.join(work_folder, 'artifacts', 'artifacts.sqlite'),
+        'KLINES_STORE_PATH': os.path.join(work_folder, 'market_data', 'klines.sqlite'),
+        'RECOMMENDATIONS_PATH': os.path.join(work_folder, 'recommendations'),
+        'TELEMETRY_PATH': os.path.join(work_folder, 'stats', 'telemetry'),
+        'ANALYSIS_MODE': args.analysis_mode,
+    })
+    # the benchmark measures the pipeline, not the production quota
+    os.environ.setdefault('GEMINI_RPM', '100000')
+    os.environ.setdefault('GEMINI_TPM', '1000000000')
+    for folder in ('cache', 'artifacts', 'market_data', 'recommendations', 'images', 'stats', 'buffer_memory'):
+        os.makedirs(os.path.join(work_folder, folder), exist_ok=True)
+
+
+def run_stage(name, callable, gemini_stats, articles, verbose):
+    '''Run one stage callable and measure it'''
+    before = gemini_stats()
+    output = io.StringIO()
+    tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    error = None
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        try:
+            callable()
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+    wall_time = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    after = gemini_stats()
+    return {
+        'stage': name,
+        'articles': articles,
+        'wall_time': round(wall_time, 3),
+        'articles_per_second': round(articles / wall_time, 2) if wall_time and articles else None,
+        'peak_memory_mb': round(peak / 1024 / 1024, 2),
+        'gemini_requests': after['requests'] - before['requests'],
+        'bytes_uploaded': after['bytes_received'] - before['bytes_received'],
+        'error': error,
+    }
+
+
+def run_scale(count, ro, fixtures, gemini_stats, work_folder, verbose):
+    '''Run every stage on `count` crawled articles'''
+    from plugins.artifact_store import ArtifactStore
+
+    fixtures.articles = fixture_articles(count, seed=count)
+    os.environ['RSS_URL'] = ';;'.join(
+        f'{fixtures.base_url}/rss/{feed}.xml' for feed in range(fixtures.rss_feeds)
+    )
+    ti = TaskInstance(f'benchmark-{count}-{int(time.time())}')
+    store = ArtifactStore()
+
+    results = []
+    batches = []
+    for stage in stages:
+        # articles entering the stage
+        if stage == 'crawl_relate_news':
+            articles = count
+        elif stage in mapped_stages or stage == 'gather_summaries':
+            articles = len(store.selected_links(ti.run_id))
+        elif stage == 'analysis_market':
+            articles = len(store.summaries(ti.run_id))
+        else:
+            articles = 0
+
+        if stage == 'crawl_relate_news':
+            def call():
+                batches[:] = ro.crawl_relate_news(ti)
+        elif stage == 'snapshot_article_flow':
+            # the batches run side by side like on several workers, one per node
+            def call():
+                with ThreadPoolExecutor(max_workers=max(len(ro.domains_selenium), 1)) as executor:
+                    list(executor.map(lambda batch: ro.snapshot_article_flow(ti, **batch), batches))
+        elif stage in mapped_stages:
+            # the client keeps one aiohttp session per event loop, these batches run in turn
+            def call(stage=stage):
+                for batch in batches:
+                    getattr(ro, stage)(ti, **batch)
+        elif stage == 'opinion_order':
+            def call():
+                ro.opinion_order(ro.domain_selenium0, ti)
+        else:
+            def call(stage=stage):
+                getattr(ro, stage)(ti)
+        result = run_stage(stage, call, gemini_stats, articles, verbose)
+        result['scale'] = count
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def print_result(result):
+    throughput = result['articles_per_second']
+    print(
+        f"{result['scale']:>6} {result['stage']:<26} {result['wall_time']:>9.2f}s "
+        f"{throughput if throughput is not None else '-':>10} art/s "
+        f"{result['peak_memory_mb']:>9.1f} MB {result['gemini_requests']:>6} req "
+        f"{result['bytes_uploaded']:>12} B"
+        + (f"  {result['error']}" if result['error'] else '')
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--articles', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--latency', type=float, default=0.05, help='mean seconds per Gemini request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of Gemini requests answered 429/503')
+    parser.add_argument('--nodes', type=int, default=4, help='fixture browser nodes')
+    parser.add_argument('--snapshot-mode', default='text', choices=('text', 'screenshot', 'compare'))
+    parser.add_argument('--screenshot-capture', default='full_page', choices=('full_page', 'scroll'))
+    parser.add_argument('--analysis-mode', default='full', choices=('full', 'incremental'))
+    parser.add_argument('--cache', action='store_true', help='keep the Gemini response cache on')
+    parser.add_argument('--work-folder', help='folder of the stores, kept after the run when given')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the stages')
+    args = parser.parse_args()
+
+    gemini_server, gemini_api_path = serve_gemini(latency=args.latency, error_rate=args.error_rate)
+    fixture_server, fixtures = serve_fixtures()
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix='dag-benchmark-')
+    configure_environment(work_folder, gemini_api_path, fixtures.base_url, args)
+
+    # the DAG reads its configuration when it is imported
+    sys.path.insert(0, dags_folder)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import recommend_order as ro
+        from plugins import snapshot
+    ro.images_folder_path = os.path.join(work_folder, 'images')
+    ro.stats_folder_path = os.path.join(work_folder, 'stats')
+    domains = snapshot.selenium_domains()
+    # every node list a stage can ask for: all the nodes, or one node per mapped batch
+    for pool_domains in [domains] + [[domain] for domain in domains]:
+        snapshot._webdriver_pools[tuple(pool_domains)] = snapshot.WebDriverPool(
+            pool_domains,
+            driver_factory=FixtureDriver,
+            node_probe=lambda domain: True,
+            free_probe=lambda domain: True
+        )
+
+    def gemini_stats():
+        with gemini_server.state.lock:
+            return dict(gemini_server.state.stats)
+
+    print(f"Work folder: {work_folder}")
+    print(f"{'scale':>6} {'stage':<26} {'wall time':>10} {'throughput':>16} {'peak memory':>12} {'gemini':>10} {'uploaded':>14}")
+    tracemalloc.start()
+    results = []
+    for count in args.articles:
+        results += run_scale(count, ro, fixtures, gemini_stats, work_folder, args.verbose)
+    tracemalloc.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    gemini_server.shutdown()
+    fixture_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
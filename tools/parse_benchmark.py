@@ -0,0 +1,114 @@
+'''
+Parse-time benchmark of recommend_order.py.
+
+The scheduler re-parses the DAG file every few seconds. Each sample starts a
+fresh interpreter, imports Airflow first as the DAG processor already has it,
+then times the import of the DAG file alone. It reports the median time, the
+heavy libraries the file pulled in and the slowest modules it imported. It
+fails when the median goes over the budget or a heavy library is imported.
+
+    python tools/parse_benchmark.py --samples 5 --budget-ms 100 --top 10
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+tools_folder = os.path.dirname(os.path.abspath(__file__))
+dags_folder = os.path.join(os.path.dirname(tools_folder), 'airflow', 'dags')
+
+# libraries the task callables import, never the parse
+heavy_modules = (
+    'aiohttp', 'matplotlib', 'numpy', 'pandas', 'PIL', 'pyarrow', 'requests', 'selenium', 'urllib3'
+)
+
+marker = '--- dag import ---'
+
+probe = f'''
+import importlib.util
+import json
+import sys
+import time
+
+import airflow.sdk
+from airflow.providers.standard.operators.python import PythonOperator
+from airflow.providers.standard.sensors.python import PythonSensor
+
+before = set(sys.modules)
+sys.stderr.write({marker!r} + "\\n")
+sys.stderr.flush()
+start_time = time.perf_counter()
+spec = importlib.util.spec_from_file_location("recommend_order", "recommend_order.py")
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+seconds = time.perf_counter() - start_time
+print(json.dumps({{
+    "seconds": seconds,
+    "tasks": len(module.dag.task_dict),
+    "modules": sorted({{name.split(".")[0] for name in set(sys.modules) - before}}),
+}}))
+'''
+
+
+def parse_sample(importtime=False):
+    '''Import the DAG file in a fresh interpreter, returns (result, importtime lines)'''
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', probe]
+    completed = subprocess.run(command, cwd=dags_folder, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"The DAG file could not be imported:\n{completed.stderr}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    lines = completed.stderr.split(marker, 1)[-1].splitlines() if importtime else []
+    return result, lines
+
+
+def slowest_imports(lines, top):
+    '''The modules with the largest own import time, from the -X importtime lines'''
+    imports = []
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=100, help='largest median parse time')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to list')
+    args = parser.parse_args()
+
+    # the first sample warms the bytecode cache, like a long-running scheduler
+    parse_sample()
+    samples = [parse_sample()[0] for _ in range(args.samples)]
+    times = [sample['seconds'] * 1000 for sample in samples]
+    median = statistics.median(times)
+    modules = samples[-1]['modules']
+    heavy = [name for name in heavy_modules if name in modules]
+
+    print(
+        f"recommend_order.py: {samples[-1]['tasks']} tasks, parsed in {median:.1f} ms "
+        f"(min {min(times):.1f}, max {max(times):.1f}, budget {args.budget_ms:.0f})"
+    )
+    print(f"Modules imported by the DAG file: {', '.join(modules)}")
+    if args.top:
+        _, lines = parse_sample(importtime=True)
+        for self_us, name in slowest_imports(lines, args.top):
+            print(f"{self_us / 1000:>8.1f} ms  {name}")
+
+    failures = []
+    if median > args.budget_ms:
+        failures.append(f"the median parse time {median:.1f} ms is over the budget")
+    if heavy:
+        failures.append(f"the parse imports {', '.join(heavy)}, import them in the callables")
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+'''
+Local stand-in for the Gemini API: generateContent, batchGenerateContent,
+batch polling and cancelling, with a configurable latency and error rate.
+
+    python tools/stub_gemini.py --port 8765 --latency 0.2 --error-rate 0.05
+    API_PATH=http://localhost:8765/v1beta/models/stub:generateContent?key=test
+'''
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+def prompt_text(payload):
+    '''Concatenate the text parts of a generateContent request'''
+    texts = []
+    for content in payload.get('contents') or []:
+        for part in content.get('parts') or []:
+            if isinstance(part, dict) and isinstance(part.get('text'), str):
+                texts.append(part['text'])
+    return '\n'.join(texts)
+
+
+def answer_text(payload):
+    '''Answer a request the way the DAG expects from its prompt'''
+    prompt = prompt_text(payload)
+    if 'Provide the ids of the filtered articles' in prompt:
+        # keep every other article
+        ids = re.findall(r'^\s*(\d+)\|', prompt, re.MULTILINE)
+        return json.dumps([int(short_id) for short_id in ids[::2]])
+    if '"buy_zone"' in prompt:
+        base = 95000 + random.uniform(-50, 50)
+        return json.dumps({
+            'buy_zone': {'min': round(base - 1500, 2), 'max': round(base - 1000, 2)},
+            'sell_zone': {'min': round(base + 1000, 2), 'max': round(base + 1500, 2)},
+            'stop_loss': {'min': round(base - 2000, 2), 'max': round(base - 1800, 2)},
+        })
+    if 'Update the analysis with the new articles' in prompt:
+        # keep the points of the state and add one supported by the new articles
+        state = re.search(r'^\s*(\{"dimensions".*)$', prompt, re.MULTILINE)
+        state = json.loads(state.group(1)) if state else {'dimensions': {}, 'sentiment': ''}
+        ids = re.findall(r'^\s*\[(\w+)\]', prompt, re.MULTILINE)
+        dimensions = state['dimensions']
+        if ids:
+            dimensions.setdefault('economic', []).append({
+                'point': f'{len(ids)} new articles report easing inflation and BTC inflows.',
+                'impact': 'bullish',
+                'article_ids': ids,
+            })
+        return json.dumps({'dimensions': dimensions, 'sentiment': 'Moderately bullish.'})
+    if 'Summarize this article' in prompt:
+        title = re.search(r'Here is the article:\s*(.{0,80})', prompt)
+        return (
+            f"Title: {title.group(1).strip() if title else 'Article'}\n"
+            "Content: Inflation slowed to 2.9% while BTC inflows reached $1.2B."
+        )
+    if 'partial analys' in prompt:
+        return 'Merged PESTEL analysis: risk appetite improves, BTC sentiment is bullish.'
+    return 'PESTEL analysis: easing inflation supports BTC, regulation remains a risk.'
+
+
+def generate_response(payload):
+    '''A generateContent response with its usage metadata'''
+    text = answer_text(payload)
+    json_mode = (payload.get('generationConfig') or {}).get('responseMimeType') == 'application/json'
+    if text.startswith(('{', '[')) and not json_mode:
+        # without JSON mode the model tends to wrap its JSON in prose
+        text = f"Here is the result:\n```json\n{text}\n```\nLet me know if you need more."
+    return {
+        'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}}],
+        'usageMetadata': {'promptTokenCount': len(json.dumps(payload)) // 4},
+    }
+
+
+class StubState:
+    '''Batch jobs and counters shared by the request handlers'''
+    def __init__(self, latency=0.0, error_rate=0.0, batch_delay=5.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.batch_delay = batch_delay
+        self.batches = {}
+        self.stats = {'requests': 0, 'generate': 0, 'batch_requests': 0, 'errors': 0, 'bytes_received': 0}
+        self.lock = threading.Lock()
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def batch_operation(self, name):
+        '''Operation of a batch job, done once its delay is over'''
+        with self.lock:
+            batch = self.batches.get(name)
+        if batch is None:
+            return None
+        state = batch['state']
+        if state == 'RUNNING' and time.time() - batch['created_at'] >= self.batch_delay:
+            state = 'SUCCEEDED'
+        operation = {'name': name, 'metadata': {'state': f'BATCH_STATE_{state}'}}
+        if state == 'SUCCEEDED':
+            operation['done'] = True
+            operation['response'] = {'inlinedResponses': {'inlinedResponses': [
+                # a few requests of a batch fail like the direct requests do
+                {'metadata': request.get('metadata'), 'error': {'code': 500, 'message': 'stub error'}}
+                if random.random() < self.error_rate else
+                {'metadata': request.get('metadata'), 'response': generate_response(request['request'])}
+                for request in batch['requests']
+            ]}}
+        elif state != 'RUNNING':
+            operation['done'] = True
+        return operation
+
+
+def make_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, headers=None):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            state.count('bytes_received', length)
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def _fail(self):
+            '''Answer 429 or 503 for a share of the requests'''
+            if random.random() >= state.error_rate:
+                return False
+            state.count('errors')
+            if random.random() < 0.5:
+                self._send(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED', 'details': [
+                    {'@type': 'type.googleapis.com/google.rpc.RetryInfo', 'retryDelay': '1s'}
+                ]}})
+            else:
+                self._send(503, {'error': {'code': 503, 'status': 'UNAVAILABLE'}}, {'Retry-After': '1'})
+            return True
+
+        def do_POST(self):
+            state.count('requests')
+            path = self.path.split('?')[0]
+            payload = self._read_json()
+            if state.latency:
+                time.sleep(random.uniform(0.5, 1.5) * state.latency)
+
+            if path.endswith(':generateContent'):
+                if not self._fail():
+                    state.count('generate')
+                    self._send(200, generate_response(payload))
+            elif path.endswith(':batchGenerateContent'):
+                batch = payload.get('batch') or {}
+                requests = ((batch.get('input_config') or {}).get('requests') or {}).get('requests') or []
+                name = f'batches/{uuid.uuid4().hex[:12]}'
+                with state.lock:
+                    state.batches[name] = {'requests': requests, 'created_at': time.time(), 'state': 'RUNNING'}
+                state.count('batch_requests', len(requests))
+                self._send(200, {'name': name, 'metadata': {'state': 'BATCH_STATE_PENDING'}})
+            elif path.endswith(':cancel'):
+                name = path.split('/v1beta/')[-1][:-len(':cancel')]
+                with state.lock:
+                    if name in state.batches:
+                        state.batches[name]['state'] = 'CANCELLED'
+                self._send(200, {})
+            else:
+                self._send(404, {'error': {'code': 404, 'message': path}})
+
+        def do_GET(self):
+            state.count('requests')
+            path = self.path.split('?')[0]
+            if path == '/stats':
+                with state.lock:
+                    self._send(200, dict(state.stats))
+                return
+            operation = state.batch_operation(path.split('/v1beta/')[-1])
+            if operation is None:
+                self._send(404, {'error': {'code': 404, 'message': path}})
+            else:
+                self._send(200, operation)
+
+    return StubHandler
+
+
+def serve(port=0, latency=0.0, error_rate=0.0, batch_delay=5.0):
+    '''Start the stub in a background thread, returns (server, API_PATH to use)'''
+    state = StubState(latency, error_rate, batch_delay)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_path = f'http://127.0.0.1:{server.server_address[1]}/v1beta/models/stub:generateContent?key=test'
+    return server, api_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.2, help='mean seconds per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 429/503')
+    parser.add_argument('--batch-delay', type=float, default=5.0, help='seconds before a batch job succeeds')
+    args = parser.parse_args()
+
+    server, api_path = serve(args.port, args.latency, args.error_rate, args.batch_delay)
+    print(f"Gemini stub listening, API_PATH={api_path}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()